@@ -0,0 +1,73 @@
+"""
+Benchmark merging many large configuration files.
+
+Usage: python benchmarks/bench_merge.py [--files N] [--sets N] [--repeat N]
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from diu.merge import Merger, merge  # noqa: E402
+
+
+def generate_configs(files, sets):
+    """
+    Generate `files` configurations, each defining `sets` watch sets. Every
+    set appears in several files, so its images and commands get merged.
+    """
+    configs = []
+    for f in range(files):
+        watch = {}
+        for s in range(sets):
+            name = "set{}".format((f * sets // 2 + s) % (files * sets // 2 or 1))
+            watch[name] = {
+                'images': ["registry.example.com/app{}:{}".format(s, t) for t in range(5)],
+                'commands': [
+                    "systemctl restart {}".format(name),
+                    {'run': "/usr/local/bin/notify {}".format(f), 'timeout': 30},
+                ],
+                'interval': 60,
+            }
+        configs.append({
+            'config': {'docker': {'base_url': "unix://var/run/docker.sock"}},
+            'watch': watch,
+        })
+    return configs
+
+
+def merge_incrementally(configs):
+    merger = Merger()
+    result = {'config': {}, 'watch': {}}
+    for config in configs:
+        result = merger.merge(result, config)
+    return result
+
+
+def merge_pairwise(configs):
+    result = {'config': {}, 'watch': {}}
+    for config in configs:
+        result = merge(result, config)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=40, help="number of files to merge")
+    parser.add_argument("--sets", type=int, default=1000, help="number of watch sets per file")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed repetitions")
+    args = parser.parse_args()
+
+    configs = generate_configs(args.files, args.sets)
+    print("Merging {} files of {} sets each".format(args.files, args.sets))
+    for name, func in (("Merger (shared)", merge_incrementally),
+                       ("merge() per file", merge_pairwise)):
+        best = min(timeit.repeat(lambda: func(configs), number=1, repeat=args.repeat))
+        print("{:<20} {:8.1f} ms".format(name, best * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark the startup time of runs with nothing to do.
+
+Usage: python benchmarks/bench_startup.py [--repeat N] [--max-import-ms MS]
+
+Measures, in fresh interpreters, the time taken to start Python itself,
+to import `diu.main` and to complete a run in which every image was
+checked recently, as happens when running from cron every minute. Exits
+with status 1 when importing `diu.main` takes longer than `--max-import-ms`,
+so import-time regressions can fail a build.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from diu.state import ImageState, StateStore  # noqa: E402
+
+CONFIG = """
+config:
+  state:
+    path: {state}
+    ttl: 3600
+watch:
+{sets}
+"""
+
+
+def write_config(directory, sets):
+    """
+    Write a configuration with `sets` sets of two images each, and record
+    every image as checked just now.
+    """
+    state = os.path.join(directory, "state.db")
+    store = StateStore(state)
+    lines = []
+    for i in range(sets):
+        images = ["app{}:latest".format(i), "app{}-worker:latest".format(i)]
+        lines.append("  set{}:\n    images: [{}]\n    commands: []".format(i, ", ".join(images)))
+        for image in images:
+            store.put(ImageState(image, checked_at=time.time()))
+    store.close()
+    path = os.path.join(directory, "config.yml")
+    with open(path, "w") as f:
+        f.write(CONFIG.format(state=state, sets="\n".join(lines)))
+    return path
+
+
+def measure(code, args, repeat):
+    """
+    Run `code` in `repeat` fresh interpreters, returning the median time in ms.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call([sys.executable, "-c", code] + args, env=env,
+                                  stdout=devnull, stderr=devnull)
+        timings.append((time.time() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of runs to take the median of")
+    parser.add_argument("--sets", type=int, default=100,
+                        help="number of sets in the configuration")
+    parser.add_argument("--max-import-ms", type=float, default=None,
+                        help="fail when importing diu.main takes longer than this")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        config = write_config(directory, args.sets)
+        interpreter = measure("pass", [], args.repeat)
+        imported = measure("import diu.main", [], args.repeat)
+        run = measure("import sys; from diu.main import main; sys.argv[0] = 'diu'; main()",
+                      [config], args.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    import_ms = imported - interpreter
+    print("{:<32} {:>8.1f} ms".format("python startup", interpreter))
+    print("{:<32} {:>8.1f} ms".format("import diu.main", import_ms))
+    print("{:<32} {:>8.1f} ms".format("run with nothing due ({} sets)".format(args.sets),
+                                      run - interpreter))
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print("Importing diu.main took longer than {} ms".format(args.max_import_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Benchmark complete update runs against a fake Docker daemon.
+
+Usage: python benchmarks/bench_updater.py [--sizes 10,100,1000] [options]
+
+For every size N, N images and N sets (each listing two neighbouring images)
+are checked. Half of the images have a newer version to pull. Every run
+happens in a fresh worker process, which reports the wall time, CPU time and
+peak resident memory of the run. Runs in which any image failed to update
+aren't timed, and the benchmark exits with status 1 instead.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from diu.updater import ContainerSet, Updater  # noqa: E402
+
+
+def image_name(i):
+    return "bench/image{}:latest".format(i)
+
+
+def populate(docker, size):
+    """
+    Add `size` images to the fake daemon, every other one with an update.
+    """
+    docker.images.clear()
+    docker.remote.clear()
+    for i in range(size):
+        remote_id = "sha256:{:064x}".format(i + (size if i % 2 else 0))
+        docker.add_image(image_name(i), local_id="sha256:{:064x}".format(i), remote_id=remote_id)
+
+
+def create_sets(size, commands):
+    return [
+        ContainerSet(
+            name="set{}".format(i),
+            images=[image_name(i), image_name((i + 1) % size)],
+            commands=["true"] if commands else [],
+        )
+        for i in range(size)
+    ]
+
+
+def create_client(backend, base_url):
+    if backend == "asyncio":
+        from diu.aio import AsyncioClient
+        return AsyncioClient(base_url=base_url, version="1.24")
+    from docker import Client
+    return Client(base_url=base_url, version="1.24")
+
+
+def worker(args):
+    """
+    Perform a single run and print its measurements as JSON.
+    """
+    logging.basicConfig(level=logging.CRITICAL)
+    client = create_client(args.backend, args.base_url)
+    updater = Updater(client, create_sets(args.size, args.commands), concurrency=args.pulls)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    updater.do_updates()
+    wall = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    print(json.dumps({
+        'wall': wall,
+        'cpu': (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_mb': after.ru_maxrss / 1024,
+        'errors': updater.error_count,
+    }))
+
+
+def run(args, base_url, size):
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--base-url", base_url, "--size", str(size), "--backend", args.backend,
+        "--pulls", str(args.pulls),
+    ]
+    if args.commands:
+        command.append("--commands")
+    return json.loads(subprocess.check_output(command).decode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000",
+                        help="comma separated numbers of images and sets")
+    parser.add_argument("--backend", choices=("docker-py", "asyncio"), default="docker-py")
+    parser.add_argument("--pulls", type=int, default=4, help="number of parallel pulls")
+    parser.add_argument("--commands", action="store_true",
+                        help="run a command for every updated set")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds the daemon takes to inspect an image")
+    parser.add_argument("--layers", type=int, default=3, help="layers per image")
+    parser.add_argument("--layer-size", type=int, default=10 * 1000 * 1000,
+                        help="size of each layer in bytes")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="download speed in bytes per second (default: unlimited)")
+    parser.add_argument("--unix", action="store_true",
+                        help="serve the fake daemon over a unix socket instead of TCP, which "
+                             "docker-py only supports with the requests versions it pins")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    from tests.fakedocker import FakeDocker
+    docker = FakeDocker(
+        inspect_latency=args.latency,
+        layers=args.layers,
+        layer_size=args.layer_size,
+        speed=args.speed,
+        tcp=not args.unix,
+    ).start()
+    try:
+        print("{:>7} {:>7} {:>10} {:>10} {:>10}".format(
+            "images", "sets", "wall (s)", "cpu (s)", "peak (MB)"))
+        for size in [int(s) for s in args.sizes.split(",")]:
+            populate(docker, size)
+            result = run(args, docker.base_url, size)
+            if result['errors']:
+                print("{} errors while updating {} images, not reporting timings".format(
+                    result['errors'], size), file=sys.stderr)
+                sys.exit(1)
+            print("{:>7} {:>7} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+                size, size, result['wall'], result['cpu'], result['peak_mb']))
+    finally:
+        docker.stop()
+
+
+if __name__ == "__main__":
+    main()
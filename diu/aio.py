@@ -0,0 +1,440 @@
+"""
+An asyncio based backend for talking to the Docker daemon.
+
+All requests are multiplexed by a single event loop over a pool of
+persistent connections to the daemon, so the connections are reused
+between requests rather than opened by each thread.
+
+The updater still calls the client through its synchronous facade from
+its worker threads, so the number of inspections and pulls in flight is
+capped by those threads (`concurrency.pulls`), not by the pool size.
+
+This module requires Python 3.6 or newer and is only imported when
+`config.docker.backend` is set to `asyncio`.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+import asyncio
+import json
+import threading
+from urllib.parse import quote, urlencode, urlparse
+
+import requests
+from docker import auth
+from docker.constants import DEFAULT_DOCKER_API_VERSION, DEFAULT_TIMEOUT_SECONDS
+from docker.errors import APIError
+from docker.utils import parse_repository_tag
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BASE_URL = "unix://var/run/docker.sock"
+# Number of chunks of a pull's progress stream buffered ahead of the
+# thread consuming it, after which reading from the daemon is paused.
+PULL_BUFFER_SIZE = 64
+_END_OF_STREAM = object()
+
+
+class Response(object):
+    """
+    The status and headers of an HTTP response. The body is read through
+    `read()` or `iter_chunks()`.
+    """
+
+    def __init__(self, connection, status, reason, headers):
+        self.connection = connection
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    @property
+    def chunked(self):
+        return self.headers.get("transfer-encoding", "").lower() == "chunked"
+
+    async def iter_chunks(self):
+        """
+        Yield the body of the response as it arrives.
+        """
+        reader = self.connection.reader
+        if self.chunked:
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                data = await reader.readexactly(size)
+                await reader.readexactly(2)
+                yield data
+        elif "content-length" in self.headers:
+            length = int(self.headers["content-length"])
+            if length:
+                yield await reader.readexactly(length)
+        else:
+            self.connection.reusable = False
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                yield data
+
+    async def read(self):
+        """
+        Read and return the complete body of the response.
+        """
+        body = b""
+        async for chunk in self.iter_chunks():
+            body += chunk
+        return body
+
+    def to_requests_response(self, content):
+        """
+        Convert this response into a `requests.Response`, as expected by
+        `docker.errors.APIError`.
+        """
+        response = requests.Response()
+        response.status_code = self.status
+        response.reason = self.reason
+        response._content = content
+        return response
+
+
+class Connection(object):
+    """
+    A persistent HTTP/1.1 connection to the Docker daemon.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    async def request(self, method, path, headers=None, body=b""):
+        """
+        Send a request and read the status line and headers of the response.
+        """
+        lines = ["{} {} HTTP/1.1".format(method, path), "Host: docker"]
+        for key, value in (headers or {}).items():
+            lines.append("{}: {}".format(key, value))
+        lines.append("Content-Length: {}".format(len(body)))
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by Docker daemon")
+        # The reason phrase is optional, as in "HTTP/1.1 200"
+        _, _, status = status_line.decode("latin-1").rstrip("\r\n").partition(" ")
+        status, _, reason = status.partition(" ")
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+        if response_headers.get("connection", "").lower() == "close":
+            self.reusable = False
+        return Response(self, int(status), reason, response_headers)
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class ConnectionPool(object):
+    """
+    A pool of at most `size` connections to the Docker daemon.
+    """
+
+    def __init__(self, base_url, size=DEFAULT_POOL_SIZE):
+        """
+        :param base_url:
+            The address of the daemon, as `unix:///path/to/socket` or
+            `tcp://host:port`.
+        :param size:
+            The maximum number of connections open at the same time.
+        """
+        self.url = urlparse(base_url)
+        if self.url.scheme not in ("unix", "tcp", "http"):
+            raise ValueError("Unsupported Docker base URL: {}".format(base_url))
+        self.size = size
+        self._idle = []
+        self._slots = None
+
+    async def _connect(self):
+        if self.url.scheme == "unix":
+            reader, writer = await asyncio.open_unix_connection(
+                "/" + (self.url.netloc + self.url.path).lstrip("/")
+            )
+        else:
+            reader, writer = await asyncio.open_connection(self.url.hostname, self.url.port)
+        return Connection(reader, writer)
+
+    async def acquire(self):
+        """
+        Return an idle connection, opening a new one if there is none.
+        Waits while `size` connections are in use.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                connection = self._idle.pop()
+                if not connection.reader.at_eof():
+                    return connection
+                connection.close()
+            return await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        """
+        Return a connection to the pool, closing it when it can't be reused.
+        """
+        if connection.reusable:
+            self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+class AsyncDockerAPI(object):
+    """
+    Coroutines for the Docker API operations used by the updater.
+    """
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, version=DEFAULT_DOCKER_API_VERSION,
+                 timeout=DEFAULT_TIMEOUT_SECONDS, pool_size=DEFAULT_POOL_SIZE):
+        self.version = version
+        self.timeout = timeout
+        self.pool = ConnectionPool(base_url, size=pool_size)
+        self._auth_configs = auth.load_config()
+
+    def _path(self, path, *args, **params):
+        path = "/v{}{}".format(self.version, path.format(*[quote(a, safe="/:") for a in args]))
+        params = {k: v for k, v in params.items() if v is not None}
+        if params:
+            path += "?" + urlencode(params)
+        return path
+
+    async def _request(self, method, path, headers=None):
+        """
+        Perform a request, returning the connection and response. The
+        caller must read the body of the response and release the connection.
+        """
+        connection = await self.pool.acquire()
+        try:
+            response = await asyncio.wait_for(
+                connection.request(method, path, headers=headers), self.timeout
+            )
+        except Exception:
+            connection.close()
+            self.pool.release(connection)
+            raise
+        if response.status >= 400:
+            try:
+                content = await response.read()
+            finally:
+                self.pool.release(connection)
+            try:
+                explanation = json.loads(content.decode("utf-8")).get("message")
+            except ValueError:
+                explanation = content.decode("utf-8", "replace")
+            raise APIError(
+                "{} {}".format(response.status, response.reason),
+                response=response.to_requests_response(content),
+                explanation=explanation,
+            )
+        return connection, response
+
+    async def _json(self, method, path):
+        connection, response = await self._request(method, path)
+        try:
+            content = await asyncio.wait_for(response.read(), self.timeout)
+        except Exception:
+            connection.close()
+            raise
+        finally:
+            self.pool.release(connection)
+        return json.loads(content.decode("utf-8")) if content else None
+
+    async def inspect_image(self, image):
+        return await self._json("GET", self._path("/images/{}/json", image))
+
+    async def images(self, all=False):
+        return await self._json("GET", self._path("/images/json", all=int(all)))
+
+    async def containers(self, all=False):
+        return await self._json("GET", self._path("/containers/json", all=int(all)))
+
+    async def remove_image(self, image, force=False, noprune=False):
+        return await self._json("DELETE", self._path(
+            "/images/{}", image, force=int(force), noprune=int(noprune)
+        ))
+
+    async def pull(self, repository, tag=None):
+        """
+        Pull an image, yielding the raw chunks of the progress stream.
+        """
+        if not tag:
+            repository, tag = parse_repository_tag(repository)
+        registry, _ = auth.resolve_repository_name(repository)
+        headers = {}
+        authconfig = auth.resolve_authconfig(self._auth_configs, registry)
+        if authconfig:
+            headers["X-Registry-Auth"] = auth.encode_header(authconfig).decode("ascii")
+
+        connection, response = await self._request(
+            "POST", self._path("/images/create", fromImage=repository, tag=tag), headers
+        )
+        try:
+            async for chunk in response.iter_chunks():
+                yield chunk
+        except BaseException:
+            connection.close()
+            raise
+        finally:
+            self.pool.release(connection)
+
+    def close(self):
+        self.pool.close()
+
+
+class AsyncioClient(object):
+    """
+    A drop-in replacement for the parts of `docker.Client` used by the
+    updater, backed by `AsyncDockerAPI`.
+
+    Methods may be called from any number of threads. The requests
+    themselves are all performed by a single event loop running in a
+    background thread, but each call blocks its calling thread until
+    it completes.
+    """
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, version=DEFAULT_DOCKER_API_VERSION,
+                 timeout=DEFAULT_TIMEOUT_SECONDS, pool_size=DEFAULT_POOL_SIZE):
+        """
+        :param base_url:
+            The address of the daemon, as `unix:///path/to/socket` or
+            `tcp://host:port`.
+        :param version:
+            The Docker API version to use.
+        :param timeout:
+            Timeout in seconds for API calls, except for the streaming
+            part of pulls.
+        :param pool_size:
+            The maximum number of connections to the daemon.
+        """
+        if version == "auto":
+            version = DEFAULT_DOCKER_API_VERSION
+        self.api = AsyncDockerAPI(base_url, version, timeout, pool_size)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="docker-asyncio")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def inspect_image(self, image):
+        return self._call(self.api.inspect_image(image))
+
+    def images(self, all=False):
+        return self._call(self.api.images(all=all))
+
+    def containers(self, all=False):
+        return self._call(self.api.containers(all=all))
+
+    def remove_image(self, image, force=False, noprune=False):
+        return self._call(self.api.remove_image(image, force=force, noprune=noprune))
+
+    def pull(self, repository, tag=None, stream=False):
+        """
+        Pull an image. With `stream`, returns a `PullStream` iterating over
+        the raw chunks of the progress stream as they arrive.
+        """
+        chunks = PullStream(self, repository, tag)
+        if stream:
+            return chunks
+        return b"".join(chunks).decode("utf-8")
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.api.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class PullStream(object):
+    """
+    Iterates over the raw chunks of a pull's progress stream, as returned
+    by `AsyncioClient.pull(stream=True)`.
+
+    At most `PULL_BUFFER_SIZE` chunks are read ahead of the consumer.
+    Closing the stream cancels the pull and returns its connection to the
+    pool.
+    """
+    _future = None
+
+    def __init__(self, client, repository, tag):
+        async def new_queue():
+            # Created on the loop, as queues bind to the loop they are used in
+            return asyncio.Queue(maxsize=PULL_BUFFER_SIZE)
+
+        self._client = client
+        self._queue = client._call(new_queue())
+        self._finished = False
+        self._future = asyncio.run_coroutine_threadsafe(
+            self._produce(client.api.pull(repository, tag)), client.loop
+        )
+
+    async def _produce(self, chunks):
+        try:
+            async for chunk in chunks:
+                await self._queue.put(chunk)
+            await self._queue.put(_END_OF_STREAM)
+        except asyncio.CancelledError:
+            # Wakes up a consumer waiting for the next chunk
+            while self._queue.full():
+                self._queue.get_nowait()
+            self._queue.put_nowait(ConnectionError("Pull aborted"))
+            raise
+        except BaseException as e:
+            await self._queue.put(e)
+        finally:
+            # Closes the connection when the pull was abandoned
+            await chunks.aclose()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item = self._client._call(self._queue.get())
+        if item is _END_OF_STREAM or isinstance(item, BaseException):
+            self._finished = True
+            self.close()
+            if item is _END_OF_STREAM:
+                raise StopIteration
+            raise item
+        return item
+
+    def close(self):
+        """
+        Cancel the pull, if it's still in progress. Safe to call from any
+        thread, also while another thread waits for the next chunk.
+        """
+        self._future.cancel()
+
+    abort = close
+
+    def __del__(self):
+        # Like a generator, an abandoned stream is closed once collected
+        if self._future is not None and not self._future.done():
+            try:
+                self.close()
+            except RuntimeError:
+                pass  # The client, and its loop, were closed already
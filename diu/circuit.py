@@ -0,0 +1,156 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import logging
+import re
+import threading
+import time
+
+from diu.progress import PullError, PullTimeout
+from diu.registry import RegistryError
+
+# Matches errors in the pull stream of the Docker daemon when a registry
+# can't be reached or fails to respond, as opposed to errors about a
+# single image.
+UNAVAILABLE = re.compile(
+    r"connection refused|no such host|i/o timeout|tls handshake timeout|"
+    r"context deadline exceeded|request canceled|connection reset|"
+    r"service unavailable|bad gateway|gateway time-?out|\b50[234]\b",
+    re.IGNORECASE,
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of contacting a registry which recently kept failing.
+    """
+
+
+def is_registry_error(error):
+    """
+    Check whether an exception was raised while talking to a registry,
+    directly or through a pull. Errors of the Docker daemon itself, such as
+    failing to connect to it or to inspect an image, say nothing about the
+    registry.
+    """
+    return isinstance(error, (RegistryError, PullError))
+
+
+def is_unavailable(error):
+    """
+    Check whether an exception indicates the registry itself is broken,
+    rather than a problem with a single image or with the Docker daemon.
+    """
+    if isinstance(error, PullTimeout):
+        return True
+    if isinstance(error, RegistryError):
+        return "failed with HTTP status 4" not in str(error)
+    return isinstance(error, PullError) and UNAVAILABLE.search(str(error)) is not None
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the failures of a single registry.
+
+    After `threshold` consecutive failures the circuit opens, and images
+    from the registry fail immediately. Once `reset_timeout` seconds have
+    passed, a single image is let through to probe the registry: its
+    success closes the circuit again, its failure keeps it open for
+    another `reset_timeout` seconds.
+    """
+
+    def __init__(self, registry, threshold=3, reset_timeout=300, clock=time.time):
+        self.registry = registry
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.state = CLOSED
+        self.failures = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Check whether the registry may be contacted, moving an open circuit
+        to half-open once `reset_timeout` has passed.
+
+        :raises CircuitOpenError:
+            When the circuit is open, or half-open with a probe in progress.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and self.clock() - self._opened >= self.reset_timeout:
+                self.logger.info("Probing registry {}".format(self.registry))
+                self.state = HALF_OPEN
+                return
+        raise CircuitOpenError("Registry {} failed {} times in a row, skipping".format(
+            self.registry, self.failures))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                self.logger.info("Registry {} recovered".format(self.registry))
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_skipped(self):
+        """
+        Record that an image let through didn't reach the registry, so its
+        outcome says nothing about it. A half-open circuit lets the next
+        image through to probe the registry instead.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self.failures >= self.threshold):
+                self.logger.error(
+                    "Registry {} failed {} times in a row, failing its images for {}s".format(
+                        self.registry, self.failures, self.reset_timeout)
+                )
+                self.state = OPEN
+                self._opened = self.clock()
+
+
+class CircuitBreakers(object):
+    """
+    The circuit breakers of all registries.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=300, clock=time.time):
+        """
+        :param threshold:
+            The number of consecutive failures after which a registry's
+            circuit opens. Circuits never open when 0.
+        :param reset_timeout:
+            The number of seconds after which an open circuit lets a single
+            image through again.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._breakers = {}  # Maps registry names to their CircuitBreaker
+
+    def for_registry(self, registry):
+        """
+        Return the `CircuitBreaker` of the given registry, or None when
+        circuit breaking is disabled.
+        """
+        if not self.threshold:
+            return None
+        with self._lock:
+            breaker = self._breakers.get(registry)
+            if breaker is None:
+                breaker = self._breakers[registry] = CircuitBreaker(
+                    registry, self.threshold, self.reset_timeout, self.clock
+                )
+            return breaker
@@ -0,0 +1,136 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from diu.metrics import Metrics
+from diu.progress import format_bytes
+
+
+def unique_size(image):
+    """
+    The size of the layers only the given image uses, which is what
+    removing it frees.
+
+    The daemon reports `SharedSize` as -1 (or not at all) when it didn't
+    compute it, in which case the image's full `Size` is used instead.
+
+    :param image:
+        An image as returned by the Docker API's image list.
+    :returns:
+        The size in bytes.
+    """
+    size = image.get('VirtualSize', image.get('Size')) or 0
+    shared = image.get('SharedSize')
+    if shared is None or shared < 0:
+        return image.get('Size') or 0
+    return max(0, size - shared)
+
+
+@attr.s
+class CollectionResult(object):
+    """
+    The outcome of removing superseded images.
+
+    :param removed:
+        The IDs of the removed images.
+    :param in_use:
+        The IDs of images which were kept because containers use them.
+    :param tagged:
+        The IDs of images which were kept because they are still tagged
+        under another name.
+    :param failed:
+        The IDs of images which couldn't be removed.
+    :param reclaimed:
+        The bytes freed by removing the images, not counting layers they
+        shared with other images.
+    """
+    removed = attr.ib(default=attr.Factory(list))
+    in_use = attr.ib(default=attr.Factory(list))
+    tagged = attr.ib(default=attr.Factory(list))
+    failed = attr.ib(default=attr.Factory(list))
+    reclaimed = attr.ib(default=0)
+
+
+class ImageCollector(object):
+    """
+    Removes images which were replaced by a newer version during a run.
+    """
+
+    def __init__(self, client, concurrency=4, metrics=None, logger=None):
+        """
+        :param client:
+            The Docker client to use (a docker.Client instance)
+        :param concurrency:
+            The maximum number of images to remove in parallel.
+        :param metrics:
+            The `diu.metrics.Metrics` instance to record metrics in.
+        :param logger:
+            The logger to use, defaults to one named after this class.
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+
+    def _remove(self, image_id, result):
+        from docker.errors import APIError
+        try:
+            self.client.remove_image(image_id)
+        except APIError as e:
+            self.logger.warning("Unable to remove image {}: {!s}".format(image_id, e))
+            with self._lock:
+                result.failed.append(image_id)
+            return False
+        self.logger.debug("Removed image {}".format(image_id))
+        return True
+
+    def collect(self, image_ids, keep=()):
+        """
+        Remove the given images, unless a container (running or not) still
+        uses them or they are still tagged.
+
+        All containers and images are listed once up front, rather than
+        looking up every image on its own.
+
+        :param image_ids:
+            The IDs of the superseded images.
+        :param keep:
+            IDs which must not be removed, such as the current IDs of the
+            watched images.
+        :returns:
+            A `CollectionResult` instance.
+        """
+        result = CollectionResult()
+        candidates = set(image_ids) - set(keep)
+        if not candidates:
+            return result
+
+        in_use = set(c.get('ImageID') for c in self.client.containers(all=True))
+        images = dict((i['Id'], i) for i in self.client.images())
+        removable = []
+        for image_id in sorted(candidates):
+            if image_id not in images:
+                continue  # Already removed
+            if image_id in in_use:
+                result.in_use.append(image_id)
+            elif set(images[image_id].get('RepoTags') or []) - {'<none>:<none>'}:
+                result.tagged.append(image_id)
+            else:
+                removable.append(image_id)
+        if result.in_use:
+            self.logger.info("Keeping {} superseded images still used by containers".format(
+                len(result.in_use)))
+
+        if removable:
+            with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+                removed = list(executor.map(lambda i: self._remove(i, result), removable))
+            result.removed = [i for i, ok in zip(removable, removed) if ok]
+            result.reclaimed = sum(unique_size(images[i]) for i in result.removed)
+            result.failed.sort()
+            self.logger.info("Removed {} superseded images, reclaiming {}".format(
+                len(result.removed), format_bytes(result.reclaimed)))
+        self.metrics.inc('diu_images_removed_total', len(result.removed))
+        self.metrics.inc('diu_reclaimed_bytes_total', result.reclaimed)
+        return result
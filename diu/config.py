@@ -0,0 +1,236 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import fnmatch
+import glob
+import logging
+import os
+import re
+
+from diu.merge import Merger
+
+# Extensions of the files loaded from a directory
+EXTENSIONS = ('.yml', '.yaml')
+
+_MAGIC = re.compile(r'[*?[]')
+
+
+class ConfigurationError(Exception):
+    """
+    Raised when the configuration can't be loaded.
+    """
+
+
+def is_glob(pattern):
+    return _MAGIC.search(pattern) is not None
+
+
+def expand_paths(patterns):
+    """
+    Expand configuration file arguments into a list of files.
+
+    Directories expand to the `.yml` and `.yaml` files they contain and glob
+    patterns to the files they match, both in alphabetical order. Other
+    arguments are taken to be files, whether they exist or not. Files are
+    only listed once, at their first position.
+    """
+    files = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(
+                os.path.join(pattern, name) for name in os.listdir(pattern)
+                if name.endswith(EXTENSIONS)
+            )
+        elif is_glob(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        for f in matches:
+            if f not in seen:
+                seen.add(f)
+                files.append(f)
+    return files
+
+
+def matches_patterns(path, patterns):
+    """
+    Check whether `path` is (or would be) one of the files `patterns`
+    expand to.
+    """
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            if (os.path.dirname(os.path.normpath(path)) == os.path.normpath(pattern) and
+                    path.endswith(EXTENSIONS)):
+                return True
+        elif is_glob(pattern):
+            if fnmatch.fnmatch(path, pattern):
+                return True
+        elif path == pattern:
+            return True
+    return False
+
+
+def file_signature(path):
+    """
+    Return the modification time, size and inode of a file, or None when
+    it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+@attr.s
+class ConfigFile(object):
+    """
+    A parsed configuration file.
+
+    :param path:
+        The path of the file.
+    :param signature:
+        The modification time, size and inode of the file when it was parsed.
+    :param config:
+        The `config` section of the file.
+    :param watch:
+        The `watch` section of the file.
+    """
+    path = attr.ib()
+    signature = attr.ib()
+    config = attr.ib(default=attr.Factory(dict))
+    watch = attr.ib(default=attr.Factory(dict))
+
+
+class ConfigLoader(object):
+    """
+    Loads and merges configuration files, keeping the result around so
+    that loading the same files again only reparses the files which
+    changed, and only rebuilds the watch sets they define.
+    """
+
+    def __init__(self, build_set):
+        """
+        :param build_set:
+            A function taking the name of a watch set and its merged
+            configuration, returning the `ContainerSet` to use for it. It
+            should raise ValueError when the configuration is invalid.
+        """
+        self.build_set = build_set
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.loaded = False
+        self.changed_files = []  # Files which changed during the last load
+        self.changed_sets = set()  # Sets which were rebuilt during the last load
+        self._files = {}  # Maps paths to ConfigFile instances
+        self._config = {}
+        self._sets = {}  # Maps set names to ContainerSet instances
+
+    def _parse(self, path, signature):
+        # PyYAML is imported here rather than at the top, so runs using
+        # the configuration cache don't need to import it at all.
+        import yaml
+        try:
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+        try:
+            with open(path) as f:
+                data = yaml.load(f, Loader=SafeLoader)
+        except (IOError, yaml.parser.ParserError) as e:
+            raise ConfigurationError("Error loading {f}: {e!s}".format(f=path, e=e))
+        try:
+            data = Merger().merge({'config': {}, 'watch': {}}, data)
+        except ValueError as e:
+            raise ConfigurationError(
+                "You have an error in the configuration file {f}: {e!s}".format(f=path, e=e)
+            )
+        return ConfigFile(path, signature, config=data['config'], watch=data['watch'])
+
+    def load(self, patterns):
+        """
+        Load the configuration from the given files.
+
+        :param patterns:
+            Files, directories or glob patterns, see `expand_paths()`.
+        :returns:
+            A `(config, containerset)` tuple, with the merged `config`
+            section and a list of `ContainerSet` instances.
+        :raises ConfigurationError:
+            When a file can't be loaded or contains an invalid configuration.
+            The previously loaded configuration is left untouched in that case.
+        """
+        paths = expand_paths(patterns)
+        files = []
+        changed = []
+        for path in paths:
+            signature = file_signature(path)
+            f = self._files.get(path)
+            if f is None or signature is None or f.signature != signature:
+                f = self._parse(path, signature)
+                changed.append(path)
+            files.append(f)
+        new_files = dict((f.path, f) for f in files)
+        removed = [path for path in self._files if path not in new_files]
+
+        # Maps set names to the files defining them, in order
+        definitions = {}
+        order = []
+        for f in files:
+            for name in f.watch:
+                if name not in definitions:
+                    definitions[name] = []
+                    order.append(name)
+                definitions[name].append(f)
+
+        # Sets and sections which may differ from what was loaded before
+        if self.loaded:
+            affected = set()
+            config_changed = False
+            for path in changed + removed:
+                for f in (self._files.get(path), new_files.get(path)):
+                    if f is not None:
+                        affected.update(f.watch)
+                        config_changed = config_changed or bool(f.config)
+        else:
+            affected = set(order)
+            config_changed = True
+
+        merger = Merger()
+        config = self._config
+        if config_changed:
+            config = {}
+            for f in files:
+                try:
+                    config = merger.merge(config, f.config)
+                except ValueError as e:
+                    raise ConfigurationError(
+                        "You have an error in the configuration file {f}: {e!s}".format(
+                            f=f.path, e=e)
+                    )
+
+        sets = dict(self._sets)
+        for name in affected:
+            if name not in definitions:
+                sets.pop(name, None)
+                continue
+            value = definitions[name][0].watch[name]
+            try:
+                for f in definitions[name][1:]:
+                    value = merger.merge(value, f.watch[name])
+                sets[name] = self.build_set(name, value)
+            except ValueError as e:
+                raise ConfigurationError(
+                    "You have an error in watch set {name} (defined in {files}): {e!s}".format(
+                        name=name, files=", ".join(f.path for f in definitions[name]), e=e)
+                )
+
+        if self.loaded and (changed or removed):
+            self.logger.info("{} configuration files changed, rebuilt {} sets".format(
+                len(changed) + len(removed), len(affected)))
+        self._files = new_files
+        self._config = config
+        self._sets = sets
+        self.loaded = True
+        self.changed_files = changed + removed
+        self.changed_sets = affected
+        return config, [sets[name] for name in order]
@@ -0,0 +1,89 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import hashlib
+import logging
+import os
+import pickle
+
+import diu
+
+# Bump when the structure of cached values changes
+CACHE_FORMAT = 1
+
+
+class ConfigCache(object):
+    """
+    A cache of parsed and validated configurations, stored in a single file.
+
+    Entries are keyed by the paths, modification times and content hashes
+    of the configuration files they were loaded from, so a cached entry is
+    only used while none of those files changed. Only the most recent
+    entry is kept.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:
+            Path to the cache file. Its directory is created when missing.
+        """
+        self.path = path
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def key(self, files):
+        """
+        Compute the cache key for the given configuration files.
+
+        :returns:
+            A tuple identifying the files and their contents, or None when
+            one of the files can't be read.
+        """
+        entries = []
+        for f in files:
+            try:
+                with open(f, 'rb') as fh:
+                    digest = hashlib.sha256(fh.read()).hexdigest()
+                mtime = os.stat(f).st_mtime
+            except (IOError, OSError):
+                return None
+            entries.append((os.path.abspath(f), mtime, digest))
+        return (CACHE_FORMAT, diu.__version__, tuple(entries))
+
+    def get(self, key):
+        """
+        Return the value cached for `key`, or None on a cache miss.
+        """
+        if key is None:
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                cached_key, value = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            self.logger.warning("Ignoring unreadable configuration cache {}: {!s}".format(
+                self.path, e))
+            return None
+        if cached_key != key:
+            return None
+        self.logger.debug("Loaded configuration from cache {}".format(self.path))
+        return value
+
+    def put(self, key, value):
+        """
+        Store `value` under `key`, replacing the previous entry. The file is
+        replaced atomically and is only readable by the current user.
+        Failures to write the cache are logged and otherwise ignored.
+        """
+        if key is None:
+            return
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            self.logger.warning("Unable to write configuration cache {}: {!s}".format(
+                self.path, e))
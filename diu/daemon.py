@@ -0,0 +1,307 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import heapq
+import logging
+import random
+import signal
+import threading
+import time
+from diu.filewatch import create_file_watcher
+from diu.metrics import MetricsServer
+from diu.webhook import WebhookServer, build_image_index, build_pattern_index, matching_sets
+
+DEFAULT_INTERVAL = 300
+DEFAULT_DEBOUNCE = 5
+
+
+def parse_address(listen):
+    """
+    Parse a `host:port` string into a `(host, port)` tuple. The host
+    defaults to all interfaces when omitted.
+    """
+    host, _, port = listen.rpartition(':')
+    return (host or '0.0.0.0', int(port))
+
+
+class Scheduler(object):
+    """
+    Keeps track of when each watch set is next due to be checked.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        :param clock:
+            A function returning the current time in seconds.
+        """
+        self.clock = clock
+        self._due = {}  # Maps set names to the time they're due
+        self._heap = []  # (due time, set name), may contain stale entries
+
+    def schedule(self, name, delay):
+        """
+        Schedule the given set to be checked after `delay` seconds,
+        replacing any time it was scheduled at before.
+        """
+        due = self.clock() + delay
+        self._due[name] = due
+        heapq.heappush(self._heap, (due, name))
+
+    def expedite(self, name, delay):
+        """
+        Schedule the given set to be checked after at most `delay` seconds.
+        Leaves the set untouched when it is already due sooner than that.
+        """
+        due = self._due.get(name)
+        if due is None or due > self.clock() + delay:
+            self.schedule(name, delay)
+
+    def unschedule(self, name):
+        """
+        Stop checking the given set.
+        """
+        self._due.pop(name, None)
+
+    def names(self):
+        """
+        Return the names of all scheduled sets.
+        """
+        return set(self._due)
+
+    def next_due(self):
+        """
+        Return the time at which the next set is due, or None when nothing
+        is scheduled.
+        """
+        while self._heap:
+            due, name = self._heap[0]
+            if self._due.get(name) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self):
+        """
+        Remove and return the names of all sets which are currently due,
+        in the order in which they became due.
+        """
+        now = self.clock()
+        names = []
+        while self._heap and self._heap[0][0] <= now:
+            due, name = heapq.heappop(self._heap)
+            if self._due.get(name) == due:
+                del self._due[name]
+                names.append(name)
+        return names
+
+
+class Daemon(object):
+    """
+    Runs the updater continuously, checking every watch set at its own
+    interval until asked to stop.
+
+    SIGTERM and SIGINT stop the daemon once the check in progress (if any)
+    has finished. SIGHUP reloads the configuration files.
+
+    When `config.webhook` is configured, registry push notifications
+    trigger a check of the sets listing the pushed image.
+
+    Unless `config.daemon.watch_config` is disabled, changes to the
+    configuration files are picked up as if SIGHUP was received.
+    """
+
+    def __init__(self, app):
+        """
+        :param app:
+            The `diu.main.Application` instance to run.
+        """
+        self.app = app
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.scheduler = Scheduler()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._reloading = False
+        self._index = ({}, {})  # See build_image_index() and build_pattern_index()
+        self._triggered = set()  # Names of sets triggered by push notifications
+        self._lock = threading.Lock()
+        self.webhook = None
+        self.metrics_server = None
+        self.file_watcher = None
+
+    @property
+    def interval(self):
+        """
+        The default number of seconds between checks of a set.
+        """
+        return self.app.config.get('daemon', {}).get('interval', DEFAULT_INTERVAL)
+
+    @property
+    def jitter(self):
+        """
+        The maximum number of seconds randomly added to each interval.
+        """
+        return self.app.config.get('daemon', {}).get('jitter', 0)
+
+    def _delay(self, watcher):
+        """
+        Return the number of seconds until the next check of a set.
+        """
+        interval = watcher.interval or self.interval
+        return interval + random.uniform(0, self.jitter)
+
+    def _sync_schedule(self):
+        """
+        Bring the schedule in line with the currently configured sets.
+
+        Sets which are new are scheduled after a random delay of up to
+        `jitter` seconds, so they don't all start at once.
+        """
+        configured = set(self.app.updater.containerset)
+        sets = list(self.app.updater.containerset.values())
+        self._index = (build_image_index(sets), build_pattern_index(sets))
+        for name in self.scheduler.names() - configured:
+            self.scheduler.unschedule(name)
+        for name in configured - self.scheduler.names():
+            self.scheduler.schedule(name, random.uniform(0, self.jitter))
+
+    def trigger(self, pushed):
+        """
+        Check the sets listing any of the given images soon. Safe to call
+        from any thread.
+
+        Sets are checked `config.webhook.debounce` seconds after the first
+        notification mentioning them, so a burst of notifications results
+        in a single check.
+
+        :param pushed:
+            A list of `(repository, tag)` tuples.
+        """
+        index, patterns = self._index
+        names = matching_sets(pushed, index, patterns)
+        if not names:
+            self.logger.info("Push notification doesn't match any watched image")
+            return
+        with self._lock:
+            self._triggered.update(names)
+        self._wakeup.set()
+
+    def _schedule_triggered(self):
+        """
+        Move sets triggered by push notifications onto the schedule.
+        """
+        with self._lock:
+            triggered, self._triggered = self._triggered, set()
+        debounce = self.app.config.get('webhook', {}).get('debounce', DEFAULT_DEBOUNCE)
+        for name in triggered:
+            if name in self.app.updater.containerset:
+                self.scheduler.expedite(name, debounce)
+
+    def _start_webhook(self):
+        """
+        Start listening for push notifications, if configured.
+        """
+        config = self.app.config.get('webhook')
+        if not config:
+            return
+        self.webhook = WebhookServer(
+            parse_address(config.get('listen', '0.0.0.0:8080')),
+            self.trigger,
+            token=config.get('token'),
+        )
+        self.webhook.start()
+
+    def _start_metrics_server(self):
+        """
+        Start serving metrics over HTTP, if configured.
+        """
+        listen = self.app.config.get('metrics', {}).get('listen')
+        if listen is None:
+            return
+        self.metrics_server = MetricsServer(parse_address(listen), self.app.metrics)
+        self.metrics_server.start()
+
+    def _start_file_watcher(self):
+        """
+        Start watching the configuration files for changes, if enabled.
+        """
+        if not self.app.config.get('daemon', {}).get('watch_config', True):
+            return
+        self.file_watcher = create_file_watcher(self.app.config_files, self.reload)
+        self.file_watcher.start()
+
+    def stop(self, *args):
+        """
+        Ask the daemon to stop. Safe to call from a signal handler.
+        """
+        self._stopping = True
+        self._wakeup.set()
+
+    def reload(self, *args):
+        """
+        Ask the daemon to reload its configuration. Safe to call from a
+        signal handler.
+        """
+        self._reloading = True
+        self._wakeup.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+
+    def run_once(self):
+        """
+        Check all sets which are currently due and schedule their next check.
+        """
+        if self._reloading:
+            self._reloading = False
+            self.app.reload()
+            self._sync_schedule()
+        self._schedule_triggered()
+
+        names = self.scheduler.pop_due()
+        if not names:
+            return
+
+        updater = self.app.updater
+        errors_before = updater.error_count
+        self.logger.info("Checking sets: {}".format(", ".join(names)))
+        try:
+            updater.do_updates(names)
+        except Exception:
+            self.logger.exception("Unexpected exception during update")
+        if updater.error_count > errors_before:
+            self.logger.error("{} errors occurred during this check".format(
+                updater.error_count - errors_before
+            ))
+        for name in names:
+            self.scheduler.schedule(name, self._delay(updater.containerset[name]))
+        self.app.write_metrics()
+
+    def run(self):
+        """
+        Run until stopped.
+        """
+        self.install_signal_handlers()
+        self._sync_schedule()
+        self._start_webhook()
+        self._start_metrics_server()
+        self._start_file_watcher()
+        self.logger.info("Daemon started, watching {} sets".format(
+            len(self.scheduler.names())
+        ))
+        try:
+            while not self._stopping:
+                self._wakeup.clear()
+                self.run_once()
+                if self._stopping or self._reloading or self._triggered:
+                    continue
+                due = self.scheduler.next_due()
+                timeout = None if due is None else max(0, due - self.scheduler.clock())
+                self._wakeup.wait(timeout)
+        finally:
+            if self.webhook is not None:
+                self.webhook.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            if self.file_watcher is not None:
+                self.file_watcher.stop()
+        self.logger.info("Daemon stopped")
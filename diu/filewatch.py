@@ -0,0 +1,220 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+from diu.config import expand_paths, is_glob, matches_patterns, file_signature
+
+# Events which signal a file was written, replaced or removed
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+_EVENT = struct.Struct(str('iIII'))  # wd, mask, cookie, len
+
+
+def _load_libc():
+    """
+    Return the C library when it provides inotify, None otherwise.
+    """
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _directories(patterns):
+    """
+    Return the directories containing the files `patterns` expand to,
+    mapped to the prefixes under which their files appear in the patterns.
+    """
+    directories = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            prefixes = [pattern]
+        elif is_glob(os.path.dirname(pattern)):
+            prefixes = set(os.path.dirname(f) for f in expand_paths([pattern]))
+        else:
+            prefixes = [os.path.dirname(pattern)]
+        for prefix in prefixes:
+            directories.setdefault(os.path.realpath(prefix or '.'), set()).add(prefix)
+    return directories
+
+
+class FileWatcher(object):
+    """
+    Calls a function whenever configuration files are written, created,
+    renamed or removed, based on inotify.
+
+    Events arriving within `delay` seconds of each other result in a
+    single call, so a tool replacing many files at once causes a single
+    reload.
+    """
+
+    def __init__(self, patterns, callback, delay=0.5):
+        """
+        :param patterns:
+            Files, directories or glob patterns, see
+            `diu.config.expand_paths()`.
+        :param callback:
+            The function to call, without arguments, from a background thread.
+        :param delay:
+            The number of seconds to wait for more events before calling
+            `callback`.
+        """
+        self.patterns = patterns
+        self.callback = callback
+        self.delay = delay
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.libc = _load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._prefixes = {}  # Maps watch descriptors to path prefixes
+        for directory, prefixes in _directories(patterns).items():
+            path = directory.encode(sys.getfilesystemencoding())
+            wd = self.libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+            if wd < 0:
+                self.logger.warning("Unable to watch {} for changes".format(directory))
+                continue
+            self._prefixes.setdefault(wd, set()).update(prefixes)
+        self._stop_r, self._stop_w = os.pipe()
+        self.thread = None
+
+    def _matching_events(self, data):
+        """
+        Parse a buffer of inotify events, returning whether any of them
+        concerns a configuration file.
+        """
+        matched = False
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            name = name.decode(sys.getfilesystemencoding())
+            for prefix in self._prefixes.get(wd, ()):
+                if matches_patterns(os.path.join(prefix, name), self.patterns):
+                    self.logger.debug("{} changed".format(os.path.join(prefix, name)))
+                    matched = True
+        return matched
+
+    def _run(self):
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0, deadline - time.time())
+                readable, _, _ = select.select([self._fd, self._stop_r], [], [], timeout)
+                if self._stop_r in readable:
+                    return
+                if self._fd in readable:
+                    if self._matching_events(os.read(self._fd, 65536)) and deadline is None:
+                        deadline = time.time() + self.delay
+                if deadline is not None and time.time() >= deadline:
+                    deadline = None
+                    self.callback()
+        finally:
+            os.close(self._fd)
+            os.close(self._stop_r)
+
+    def start(self):
+        """
+        Start watching for changes in a background thread.
+        """
+        self.thread = threading.Thread(target=self._run, name="filewatch")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Watching {} directories for configuration changes".format(
+            len(self._prefixes)))
+
+    def stop(self):
+        """
+        Stop watching for changes.
+        """
+        os.write(self._stop_w, b"x")
+        self.thread.join()
+        os.close(self._stop_w)
+
+
+class PollingFileWatcher(object):
+    """
+    Calls a function whenever configuration files change, by periodically
+    comparing their modification times. Used where inotify isn't available.
+    """
+
+    def __init__(self, patterns, callback, interval=5):
+        """
+        :param patterns:
+            Files, directories or glob patterns, see
+            `diu.config.expand_paths()`.
+        :param callback:
+            The function to call, without arguments, from a background thread.
+        :param interval:
+            The number of seconds between checks.
+        """
+        self.patterns = patterns
+        self.callback = callback
+        self.interval = interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._stopping = threading.Event()
+        self._snapshot = self._take_snapshot()
+        self.thread = None
+
+    def _take_snapshot(self):
+        return dict((path, file_signature(path)) for path in expand_paths(self.patterns))
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            snapshot = self._take_snapshot()
+            if snapshot != self._snapshot:
+                self._snapshot = snapshot
+                self.callback()
+
+    def start(self):
+        """
+        Start watching for changes in a background thread.
+        """
+        self.thread = threading.Thread(target=self._run, name="filewatch")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Checking configuration files for changes every {}s".format(
+            self.interval))
+
+    def stop(self):
+        """
+        Stop watching for changes.
+        """
+        self._stopping.set()
+        self.thread.join()
+
+
+def create_file_watcher(patterns, callback):
+    """
+    Create a watcher for the given configuration files, using inotify when
+    available and falling back to polling otherwise.
+    """
+    try:
+        return FileWatcher(patterns, callback)
+    except OSError:
+        return PollingFileWatcher(patterns, callback)
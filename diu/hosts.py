@@ -0,0 +1,120 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+@attr.s
+class HostResult(object):
+    """
+    The outcome of the last run on a single Docker host.
+
+    :param host:
+        The name of the host.
+    :param updated:
+        The images which were updated.
+    :param errors:
+        The number of errors which occurred.
+    :param failed:
+        Whether the run was aborted by an unexpected exception.
+    """
+    host = attr.ib()
+    updated = attr.ib(default=attr.Factory(list))
+    errors = attr.ib(default=0)
+    failed = attr.ib(default=False)
+
+
+class MultiHostUpdater(object):
+    """
+    Updates several Docker hosts, each through an `Updater` of its own,
+    with at most `concurrency` hosts being updated at the same time.
+
+    Provides the same `containerset`, `error_count`, `do_updates()` and
+    `check_images()` as a single `Updater`, aggregated across hosts.
+    """
+
+    def __init__(self, updaters, concurrency=4):
+        """
+        :param updaters:
+            An `OrderedDict` mapping host names to `diu.updater.Updater`
+            instances.
+        :param concurrency:
+            The maximum number of hosts to update in parallel.
+        """
+        self.updaters = updaters
+        self.concurrency = concurrency
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.results = OrderedDict()  # Maps host names to their last HostResult
+        self._failures = 0  # Number of runs which failed unexpectedly
+
+    @property
+    def containerset(self):
+        containerset = {}
+        for updater in self.updaters.values():
+            for name, watcher in updater.containerset.items():
+                containerset.setdefault(name, watcher)
+        return containerset
+
+    @property
+    def error_count(self):
+        return self._failures + sum(u.error_count for u in self.updaters.values())
+
+    def _names(self, updater, names):
+        if names is None:
+            return list(updater.containerset)
+        return [name for name in names if name in updater.containerset]
+
+    def _update_host(self, host, updater, names):
+        errors_before = updater.error_count
+        result = HostResult(host=host)
+        if not names:
+            return result
+        try:
+            updater.do_updates(names)
+        except Exception:
+            self.logger.exception("Unexpected exception while updating host {}".format(host))
+            result.failed = True
+            result.errors += 1
+        result.updated = list(updater._updated)
+        result.errors += updater.error_count - errors_before
+        return result
+
+    def do_updates(self, names=None):
+        """
+        Update the watched images on every host.
+
+        :param names:
+            The names of the sets to update. All sets are updated when None.
+            Hosts are only updated for the sets assigned to them.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            futures = OrderedDict(
+                (host, executor.submit(self._update_host, host, updater,
+                                       self._names(updater, names)))
+                for host, updater in self.updaters.items()
+            )
+        for host, future in futures.items():
+            result = future.result()
+            self.results[host] = result
+            if result.failed:
+                self._failures += 1
+        for result in self.results.values():
+            log = self.logger.error if result.errors else self.logger.info
+            log("Host {}: {} images updated, {} errors".format(
+                result.host, len(result.updated), result.errors))
+
+    def check_images(self, names=None, concurrency=10):
+        """
+        Compare the images of every host with their registries, see
+        `diu.updater.Updater.check_images()`.
+
+        :returns:
+            A list of `ImageCheck` instances, grouped by host.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            futures = [
+                executor.submit(updater.check_images, self._names(updater, names), concurrency)
+                for updater in self.updaters.values()
+            ]
+        return [check for future in futures for check in future.result()]
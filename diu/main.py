@@ -1,18 +1,51 @@
 from __future__ import print_function, absolute_import, unicode_literals, division
 
 import argparse
+import json
 import sys
 import logging
-import yaml
+import time
+from collections import OrderedDict
 
-from diu.merge import merge
+from diu.circuit import CircuitBreakers
+from diu.config import ConfigLoader, ConfigurationError, expand_paths
+from diu.configcache import ConfigCache
+from diu.hosts import MultiHostUpdater
+from diu.metrics import Metrics
+from diu.ratelimit import RateLimits
+from diu.recreate import uses_recreate
+from diu.registry import DEFAULT_PLATFORM, DEFAULT_TAG_PAGE_SIZE, RegistryClient, TagCache
+from diu.state import StateStore, state_key
+from diu.tags import TagResolver, is_tag_pattern, parse_tag_pattern
+from diu.trace import NullTracer, ThreadProfiler, Tracer
 from diu.updater import ContainerSet, Updater
-from docker import Client as DockerClient
 
-try:
-    from colorlog import ColoredFormatter
-except ImportError:
-    ColoredFormatter = None
+
+# Exit status of --check when images are out of date
+EXIT_UPDATES_AVAILABLE = 100
+
+# Name of the `config.docker` daemon when sets list other hosts
+DEFAULT_HOST = 'default'
+
+
+def DockerClient(*args, **kwargs):
+    """
+    Create a docker-py client. docker-py is only imported when the first
+    client is created, as importing it takes longer than everything else
+    done by a run with nothing to do.
+    """
+    from docker import Client
+    return Client(*args, **kwargs)
+
+
+def _log_to_stderr():
+    """
+    Move console logging from stdout to stderr, keeping stdout free for
+    machine-readable output.
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+            handler.stream = sys.stderr
 
 
 class Application(object):
@@ -30,6 +63,9 @@ class Application(object):
         self.args = self.parser.parse_args(args=args)
         if self.args.debug:
             logging.getLogger().setLevel(logging.DEBUG)
+        if self.args.check:
+            _log_to_stderr()
+        self.tracer = Tracer() if self.args.trace is not None else NullTracer()
 
         self.containerset = []
 
@@ -38,12 +74,55 @@ class Application(object):
                 "--file is deprecated, please migrate to using positional"
                 " arguments instead"
             )
-            self._load_config(self.args.deprecated_file)
+            self.config_files = (self.args.deprecated_file,)
         else:
-            self._load_config(*self.args.file)
+            self.config_files = tuple(self.args.file)
+
+        self.config_loader = ConfigLoader(self._build_containerset)
+        self.config_cache = None
+        if self.args.config_cache is not None:
+            self.config_cache = ConfigCache(self.args.config_cache)
 
-        d = DockerClient(**self.config.get('docker', {}))
-        self.updater = Updater(d, self.containerset)
+        try:
+            self._load_config(*self.config_files)
+        except ConfigurationError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+        self.state = self._create_state_store()
+        self.metrics = Metrics()
+        self.clients = {}  # Maps host names to (configuration, client) tuples
+        # The client and updater are created on first use, see below.
+        self._client = None
+        self._updater = None
+
+    @property
+    def client(self):
+        """
+        The client of the Docker daemon, created on first use.
+        """
+        if self._client is None:
+            with self.tracer.span("create client", "setup"):
+                self._client = self._create_docker_client()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def updater(self):
+        """
+        The updater for the current configuration, created on first use.
+        """
+        if self._updater is None:
+            with self.tracer.span("create updater", "setup"):
+                self._updater = self._create_updater()
+        return self._updater
+
+    @updater.setter
+    def updater(self, updater):
+        self._updater = updater
 
     def _create_parser(self):
         """
@@ -65,52 +144,332 @@ class Application(object):
             action="store_true",
             help="show debug messages"
         )
+        parser.add_argument(
+            "--daemon",
+            action="store_true",
+            help="keep running, checking sets for updates at their configured intervals"
+        )
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="only report which images are out of date, as JSON, without pulling"
+        )
+        parser.add_argument(
+            "--config-cache",
+            metavar="FILE",
+            default=None,
+            help="cache the parsed configuration in FILE, to skip parsing unchanged files"
+        )
+        parser.add_argument(
+            "--trace",
+            metavar="FILE",
+            default=None,
+            help="record the time spent on each phase, set, image and command in FILE, "
+                 "in Chrome trace event format"
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="FILE",
+            default=None,
+            help="profile the run, including its worker threads, with cProfile and write "
+                 "the statistics to FILE"
+        )
         parser.add_argument(
             "file",
-            help="configuration file(s) to use",
+            help="configuration file(s), directories or glob patterns to use",
             nargs="*",
             default=("/etc/docker-image-updater.yml",),
         )
         return parser
 
+    def _create_updater(self):
+        """
+        Create the updater for the currently loaded configuration.
+
+        :returns:
+            An instance of `diu.updater.Updater`, or of
+            `diu.hosts.MultiHostUpdater` when more than one Docker host
+            is configured.
+        """
+        limits = self._create_rate_limits()
+        registry = self._create_registry_client(limits)
+        tags = self._create_tag_resolver(registry, limits)
+        breaker_config = self.config.get('registry', {}).get('breaker', {})
+        breakers = CircuitBreakers(
+            threshold=breaker_config.get('threshold', 3),
+            reset_timeout=breaker_config.get('reset_timeout', 300),
+        )
+        hosts = self._hosts()
+        if not hosts:
+            return self._create_host_updater(
+                self.client, self.containerset, registry, limits, breakers, tags
+            )
+
+        # Sets which don't list any hosts are updated on these
+        default_hosts = set(self.config.get('hosts', {})) or {DEFAULT_HOST}
+        clients = {}
+        updaters = OrderedDict()
+        for host, docker_config in hosts.items():
+            if host == DEFAULT_HOST and host not in self.config.get('hosts', {}):
+                client = self.client
+            else:
+                previous = self.clients.get(host)
+                if previous is not None and previous[0] == docker_config:
+                    clients[host] = previous
+                else:
+                    clients[host] = (docker_config, self._create_docker_client(docker_config))
+                client = clients[host][1]
+            containerset = [
+                w for w in self.containerset
+                if (host in default_hosts if w.hosts is None else host in w.hosts)
+            ]
+            updaters[host] = self._create_host_updater(
+                client, containerset, registry, limits, breakers, tags, host=host
+            )
+        self.clients = clients
+        return MultiHostUpdater(
+            updaters,
+            concurrency=self.config.get('concurrency', {}).get('hosts', 4),
+        )
+
+    def _create_host_updater(self, client, containerset, registry, limits, breakers, tags,
+                             host=None):
+        """
+        Create the updater for a single Docker host.
+
+        :returns:
+            An instance of `diu.updater.Updater`.
+        """
+        return Updater(
+            client,
+            containerset,
+            registry=registry,
+            concurrency=self.config.get('concurrency', {}).get('pulls', 1),
+            state=self.state,
+            state_ttl=self.config.get('state', {}).get('ttl', 0),
+            command_timeout=self.config.get('commands', {}).get('timeout'),
+            command_kill_after=self.config.get('commands', {}).get('kill_after', 10),
+            command_concurrency=self.config.get('concurrency', {}).get('commands', 1),
+            progress_interval=self.config.get('progress', {}).get('interval', 10),
+            metrics=self.metrics if host is None else self.metrics.bind(host=host),
+            tracer=self.tracer,
+            host=host,
+            share_layers=self.config.get('concurrency', {}).get('share_layers', False),
+            limits=limits,
+            breakers=breakers,
+            pull_timeout=self.config.get('pull', {}).get('timeout'),
+            stall_timeout=self.config.get('pull', {}).get('stall_timeout', 300),
+            collect_garbage=self.config.get('cleanup', {}).get('enabled', False),
+            gc_concurrency=self.config.get('cleanup', {}).get('concurrency', 4),
+            tags=tags,
+        )
+
+    def _hosts(self):
+        """
+        Return the Docker hosts to update, as configured in `config.hosts`
+        and in the `hosts` of individual sets.
+
+        :returns:
+            An `OrderedDict` mapping host names to the configuration of
+            their Docker client. Hosts which are only listed by sets are
+            named after their address. When `config.hosts` isn't set, the
+            `config.docker` daemon is included as `default`. Empty when no
+            hosts are configured.
+        """
+        defaults = self.config.get('docker', {})
+        hosts = OrderedDict()
+        for name, docker_config in sorted(self.config.get('hosts', {}).items()):
+            hosts[name] = dict(defaults, **docker_config)
+        listed = [name for watcher in self.containerset for name in watcher.hosts or ()]
+        if listed and not hosts and any(w.hosts is None for w in self.containerset):
+            # Sets which don't list any hosts stay on the `config.docker` daemon
+            hosts[DEFAULT_HOST] = dict(defaults)
+        for name in listed:
+            if name not in hosts:
+                hosts[name] = dict(defaults) if name == DEFAULT_HOST else \
+                    dict(defaults, base_url=name)
+        return hosts
+
+    def _create_docker_client(self, docker_config=None):
+        """
+        Create the client used to talk to the Docker daemon.
+
+        :param docker_config:
+            The configuration of the client, `config.docker` by default.
+        :returns:
+            An instance of `docker.Client`, or of `diu.aio.AsyncioClient`
+            when `config.docker.backend` is `asyncio`.
+        """
+        if docker_config is None:
+            docker_config = self.config.get('docker', {})
+        docker_config = dict(docker_config)
+        backend = docker_config.pop('backend', 'docker-py')
+        if backend == 'asyncio':
+            from diu.aio import AsyncioClient
+            return AsyncioClient(**docker_config)
+        docker_config.pop('pool_size', None)
+        return DockerClient(**docker_config)
+
+    def _create_state_store(self):
+        """
+        Open the store in which image states are kept across runs.
+
+        :returns:
+            An instance of `diu.state.StateStore`, or None when no state
+            path is configured.
+        """
+        path = self.config.get('state', {}).get('path')
+        if path is None:
+            return None
+        return StateStore(path)
+
+    def _create_rate_limits(self):
+        """
+        Create the limits applied to requests and pulls from each registry.
+
+        :returns:
+            An instance of `diu.ratelimit.RateLimits`.
+        """
+        registry_config = self.config.get('registry', {})
+        return RateLimits(
+            limits=registry_config.get('limits', {}),
+            retries=registry_config.get('retries', 3),
+            backoff=registry_config.get('backoff', 1),
+            max_backoff=registry_config.get('max_backoff', 60),
+        )
+
+    def _create_registry_client(self, limits=None, required=False):
+        """
+        Create the registry client used to check image digests before pulling.
+
+        :param required:
+            Create the client even when digest checking is not enabled.
+        :returns:
+            An instance of `diu.registry.RegistryClient`, or None when
+            digest checking is not enabled in the configuration (and not
+            running with `--check`).
+        """
+        registry_config = self.config.get('registry', {})
+        if not required and not registry_config.get('check_digest', False) \
+                and not self.args.check:
+            return None
+        return RegistryClient(
+            timeout=registry_config.get('timeout', 10),
+            insecure=registry_config.get('insecure', []),
+            platform=registry_config.get('platform', DEFAULT_PLATFORM),
+            limits=limits,
+            tag_cache=TagCache(store=self.state),
+            page_size=registry_config.get('tag_page_size', DEFAULT_TAG_PAGE_SIZE),
+        )
+
+    def _create_tag_resolver(self, registry, limits):
+        """
+        Create the resolver for images watched by tag pattern.
+
+        :param registry:
+            The registry client used to check image digests, if any. A
+            client is created when None.
+        :returns:
+            An instance of `diu.tags.TagResolver`, or None when no set
+            watches images by tag pattern.
+        """
+        if not any(is_tag_pattern(image) for w in self.containerset for image in w.images):
+            return None
+        if registry is None:
+            registry = self._create_registry_client(limits, required=True)
+        return TagResolver(registry)
+
     def _load_config(self, *files):
         """
         Load and parse the given configuration file.
 
+        Loading the same files again only reparses the files which changed
+        since, and only rebuilds the watch sets defined in those.
+
         :param files:
-            One or more sets of configuration files to load.
-        """
-        final_config = {'config': {}, 'watch': {}}
-        for f in files:
-            try:
-                data = yaml.safe_load(open(f))
-            except (IOError, yaml.parser.ParserError) as e:
-                print("Error loading {f}: {e!s}".format(f=f, e=e), file=sys.stderr)
-                sys.exit(1)
-            try:
-                final_config = merge(final_config, data)
-            except ValueError as e:
-                print(
-                    "You have an error in the configuration file {f}: {e!s}".format(f=f, e=e),
-                    file=sys.stderr
-                )
-                sys.exit(1)
-
-        self.config = final_config['config']
-        for key, value in final_config['watch'].items():
-            try:
-                self._validate_watch_configuration(value)
-            except ValueError as e:
-                print(
-                    "You have an error in the configuration file {f}: {e!s}".format(f=f, e=e),
-                    file=sys.stderr
+            One or more configuration files, directories or glob patterns
+            to load.
+        :raises ConfigurationError:
+            When a file can't be loaded or contains an invalid configuration.
+            The previously loaded configuration is left untouched in that case.
+        """
+        cache_key = None
+        if self.config_cache is not None:
+            cache_key = self.config_cache.key(expand_paths(files))
+            if not self.config_loader.loaded:
+                cached = self.config_cache.get(cache_key)
+                if cached is not None:
+                    self.config, self.containerset = cached
+                    return
+
+        with self.tracer.span("load config", "config", files=len(files)):
+            config, containerset = self.config_loader.load(files)
+        hosts = config.get('hosts', {})
+        if not isinstance(hosts, dict) or not all(isinstance(h, dict) for h in hosts.values()):
+            raise ConfigurationError(
+                "Key 'hosts' should map host names to Docker client configurations"
+            )
+        for docker_config in [config.get('docker', {})] + list(hosts.values()):
+            backend = docker_config.get('backend', 'docker-py')
+            if backend not in ('docker-py', 'asyncio'):
+                raise ConfigurationError(
+                    "Unknown Docker backend '{}', expected 'docker-py' or 'asyncio'".format(
+                        backend)
                 )
-                sys.exit(1)
-            self.containerset.append(ContainerSet(
-                name=key,
-                images=value.get('images', []),
-                commands=value.get('commands', []),
-            ))
+
+        backends = [c.get('backend', 'docker-py') for c in
+                    [config.get('docker', {})] + list(hosts.values())]
+        if 'asyncio' in backends and any(uses_recreate(w.commands) for w in containerset):
+            raise ConfigurationError(
+                "Recreating containers is not supported by the asyncio Docker backend"
+            )
+
+        self._validate_registry_limits(config.get('registry', {}).get('limits', {}))
+
+        self.config = config
+        self.containerset = containerset
+        if self.config_cache is not None:
+            self.config_cache.put(cache_key, (self.config, self.containerset))
+
+    def _validate_registry_limits(self, limits):
+        """
+        Validate the structure of 'registry.limits'.
+        """
+        if not isinstance(limits, dict) or \
+                not all(isinstance(limit, dict) for limit in limits.values()):
+            raise ConfigurationError(
+                "Key 'limits' should map registry names to their limits"
+            )
+        for registry, limit in limits.items():
+            unknown = set(limit) - {'concurrency', 'rate', 'burst'}
+            if unknown:
+                raise ConfigurationError("Unknown key '{}' in limits of registry {}".format(
+                    sorted(unknown)[0], registry))
+            for key, value in limit.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                    raise ConfigurationError(
+                        "Key '{}' in limits of registry {} should be a positive number".format(
+                            key, registry)
+                    )
+
+    def _build_containerset(self, name, watch):
+        """
+        Validate the merged configuration of a watch set and create it.
+
+        :returns:
+            An instance of `diu.updater.ContainerSet`.
+        :raises ValueError:
+            When the configuration is invalid.
+        """
+        self._validate_watch_configuration(watch)
+        return ContainerSet(
+            name=name,
+            images=watch.get('images', []),
+            commands=watch.get('commands', []),
+            interval=watch.get('interval'),
+            ttl=watch.get('ttl'),
+            hosts=watch.get('hosts'),
+        )
 
     def _validate_watch_configuration(self, watch):
         """
@@ -120,14 +479,245 @@ class Application(object):
             raise ValueError("Key 'watch' should be a dictionary")
         if not isinstance(watch.get('images', []), list):
             raise ValueError("Key 'images' should be of type list")
+        for image in watch.get('images', []):
+            if is_tag_pattern(image):
+                parse_tag_pattern(image.rsplit(":", 1)[1])
         if not isinstance(watch.get('commands', []), list):
             raise ValueError("Key 'commands' should be of type list")
+        for command in watch.get('commands', []):
+            self._validate_command(command)
+        interval = watch.get('interval')
+        if interval is not None and (not isinstance(interval, (int, float)) or interval <= 0):
+            raise ValueError("Key 'interval' should be a positive number")
+        ttl = watch.get('ttl')
+        if ttl is not None and (not isinstance(ttl, (int, float)) or ttl < 0):
+            raise ValueError("Key 'ttl' should be a non-negative number")
+        hosts = watch.get('hosts')
+        if hosts is not None and (not isinstance(hosts, list) or
+                                  any(isinstance(h, (dict, list)) for h in hosts)):
+            raise ValueError("Key 'hosts' should be a list of host names or addresses")
+
+    def _validate_command(self, command):
+        """
+        Validate the structure of an item in a 'commands' list.
+        """
+        if not isinstance(command, dict):
+            return
+        if 'parallel' in command:
+            if not isinstance(command['parallel'], list):
+                raise ValueError("Key 'parallel' should be of type list")
+            for c in command['parallel']:
+                self._validate_command(c)
+            return
+        if 'recreate' in command:
+            self._validate_recreate(command)
+            return
+        if 'run' not in command:
+            raise ValueError(
+                "Commands should be a string or contain a 'run', 'recreate' or 'parallel' key"
+            )
+        timeout = command.get('timeout')
+        if timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise ValueError("Key 'timeout' should be a positive number")
+        if not isinstance(command.get('dedupe', False), bool):
+            raise ValueError("Key 'dedupe' should be a boolean")
+
+    def _validate_recreate(self, command):
+        """
+        Validate the structure of a 'recreate' action.
+        """
+        if 'dedupe' in command or 'run' in command:
+            raise ValueError("Key 'recreate' can't be combined with 'run' or 'dedupe'")
+        options = command['recreate']
+        if options is True:
+            return
+        if not isinstance(options, dict):
+            raise ValueError("Key 'recreate' should be true or a dictionary")
+        unknown = set(options) - {
+            'containers', 'concurrency', 'stop_timeout', 'wait_healthy', 'health_timeout'
+        }
+        if unknown:
+            raise ValueError("Unknown key '{}' in 'recreate'".format(sorted(unknown)[0]))
+        containers = options.get('containers', [])
+        if not isinstance(containers, list) or any(isinstance(c, (dict, list))
+                                                   for c in containers):
+            raise ValueError("Key 'containers' should be a list of container names")
+        concurrency = options.get('concurrency', 1)
+        if isinstance(concurrency, bool) or not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("Key 'concurrency' should be a positive integer")
+        for key in ('stop_timeout', 'health_timeout'):
+            value = options.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError("Key '{}' should be a positive number".format(key))
+        if not isinstance(options.get('wait_healthy', False), bool):
+            raise ValueError("Key 'wait_healthy' should be a boolean")
+
+    def reload(self):
+        """
+        Reload the configuration files.
+
+        The Docker client is kept unless its configuration changed. When the
+        new configuration is invalid, the current configuration remains
+        in use.
+
+        :returns:
+            True if the configuration was reloaded, False otherwise.
+        """
+        docker_config = self.config.get('docker', {})
+        try:
+            self._load_config(*self.config_files)
+        except ConfigurationError as e:
+            self.logger.error("Not reloading configuration: {!s}".format(e))
+            return False
+        if self.config_loader.loaded and not self.config_loader.changed_files:
+            self.logger.info("Configuration unchanged")
+            return True
+
+        if self.config.get('docker', {}) != docker_config:
+            self.logger.info("Docker configuration changed, creating new client")
+            self.client = self._create_docker_client()
+        self.updater = self._create_updater()
+        self.logger.info("Configuration reloaded")
+        return True
+
+    def write_metrics(self):
+        """
+        Write metrics to the file configured as `config.metrics.textfile`, if any.
+        """
+        path = self.config.get('metrics', {}).get('textfile')
+        if path is None:
+            return
+        try:
+            self.metrics.write_textfile(path)
+        except (IOError, OSError) as e:
+            self.logger.error("Unable to write metrics to {}: {!s}".format(path, e))
+
+    def check(self):
+        """
+        Compare all watched images with their registries and print a JSON
+        report of the images which are out of date and the sets they would
+        trigger.
+
+        :returns:
+            The exit status: 1 if any image couldn't be checked,
+            `EXIT_UPDATES_AVAILABLE` if any image is out of date and 0
+            otherwise.
+        """
+        with self.tracer.span("check", "run"):
+            checks = self.updater.check_images(
+                concurrency=self.config.get('concurrency', {}).get('checks', 10)
+            )
+        if isinstance(self.updater, MultiHostUpdater):
+            report = {'hosts': OrderedDict(
+                (host, self._check_report([c for c in checks if c.host == host]))
+                for host in self.updater.updaters
+            )}
+            reports = list(report['hosts'].values())
+        else:
+            report = self._check_report(checks)
+            reports = [report]
+        print(json.dumps(report, indent=2, sort_keys=True))
+        if any(r['errors'] for r in reports):
+            return 1
+        if any(r['stale'] for r in reports):
+            return EXIT_UPDATES_AVAILABLE
+        return 0
+
+    def _check_report(self, checks):
+        """
+        Build the report printed by `check()` from a list of
+        `diu.updater.ImageCheck` instances.
+        """
+        stale = [c for c in checks if c.stale]
+        triggered = set(name for c in stale for name in c.sets)
+        return {
+            'stale': [{
+                'image': c.image,
+                'local_id': c.local_id,
+                'local_digests': c.local_digests,
+                'remote_digest': c.remote_digest,
+                'sets': c.sets,
+            } for c in stale],
+            'errors': [{
+                'image': c.image,
+                'error': str(c.error),
+                'sets': c.sets,
+            } for c in checks if c.error is not None],
+            'up_to_date': [c.image for c in checks if not c.stale and c.error is None],
+            'sets': [w.name for w in self.containerset if w.name in triggered],
+        }
 
     def run(self):
         """
         Run the application.
+
+        With `--profile`, the run and the threads it starts are profiled
+        with cProfile. With `--trace`, the recorded spans are written once
+        the run finishes.
+        """
+        try:
+            if self.args.profile is not None:
+                profile = ThreadProfiler()
+                try:
+                    profile.runcall(self._run)
+                finally:
+                    profile.dump_stats(self.args.profile)
+                    self.logger.info("Profile written to {}".format(self.args.profile))
+            else:
+                self._run()
+        finally:
+            if self.args.trace is not None:
+                self._write_trace()
+
+    def _work_due(self):
         """
+        Check whether any watched image is due to be checked, based on the
+        times recorded in the state store. This is done before connecting
+        to the Docker daemon, so a run with nothing to do exits quickly.
+
+        :returns:
+            False when every image was checked successfully within its TTL,
+            True otherwise (and always when no state store is configured).
+        """
+        if self.state is None:
+            return True
+        state_ttl = self.config.get('state', {}).get('ttl', 0)
+        hosts = list(self._hosts()) or [None]
+        for watcher in self.containerset:
+            ttl = state_ttl if watcher.ttl is None else watcher.ttl
+            for host in hosts:
+                if host is not None and watcher.hosts is not None and host not in watcher.hosts:
+                    continue
+                for image in watcher.images:
+                    if not self.state.is_fresh(state_key(image, host), ttl):
+                        return True
+        return False
+
+    def _write_trace(self):
+        try:
+            self.tracer.write(self.args.trace)
+        except (IOError, OSError) as e:
+            self.logger.error("Unable to write trace to {}: {!s}".format(self.args.trace, e))
+        else:
+            self.logger.info("Trace written to {}".format(self.args.trace))
+
+    def _run(self):
+        if self.args.check:
+            sys.exit(self.check())
+        if self.args.daemon:
+            from diu.daemon import Daemon
+            Daemon(self).run()
+            return
+
+        if not self._work_due():
+            self.logger.info("All images were checked recently, nothing to do")
+            # A skipped run is still a run, so the updater doesn't look dead
+            self.metrics.set('diu_error_count', 0)
+            self.metrics.set('diu_last_run_timestamp_seconds', time.time())
+            self.write_metrics()
+            return
         self.updater.do_updates()
+        self.write_metrics()
         if self.updater.error_count > 0:
             sys.exit(1)
 
@@ -136,7 +726,13 @@ def setup_logger():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     console_handler = logging.StreamHandler(sys.stdout)
-    if sys.stdout.isatty() and ColoredFormatter is not None:
+    ColoredFormatter = None
+    if sys.stdout.isatty():
+        try:
+            from colorlog import ColoredFormatter
+        except ImportError:
+            pass
+    if ColoredFormatter is not None:
         formatter = ColoredFormatter(
             "%(asctime)s %(log_color)s%(levelname)-8s%(reset)s "
             "%(cyan)s%(name)-10s%(reset)s %(white)s%(message)s%(reset)s",
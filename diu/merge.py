@@ -1,39 +1,120 @@
-from copy import deepcopy
+def _key(item):
+    """
+    Return a hashable key for an item of a list, which compares equal to
+    the key of another item exactly when the items do. Dicts and lists,
+    such as commands, are keyed by their (frozen) contents.
 
+    :raises TypeError:
+        When the item contains an unhashable value which isn't a dict or
+        a list.
+    """
+    if isinstance(item, dict):
+        return dict, frozenset((k, _key(v)) for k, v in item.items())
+    if isinstance(item, (list, tuple)):
+        return type(item), tuple(_key(i) for i in item)
+    hash(item)
+    return item
 
-def merge(a, b):
+
+class Merger(object):
     """
-    Recursively merge datasets of a and b together so that:
+    Merges datasets together so that:
 
     * Dicts are (recursively) merged
-    * Lists are appended together
+    * Lists are appended together, dropping duplicates while keeping the
+      order in which items are first encountered
     * Other types take the value from b
 
     A ValueError is raised when trying to merge two items of
     a different type.
+
+    The inputs are never modified. Containers are copied only when they
+    have to be changed, and at most once per merger: the copies made by a
+    merger are modified in place when the same merger merges more data into
+    them. Anything which didn't need to change is shared with the inputs,
+    so a result should be treated as read-only.
+
+    To merge many datasets in linear time, use a single merger::
+
+        merger = Merger()
+        result = {}
+        for data in datasets:
+            result = merger.merge(result, data)
     """
-    if type(a) != type(b):
-        raise ValueError(
-            "Trying to merge two different types of data:\n"
-            "Value A {a_type} = {a_value}\n\n"
-            "Value B {b_type} = {b_value}\n".format(
-                a_type=type(a),
-                a_value=a,
-                b_type=type(b),
-                b_value=b,
+
+    def __init__(self):
+        # Maps the ids of containers copied by this merger to the copies and
+        # (for lists) the items they contain. The copies are referenced
+        # here so their ids can't be reused while the merger is alive.
+        self._owned = {}
+
+    def _own_dict(self, d):
+        if id(d) in self._owned:
+            return d
+        d = dict(d)
+        self._owned[id(d)] = (d, None)
+        return d
+
+    def _own_list(self, items):
+        if id(items) in self._owned:
+            return self._owned[id(items)]
+        seen = (set(), [])  # Keys of the items of the copy, and unkeyable items
+        copy = []
+        self._owned[id(copy)] = (copy, seen)
+        self._extend(copy, seen, items)
+        return copy, seen
+
+    @staticmethod
+    def _extend(target, seen, items):
+        keys, unkeyable = seen
+        for item in items:
+            try:
+                key = _key(item)
+                if key in keys:
+                    continue
+                keys.add(key)
+            except TypeError:
+                # Items which can't be keyed, such as arbitrary objects,
+                # are compared against each other one by one
+                if item in unkeyable:
+                    continue
+                unkeyable.append(item)
+            target.append(item)
+
+    def merge(self, a, b):
+        """
+        Merge b into a, returning the result.
+        """
+        if type(a) is not type(b):
+            raise ValueError(
+                "Trying to merge two different types of data:\n"
+                "Value A {a_type} = {a_value}\n\n"
+                "Value B {b_type} = {b_value}\n".format(
+                    a_type=type(a),
+                    a_value=a,
+                    b_type=type(b),
+                    b_value=b,
+                )
             )
-        )
-
-    result = None
-    if isinstance(b, list):
-        result = list(set(a + b))
-    elif isinstance(b, dict):
-        result = deepcopy(a)
-        for k, v in b.items():
-            if k in result:
-                result[k] = merge(result[k], v)
-            else:
-                result[k] = deepcopy(v)
-    else:
-        return b
-    return result
+
+        if isinstance(b, list):
+            result, seen = self._own_list(a)
+            self._extend(result, seen, b)
+        elif isinstance(b, dict):
+            result = self._own_dict(a)
+            for k, v in b.items():
+                if k in result:
+                    result[k] = self.merge(result[k], v)
+                else:
+                    result[k] = v
+        else:
+            return b
+        return result
+
+
+def merge(a, b):
+    """
+    Recursively merge datasets of a and b together. See `Merger` for
+    the rules which are applied.
+    """
+    return Merger().merge(a, b)
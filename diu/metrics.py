@@ -0,0 +1,266 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import bisect
+import logging
+import os
+import threading
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Name: (type, help text) of every metric which may be recorded
+METRICS = {
+    'diu_inspect_duration_seconds': (
+        'histogram', "Time taken to inspect a local image"),
+    'diu_pull_duration_seconds': (
+        'histogram', "Time taken to pull an image"),
+    'diu_pull_bytes_total': (
+        'counter', "Number of bytes downloaded while pulling images"),
+    'diu_image_checks_total': (
+        'counter', "Number of image checks, by outcome"),
+    'diu_images_updated_total': (
+        'counter', "Number of updated images, by set"),
+    'diu_image_failures_total': (
+        'counter', "Number of images which failed to update, by set"),
+    'diu_command_duration_seconds': (
+        'histogram', "Time taken to run a command"),
+    'diu_commands_total': (
+        'counter', "Number of commands run, by status"),
+    'diu_rate_limited_total': (
+        'counter', "Number of pulls which exceeded a registry's rate limit, by registry"),
+    'diu_registry_quota_remaining': (
+        'gauge', "Number of requests remaining in a registry's rate limit window"),
+    'diu_images_removed_total': (
+        'counter', "Number of superseded images removed"),
+    'diu_reclaimed_bytes_total': (
+        'counter', "Bytes freed by removing superseded images, excluding shared layers"),
+    'diu_containers_recreated_total': (
+        'counter', "Number of containers recreated by recreate actions, by outcome"),
+    'diu_error_count': (
+        'gauge', "Number of errors which occurred since the updater was started"),
+    'diu_last_run_timestamp_seconds': (
+        'gauge', "Time at which the last run finished"),
+}
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    ) for k, v in items) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    A minimal, thread-safe collection of counters, gauges and histograms,
+    which can be rendered in the Prometheus text exposition format.
+
+    Recording a sample only takes a lock and a dictionary lookup; all
+    formatting is done by `render()`.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets:
+            The upper bounds of the buckets used by histograms.
+        """
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # Maps (name, labels) to a value
+        self._histograms = {}  # Maps (name, labels) to [bucket counts, sum, count]
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Record an observation in a histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get(self, name, **labels):
+        """
+        Return the current value of a counter or gauge, or None if it was
+        never recorded.
+        """
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))))
+
+    def bind(self, **labels):
+        """
+        Return a view of these metrics which adds the given labels to
+        everything recorded through it.
+        """
+        return BoundMetrics(self, labels)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            values = dict(self._values)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+
+        samples = {}  # Maps names to a list of (labels, lines) tuples
+        for (name, labels), value in values.items():
+            samples.setdefault(name, []).append((labels, [
+                "{}{} {}".format(name, _format_labels(labels), _format_value(value))
+            ]))
+        for (name, labels), (counts, total, count) in histograms.items():
+            lines = []
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(
+                    name, _format_labels(labels, [("le", _format_value(bound))]), cumulative
+                ))
+            lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_value(total)))
+            lines.append("{}_count{} {}".format(name, _format_labels(labels), count))
+            samples.setdefault(name, []).append((labels, lines))
+
+        output = []
+        for name in sorted(samples):
+            kind, description = METRICS.get(name, ('untyped', name))
+            output.append("# HELP {} {}".format(name, description))
+            output.append("# TYPE {} {}".format(name, kind))
+            for labels, lines in sorted(samples[name]):
+                output.extend(lines)
+        return "\n".join(output) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Write all metrics to a file, for use with the textfile collector of
+        the Prometheus node exporter. The file is replaced atomically.
+        """
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+
+class BoundMetrics(object):
+    """
+    A view of a `Metrics` instance adding fixed labels to every sample,
+    see `Metrics.bind()`.
+    """
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def _merge(self, labels):
+        merged = dict(self.labels)
+        merged.update(labels)
+        return merged
+
+    def inc(self, name, value=1, **labels):
+        self.metrics.inc(name, value, **self._merge(labels))
+
+    def set(self, name, value, **labels):
+        self.metrics.set(name, value, **self._merge(labels))
+
+    def observe(self, name, value, **labels):
+        self.metrics.observe(name, value, **self._merge(labels))
+
+    def get(self, name, **labels):
+        return self.metrics.get(name, **self._merge(labels))
+
+
+def _http_server():
+    """
+    Import the HTTP server classes, which only the daemon needs.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    return BaseHTTPRequestHandler, HTTPServer
+
+
+class MetricsServer(object):
+    """
+    An HTTP server exposing metrics to Prometheus on `/metrics`.
+    """
+
+    def __init__(self, address, metrics):
+        """
+        :param address:
+            A `(host, port)` tuple to listen on.
+        :param metrics:
+            The `Metrics` instance to expose.
+        """
+        self.metrics = metrics
+        self.logger = logging.getLogger(self.__class__.__name__)
+        HTTPServer = _http_server()[1]
+        self.server = HTTPServer(address, self._create_handler())
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def _create_handler(self):
+        server = self
+
+        class Handler(_http_server()[0]):
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Serving metrics on {}:{}".format(*self.address))
+
+    def stop(self):
+        """
+        Stop serving requests.
+        """
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,296 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import json
+import logging
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MEGABYTE = 1000 * 1000
+
+
+class PullError(Exception):
+    """
+    Raised when the Docker daemon reports an error while pulling an image.
+    """
+
+
+class PullTimeout(PullError):
+    """
+    Raised when a pull exceeds its deadline or stops making progress.
+    """
+
+
+def abort_stream(chunks):
+    """
+    Close the connection a pull stream is read from, so that a thread
+    blocked reading it returns. Safe to call from any thread.
+
+    Streams with an `abort()` method, such as those of
+    `diu.aio.AsyncioClient`, are aborted through it. For streams of
+    docker-py, the socket of the HTTP response the stream reads from is
+    shut down. Other streams are left alone.
+    """
+    abort = getattr(chunks, 'abort', None)
+    if abort is not None:
+        abort()
+        return
+    frame = getattr(chunks, 'gi_frame', None)
+    response = frame.f_locals.get('response') if frame is not None else None
+    if response is None:
+        return
+    try:
+        fp = response.raw._fp.fp
+        sock = getattr(fp, 'raw', fp)._sock
+    except AttributeError:
+        sock = None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+    response.close()
+
+
+def guard_stream(chunks, timeout=None, stall_timeout=None, clock=time.time):
+    """
+    Pass on the chunks of a pull stream, aborting the pull when it takes
+    too long or the daemon stops sending events.
+
+    The stream is read by a background thread, so a read blocking forever
+    can't block the caller. When the pull is aborted, the stream is closed
+    with `abort_stream()` so that thread finishes as well.
+
+    :param chunks:
+        The stream returned by `client.pull(stream=True)`.
+    :param timeout:
+        The number of seconds the complete pull may take, or None.
+    :param stall_timeout:
+        The number of seconds to wait for the next chunk, or None.
+    :returns:
+        A generator yielding the chunks of `chunks`.
+    :raises PullTimeout:
+        When either timeout is exceeded.
+    """
+    if timeout is None and stall_timeout is None:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    received = queue.Queue()
+
+    def read():
+        try:
+            for chunk in chunks:
+                received.put((True, chunk))
+            received.put((False, None))
+        except Exception as e:
+            received.put((False, e))
+
+    reader = threading.Thread(target=read, name="pull-reader")
+    reader.daemon = True
+    reader.start()
+    deadline = None if timeout is None else clock() + timeout
+    while True:
+        wait = stall_timeout
+        if deadline is not None:
+            remaining = max(0, deadline - clock())
+            wait = remaining if wait is None else min(wait, remaining)
+        try:
+            is_chunk, value = received.get(timeout=wait)
+        except queue.Empty:
+            abort_stream(chunks)
+            if deadline is not None and clock() >= deadline:
+                raise PullTimeout("Pull did not finish within {}s".format(timeout))
+            raise PullTimeout("Pull made no progress for {}s".format(stall_timeout))
+        if not is_chunk:
+            if value is not None:
+                raise value
+            return
+        yield value
+
+
+def decode_stream(chunks):
+    """
+    Decode the stream returned by `client.pull(stream=True)` into events.
+
+    The daemon sends one JSON object per line, but lines may be split across
+    (or combined into) chunks arbitrarily.
+
+    :param chunks:
+        An iterable of bytes or str chunks.
+    :returns:
+        A generator yielding each event as a dictionary.
+    """
+    buf = b""
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode("utf-8")
+        buf += chunk
+        lines = buf.split(b"\n")
+        buf = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode("utf-8"))
+    if buf.strip():
+        yield json.loads(buf.strip().decode("utf-8"))
+
+
+def format_bytes(n):
+    return "{:.1f} MB".format(n / MEGABYTE)
+
+
+@attr.s
+class LayerProgress(object):
+    """
+    The progress of a single layer of an image being pulled.
+    """
+    downloaded = attr.ib(default=0)
+    download_total = attr.ib(default=0)
+    extracted = attr.ib(default=0)
+    extract_total = attr.ib(default=0)
+    present = attr.ib(default=False)
+    complete = attr.ib(default=False)
+
+
+class PullProgress(object):
+    """
+    Tracks the progress of pulling an image from the events streamed by
+    the Docker daemon.
+    """
+
+    def __init__(self, image, interval=10, clock=time.time, logger=None):
+        """
+        :param image:
+            The name of the image being pulled.
+        :param interval:
+            Report aggregate progress at most once per this many seconds.
+        :param clock:
+            A function returning the current time in seconds.
+        :param logger:
+            The logger to report progress to, defaults to one named after
+            this class.
+        """
+        self.image = image
+        self.interval = interval
+        self.clock = clock
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.layers = {}
+        self.started = clock()
+        self.finished = None
+        self._last_report = self.started
+
+    def feed(self, event):
+        """
+        Process a single event of the pull stream.
+
+        :raises PullError:
+            When the event reports an error.
+        """
+        if 'error' in event:
+            raise PullError(event['error'])
+
+        status = event.get('status', '')
+        layer_id = event.get('id')
+        if layer_id is None or status.startswith(("Pulling from", "Digest:", "Status:")):
+            return
+
+        layer = self.layers.setdefault(layer_id, LayerProgress())
+        detail = event.get('progressDetail') or {}
+        if status == "Already exists":
+            layer.present = True
+            layer.complete = True
+        elif status == "Downloading":
+            layer.downloaded = detail.get('current', layer.downloaded)
+            layer.download_total = detail.get('total', layer.download_total)
+        elif status == "Download complete":
+            layer.downloaded = max(layer.downloaded, layer.download_total)
+        elif status == "Extracting":
+            layer.extracted = detail.get('current', layer.extracted)
+            layer.extract_total = detail.get('total', layer.extract_total)
+        elif status == "Pull complete":
+            layer.downloaded = max(layer.downloaded, layer.download_total)
+            layer.extracted = max(layer.extracted, layer.extract_total)
+            layer.complete = True
+
+        now = self.clock()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.logger.info("Pulling {}: {}".format(self.image, self.describe()))
+
+    def consume(self, chunks):
+        """
+        Process the complete (raw) stream returned by `client.pull(stream=True)`.
+        """
+        for event in decode_stream(chunks):
+            self.feed(event)
+        self.finished = self.clock()
+
+    @property
+    def downloaded(self):
+        """
+        The number of bytes downloaded.
+        """
+        return sum(layer.downloaded for layer in self.layers.values())
+
+    @property
+    def download_total(self):
+        """
+        The number of bytes to download, as far as currently known.
+        """
+        return sum(layer.download_total for layer in self.layers.values())
+
+    @property
+    def extracted(self):
+        """
+        The number of bytes extracted.
+        """
+        return sum(layer.extracted for layer in self.layers.values())
+
+    @property
+    def duration(self):
+        """
+        The number of seconds the pull took (so far).
+        """
+        return (self.finished or self.clock()) - self.started
+
+    @property
+    def rate(self):
+        """
+        The average download rate in bytes per second.
+        """
+        duration = self.duration
+        return self.downloaded / duration if duration > 0 else 0
+
+    def describe(self):
+        """
+        Return a one-line description of the current progress.
+        """
+        complete = sum(1 for layer in self.layers.values() if layer.complete)
+        return "{}/{} layers, {} of {} downloaded, {} extracted ({:.1f} MB/s)".format(
+            complete,
+            len(self.layers),
+            format_bytes(self.downloaded),
+            format_bytes(self.download_total),
+            format_bytes(self.extracted),
+            self.rate / MEGABYTE,
+        )
+
+    def summary(self):
+        """
+        Return a one-line summary of the finished pull.
+        """
+        present = sum(1 for layer in self.layers.values() if layer.present)
+        return "{} in {:.1f}s ({:.1f} MB/s), {} of {} layers already present".format(
+            format_bytes(self.downloaded),
+            self.duration,
+            self.rate / MEGABYTE,
+            present,
+            len(self.layers),
+        )
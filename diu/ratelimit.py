@@ -0,0 +1,246 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import contextlib
+import logging
+import random
+import re
+import threading
+import time
+
+# Matches the errors registries (and the Docker daemon relaying them)
+# return when a rate limit has been exceeded.
+RATE_LIMITED = re.compile(r"toomanyrequests|too many requests|rate limit", re.IGNORECASE)
+
+_QUOTA = re.compile(r"^\s*(\d+)\s*(?:;\s*w\s*=\s*(\d+))?")
+
+
+def is_rate_limited(error):
+    """
+    Check whether an exception (or error message) reports an exceeded
+    rate limit.
+    """
+    return RATE_LIMITED.search(str(error)) is not None
+
+
+@attr.s
+class Quota(object):
+    """
+    The rate limit quota reported by a registry.
+
+    :param limit:
+        The number of requests allowed per window.
+    :param remaining:
+        The number of requests remaining in the current window.
+    :param window:
+        The length of the window in seconds, if reported.
+    """
+    limit = attr.ib()
+    remaining = attr.ib()
+    window = attr.ib(default=None)
+
+
+def parse_quota(headers):
+    """
+    Parse the `RateLimit-Limit` and `RateLimit-Remaining` headers sent by
+    Docker Hub (in the form of `100;w=21600`).
+
+    :param headers:
+        The (case-insensitive) headers of a registry response.
+    :returns:
+        A `Quota` instance, or None when the headers are absent or invalid.
+    """
+    limit = _QUOTA.match(headers.get("RateLimit-Limit") or "")
+    remaining = _QUOTA.match(headers.get("RateLimit-Remaining") or "")
+    if limit is None or remaining is None:
+        return None
+    window = limit.group(2) or remaining.group(2)
+    return Quota(
+        limit=int(limit.group(1)),
+        remaining=int(remaining.group(1)),
+        window=int(window) if window else None,
+    )
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a `Retry-After` header, given either in seconds or as an HTTP date.
+
+    :returns:
+        The number of seconds to wait, or None when `value` is invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0, email.utils.mktime_tz(parsed) - now)
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket, allowing `rate` operations per second on
+    average with bursts of up to `burst` operations.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = clock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one to become available if needed.
+
+        Tokens are reserved before waiting, so concurrent callers are
+        released in the order in which they called `acquire()`.
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+
+
+class RegistryLimiter(object):
+    """
+    Limits the requests and pulls made against a single registry.
+    """
+
+    def __init__(self, registry, concurrency=None, rate=None, burst=1,
+                 clock=time.time, sleep=time.sleep):
+        """
+        :param registry:
+            The name of the registry, e.g. `docker.io`.
+        :param concurrency:
+            The maximum number of requests and pulls in progress at the same
+            time, or None for no limit.
+        :param rate:
+            The maximum number of requests and pulls started per second on
+            average, or None for no limit.
+        :param burst:
+            The number of requests and pulls which may be started at once
+            before `rate` applies.
+        """
+        self.registry = registry
+        self.clock = clock
+        self.sleep = sleep
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.quota = None
+        self._lock = threading.Lock()
+        self._not_before = 0
+        self._slots = None if concurrency is None else threading.BoundedSemaphore(concurrency)
+        self._bucket = None if rate is None else TokenBucket(rate, burst, clock, sleep)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        A context manager which waits until a request or pull may be made
+        against this registry, and holds on to a concurrency slot until
+        the block is left.
+        """
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            with self._lock:
+                wait = self._not_before - self.clock()
+            if wait > 0:
+                self.logger.info("Waiting {:.1f}s before contacting {}".format(
+                    wait, self.registry))
+                self.sleep(wait)
+            if self._bucket is not None:
+                self._bucket.acquire()
+            yield
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def back_off(self, delay):
+        """
+        Hold back all requests and pulls against this registry for `delay`
+        seconds from now.
+        """
+        with self._lock:
+            self._not_before = max(self._not_before, self.clock() + delay)
+
+    def update(self, headers):
+        """
+        Record the quota reported in the headers of a registry response.
+        """
+        quota = parse_quota(headers)
+        if quota is not None:
+            self.quota = quota
+
+
+class RateLimits(object):
+    """
+    The limiters of all registries, along with the policy for retrying
+    requests and pulls which exceeded a registry's rate limit.
+    """
+
+    def __init__(self, limits=None, retries=3, backoff=1, max_backoff=60,
+                 clock=time.time, sleep=time.sleep, random=random.random):
+        """
+        :param limits:
+            A dictionary mapping registry names to dictionaries with the
+            optional `concurrency`, `rate` and `burst` arguments of their
+            `RegistryLimiter`. Registries not listed are not limited.
+        :param retries:
+            The number of times a rate limited request or pull is retried.
+        :param backoff:
+            The base delay in seconds before retrying, doubled on every
+            attempt.
+        :param max_backoff:
+            The maximum delay in seconds before retrying.
+        """
+        self.limits = limits or {}
+        self.retries = retries
+        self.base_delay = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random
+        self._lock = threading.Lock()
+        self._limiters = {}  # Maps registry names to their RegistryLimiter
+
+    def for_registry(self, registry):
+        """
+        Return the `RegistryLimiter` of the given registry.
+        """
+        with self._lock:
+            limiter = self._limiters.get(registry)
+            if limiter is None:
+                limiter = self._limiters[registry] = RegistryLimiter(
+                    registry, clock=self.clock, sleep=self.sleep, **self.limits.get(registry, {})
+                )
+            return limiter
+
+    def backoff(self, attempt):
+        """
+        Return the delay before retry number `attempt` (starting at 0),
+        using exponential backoff with full jitter.
+        """
+        return self.random() * min(self.max_backoff, self.base_delay * 2 ** attempt)
+
+    def quotas(self):
+        """
+        Return the last quota reported by each registry.
+
+        :returns:
+            A dictionary mapping registry names to `Quota` instances.
+        """
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.registry: limiter.quota for limiter in limiters
+                if limiter.quota is not None}
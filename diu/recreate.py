@@ -0,0 +1,317 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import fnmatch
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from diu.metrics import Metrics
+
+# Keys of a container's configuration which it inherits from its image.
+# Values identical to those of the old image are left out when recreating
+# the container, so the container picks up the values of the new image.
+IMAGE_DEFAULTS = (
+    'Cmd', 'Entrypoint', 'WorkingDir', 'User', 'ExposedPorts', 'Volumes', 'Healthcheck',
+    'StopSignal', 'Shell', 'OnBuild', 'ArgsEscaped',
+)
+
+# Network modes which don't connect a container to networks of its own
+SHARED_NETWORK_MODES = ('host', 'none')
+
+# Number of seconds to follow the events stream for at once while waiting
+# for a healthcheck, kept below the read timeout of docker-py.
+EVENTS_WINDOW = 30
+
+# Number of seconds to wait for a container without a `StopTimeout` of its
+# own to stop, when no `stop_timeout` is configured
+DEFAULT_STOP_TIMEOUT = 10
+
+
+class RecreateError(Exception):
+    """
+    Raised when a container could not be recreated.
+    """
+
+
+@attr.s
+class RecreateResult(object):
+    """
+    The outcome of recreating the containers using updated images.
+
+    :param recreated:
+        The names of the recreated containers.
+    :param failed:
+        The names of the containers which couldn't be recreated. These
+        keep running their old image.
+    """
+    recreated = attr.ib(default=attr.Factory(list))
+    failed = attr.ib(default=attr.Factory(list))
+
+
+def uses_recreate(commands):
+    """
+    Check whether any of the given command entries, including those in
+    `parallel` groups, is a `recreate` action.
+    """
+    for command in commands:
+        if isinstance(command, dict) and 'recreate' in command:
+            return True
+        if isinstance(command, dict) and uses_recreate(command.get('parallel', [])):
+            return True
+    return False
+
+
+def container_config(info, image_config, image):
+    """
+    Build the configuration for a container replacing an existing one.
+
+    :param info:
+        The existing container, as returned by `inspect_container()`.
+    :param image_config:
+        The `Config` of the image the existing container was created from.
+    :param image:
+        The name of the image to create the new container from.
+    :returns:
+        A `(config, networks)` tuple of the configuration to pass to
+        `create_container_from_config()` and a list of `(network, endpoint)`
+        tuples of additional networks to connect the container to.
+    """
+    config = dict(info['Config'])
+    config['Image'] = image
+    for key in IMAGE_DEFAULTS:
+        if key in config and config[key] == image_config.get(key):
+            del config[key]
+    image_env = set(image_config.get('Env') or [])
+    config['Env'] = [e for e in config.get('Env') or [] if e not in image_env]
+    image_labels = image_config.get('Labels') or {}
+    config['Labels'] = dict((k, v) for k, v in (config.get('Labels') or {}).items()
+                            if image_labels.get(k) != v)
+    if config.get('Hostname') == info['Id'][:12]:
+        del config['Hostname']
+
+    # Anonymous volumes aren't part of the host config, so they are passed
+    # on explicitly to keep their data.
+    host_config = dict(info.get('HostConfig') or {})
+    binds = list(host_config.get('Binds') or [])
+    destinations = set(b.split(':')[1] for b in binds if ':' in b)
+    for mount in info.get('Mounts') or []:
+        if mount.get('Type') == 'volume' and mount.get('Destination') not in destinations:
+            binds.append("{}:{}{}".format(
+                mount['Name'], mount['Destination'], '' if mount.get('RW', True) else ':ro'))
+    if binds:
+        host_config['Binds'] = binds
+    config['HostConfig'] = host_config
+
+    networks = []
+    mode = host_config.get('NetworkMode') or 'default'
+    if mode not in SHARED_NETWORK_MODES and not mode.startswith('container:'):
+        endpoints = (info.get('NetworkSettings') or {}).get('Networks') or {}
+        for network in sorted(endpoints, key=lambda n: n != mode):
+            endpoint = endpoints[network] or {}
+            aliases = [a for a in endpoint.get('Aliases') or [] if a != info['Id'][:12]]
+            if network == mode:
+                config['NetworkingConfig'] = {'EndpointsConfig': {network: {
+                    'Aliases': aliases or None,
+                    'Links': endpoint.get('Links'),
+                    'IPAMConfig': endpoint.get('IPAMConfig'),
+                }}}
+            else:
+                ipam = endpoint.get('IPAMConfig') or {}
+                networks.append((network, {
+                    'aliases': aliases or None,
+                    'links': endpoint.get('Links'),
+                    'ipv4_address': ipam.get('IPv4Address'),
+                    'ipv6_address': ipam.get('IPv6Address'),
+                }))
+    return config, networks
+
+
+class ContainerRecreator(object):
+    """
+    Recreates the containers running an outdated image from the image's
+    new version, keeping their configuration, through the Docker client
+    the updater already has open.
+    """
+
+    def __init__(self, client, concurrency=1, stop_timeout=None, wait_healthy=False,
+                 health_timeout=60, metrics=None, logger=None, clock=time.time):
+        """
+        :param client:
+            The Docker client to use (a docker.Client instance)
+        :param concurrency:
+            The maximum number of containers to recreate in parallel.
+        :param stop_timeout:
+            The number of seconds to wait for an old container to stop
+            before it is killed. Defaults to the container's own
+            `StopTimeout`, or 10 seconds when it has none.
+        :param wait_healthy:
+            Wait for new containers with a healthcheck to become healthy,
+            restoring the old container when they don't.
+        :param health_timeout:
+            The number of seconds to wait for a new container to become
+            healthy.
+        :param metrics:
+            The `diu.metrics.Metrics` instance to record metrics in.
+        :param logger:
+            The logger to use, defaults to one named after this class.
+        :param clock:
+            A function returning the current time in seconds.
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.stop_timeout = stop_timeout
+        self.wait_healthy = wait_healthy
+        self.health_timeout = health_timeout
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._image_configs = {}  # Maps old image IDs to their Config
+
+    def _image_config(self, image_id):
+        from docker.errors import APIError
+        with self._lock:
+            if image_id in self._image_configs:
+                return self._image_configs[image_id]
+        try:
+            config = self.client.inspect_image(image_id).get('Config') or {}
+        except APIError as e:
+            self.logger.warning("Unable to inspect image {}, keeping all settings of its "
+                                "containers: {!s}".format(image_id, e))
+            config = {}
+        with self._lock:
+            self._image_configs[image_id] = config
+        return config
+
+    def recreate(self, images, names=None):
+        """
+        Recreate the running containers using any of the given images.
+
+        :param images:
+            A dictionary mapping the IDs of outdated images to the name of
+            the image to recreate their containers from.
+        :param names:
+            Shell-style patterns of the container names to recreate. All
+            containers using the images are recreated when None.
+        :returns:
+            A `RecreateResult` instance.
+        """
+        result = RecreateResult()
+        targets = []
+        for container in self.client.containers():
+            if container.get('ImageID') not in images:
+                continue
+            name = (container.get('Names') or ['/' + container['Id'][:12]])[0].lstrip('/')
+            if names is not None and not any(fnmatch.fnmatchcase(name, n) for n in names):
+                continue
+            targets.append((container['Id'], name, container['ImageID']))
+        if not targets:
+            self.logger.info("No running containers use the updated images")
+            return result
+
+        def recreate(target):
+            container_id, name, image_id = target
+            try:
+                self._recreate(container_id, name, image_id, images[image_id])
+            except Exception as e:
+                self.logger.error("Unable to recreate container {}: {!s}".format(name, e))
+                self.metrics.inc('diu_containers_recreated_total', outcome='failed')
+                return False
+            self.logger.info("Recreated container {} from {}".format(name, images[image_id]))
+            self.metrics.inc('diu_containers_recreated_total', outcome='recreated')
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            outcomes = list(executor.map(recreate, targets))
+        for (_, name, _), ok in zip(targets, outcomes):
+            (result.recreated if ok else result.failed).append(name)
+        return result
+
+    def _recreate(self, container_id, name, image_id, image):
+        """
+        Replace a container by one created from `image`.
+
+        The old container is stopped and renamed, so the new container can
+        take its name and ports. It is only removed once the new container
+        has started (and became healthy, with `wait_healthy`); otherwise
+        the new container is removed and the old one is started again.
+        """
+        info = self.client.inspect_container(container_id)
+        config, networks = container_config(info, self._image_config(image_id), image)
+        self.logger.info("Recreating container {}".format(name))
+        timeout = self.stop_timeout
+        if timeout is None:
+            timeout = info['Config'].get('StopTimeout') or DEFAULT_STOP_TIMEOUT
+        self.client.stop(container_id, timeout=timeout)
+        renamed = False
+        new_id = None
+        try:
+            self.client.rename(container_id, "{}_diu_{}".format(name, container_id[:12]))
+            renamed = True
+            new_id = self.client.create_container_from_config(config, name=name)['Id']
+            for network, endpoint in networks:
+                self.client.connect_container_to_network(new_id, network, **endpoint)
+            started = self.clock()
+            self.client.start(new_id)
+            if self.wait_healthy:
+                self._wait_until_healthy(new_id, name, started)
+        except Exception:
+            self._restore(container_id, name, new_id, renamed)
+            raise
+        self.client.remove_container(container_id)
+
+    def _restore(self, container_id, name, new_id, renamed):
+        """
+        Start an old container again after recreating it failed.
+        """
+        self.logger.warning("Restoring container {}".format(name))
+        try:
+            if new_id is not None:
+                self.client.remove_container(new_id, force=True)
+            if renamed:
+                self.client.rename(container_id, name)
+            self.client.start(container_id)
+        except Exception:
+            self.logger.exception("Unable to restore container {}".format(name))
+
+    def _wait_until_healthy(self, container_id, name, started):
+        """
+        Wait for the healthcheck of a new container to pass, by following
+        its events rather than polling its state.
+
+        :raises RecreateError:
+            When the container became unhealthy, exited or didn't become
+            healthy within `health_timeout` seconds.
+        """
+        healthcheck = self.client.inspect_container(container_id)['Config'].get('Healthcheck')
+        test = (healthcheck or {}).get('Test') or ['NONE']
+        if test[0] == 'NONE':
+            self.logger.debug("Container {} has no healthcheck".format(name))
+            return
+
+        self.logger.info("Waiting for container {} to become healthy".format(name))
+        since = int(started)
+        deadline = started + self.health_timeout
+        while self.clock() < deadline:
+            # Events are replayed from `since`, so none are missed between
+            # following the stream and following it again.
+            until = int(math.ceil(min(deadline, self.clock() + EVENTS_WINDOW)))
+            events = self.client.events(since=since, until=until, decode=True,
+                                        filters={'container': container_id})
+            try:
+                for event in events:
+                    action = event.get('Action') or event.get('status') or ''
+                    if action == 'health_status: healthy':
+                        return
+                    if action == 'health_status: unhealthy':
+                        raise RecreateError("Container {} became unhealthy".format(name))
+                    if action == 'die':
+                        raise RecreateError("Container {} exited".format(name))
+            finally:
+                # Don't leave the connection of an unfinished stream open
+                close = getattr(events, 'close', None)
+                if close is not None:
+                    close()
+        raise RecreateError("Container {} did not become healthy within {}s".format(
+            name, self.health_timeout))
@@ -0,0 +1,439 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import logging
+import re
+import threading
+import time
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+from diu.ratelimit import RateLimits, parse_retry_after
+
+DEFAULT_REGISTRY = "docker.io"
+DEFAULT_REGISTRY_ENDPOINT = "registry-1.docker.io"
+DEFAULT_TAG = "latest"
+
+# Manifest media types we are able to compare against the RepoDigests
+# recorded by the Docker daemon. Manifest lists and OCI indexes are listed
+# first because that is what the daemon records for multi-arch images.
+MANIFEST_MEDIA_TYPES = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+)
+
+
+MANIFEST_LIST_MEDIA_TYPES = MANIFEST_MEDIA_TYPES[:2]
+
+DEFAULT_PLATFORM = "linux/amd64"
+
+DEFAULT_TAG_PAGE_SIZE = 100
+
+# Matches the URL of the next page in a `Link` header of a paginated response
+NEXT_LINK = re.compile(r'<([^>]*)>\s*;\s*rel="?next"?')
+
+
+class RegistryError(Exception):
+    """
+    Raised when a registry could not be queried.
+    """
+
+
+@attr.s
+class Manifest(object):
+    """
+    The manifest of an image, as far as the updater is concerned.
+
+    :param digest:
+        The digest of the manifest (or manifest list) served for the image,
+        as recorded in the `RepoDigests` of a pulled image.
+    :param layers:
+        The digests of the image's layers, from the base layer up.
+    """
+    digest = attr.ib()
+    layers = attr.ib(default=attr.Factory(list))
+
+
+@attr.s
+class TagPage(object):
+    """
+    A page of a repository's tag list, as cached between requests.
+
+    :param url:
+        The URL the page was requested from.
+    :param etag:
+        The `ETag` the registry returned with the page.
+    :param tags:
+        The tags on the page.
+    :param next:
+        The URL of the next page, or None for the last page.
+    """
+    url = attr.ib()
+    etag = attr.ib()
+    tags = attr.ib(default=attr.Factory(list))
+    next = attr.ib(default=None)
+
+
+class TagCache(object):
+    """
+    Caches the pages of tag lists by their URL, so they can be revalidated
+    with the registry rather than downloaded again. Safe to share between
+    threads.
+    """
+
+    def __init__(self, store=None):
+        """
+        :param store:
+            An optional `diu.state.StateStore` to keep the pages in across
+            runs. Pages are only kept in memory when None.
+        """
+        self.store = store
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Return the cached page for `url`, or None.
+        """
+        with self._lock:
+            page = self._pages.get(url)
+        if page is None and self.store is not None:
+            row = self.store.get_tag_page(url)
+            if row is not None:
+                page = TagPage(url, *row)
+                with self._lock:
+                    self._pages[url] = page
+        return page
+
+    def put(self, page):
+        """
+        Store a page, replacing the page previously stored for its URL.
+        """
+        with self._lock:
+            self._pages[page.url] = page
+        if self.store is not None:
+            self.store.put_tag_page(page.url, page.etag, page.tags, page.next)
+
+
+@attr.s
+class ImageReference(object):
+    """
+    A parsed Docker image reference.
+
+    :param registry:
+        The registry hostname (and optional port), e.g. `docker.io`.
+    :param repository:
+        The repository within the registry, e.g. `library/ubuntu`.
+    :param tag:
+        The tag of the image, e.g. `latest`.
+    :param digest:
+        The digest the image is pinned to, if any.
+    """
+    registry = attr.ib()
+    repository = attr.ib()
+    tag = attr.ib(default=DEFAULT_TAG)
+    digest = attr.ib(default=None)
+
+    @property
+    def endpoint(self):
+        """
+        The hostname to use when talking to the registry API.
+        """
+        if self.registry == DEFAULT_REGISTRY:
+            return DEFAULT_REGISTRY_ENDPOINT
+        return self.registry
+
+
+def parse_image_reference(image):
+    """
+    Parse an image name as accepted by `docker pull` into its components.
+
+    :param image:
+        The image name, in the form of `ubuntu`, `ubuntu:latest`,
+        `registry.example.com:5000/my/app:1.0` or `ubuntu@sha256:...`.
+    :returns:
+        An `ImageReference` instance.
+    """
+    name, digest = image, None
+    if "@" in name:
+        name, digest = name.split("@", 1)
+
+    tag = DEFAULT_TAG
+    last_component = name.rsplit("/", 1)[-1]
+    if ":" in last_component:
+        name, tag = name.rsplit(":", 1)
+
+    registry = DEFAULT_REGISTRY
+    parts = name.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry, name = parts
+    if registry == DEFAULT_REGISTRY and "/" not in name:
+        name = "library/" + name
+
+    return ImageReference(registry=registry, repository=name, tag=tag, digest=digest)
+
+
+class RegistryClient(object):
+    """
+    A minimal client for the Docker registry HTTP API v2.
+
+    Only anonymous access is supported. Registries which require
+    credentials will raise a `RegistryError`, which callers are expected
+    to handle by falling back to talking to the Docker daemon.
+    """
+
+    def __init__(self, timeout=10, insecure=(), session=None, platform=DEFAULT_PLATFORM,
+                 limits=None, tag_cache=None, page_size=DEFAULT_TAG_PAGE_SIZE):
+        """
+        :param timeout:
+            Timeout in seconds for requests made to a registry.
+        :param insecure:
+            A list of registries (`host` or `host:port`) which should be
+            spoken to over plain HTTP rather than HTTPS.
+        :param session:
+            The `requests.Session` to use. A new one is created if not supplied.
+        :param platform:
+            The `os/architecture` whose manifest is used when a registry
+            serves a multi-platform manifest list.
+        :param limits:
+            The `diu.ratelimit.RateLimits` to apply to requests. Requests
+            answered with HTTP status 429 are retried as configured there.
+        :param tag_cache:
+            The `TagCache` to revalidate tag lists against. A new one,
+            held in memory, is created if not supplied.
+        :param page_size:
+            The number of tags to request per page when listing tags.
+        """
+        self.timeout = timeout
+        self.platform = platform
+        self.insecure = set(insecure)
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self.limits = limits if limits is not None else RateLimits()
+        self.tag_cache = tag_cache if tag_cache is not None else TagCache()
+        self.page_size = page_size
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._tokens = {}  # Maps (realm, service, scope) to (token, expiry time)
+
+    def _url(self, ref, path):
+        scheme = "http" if ref.registry in self.insecure else "https"
+        return "{scheme}://{endpoint}/v2/{repository}/{path}".format(
+            scheme=scheme,
+            endpoint=ref.endpoint,
+            repository=ref.repository,
+            path=path,
+        )
+
+    def _request(self, method, ref, url, headers=None, **kwargs):
+        """
+        Perform a request against a registry, transparently obtaining a
+        bearer token when the registry asks for one and backing off when
+        its rate limit is exceeded.
+        """
+        limiter = self.limits.for_registry(ref.registry)
+        attempt = 0
+        while True:
+            with limiter.slot():
+                response = self._send(method, url, headers, **kwargs)
+            limiter.update(response.headers)
+            if response.status_code != 429 or attempt >= self.limits.retries:
+                break
+            delay = parse_retry_after(response.headers.get("Retry-After"))
+            if delay is None:
+                delay = self.limits.backoff(attempt)
+            self.logger.warning("Rate limited by {}, retrying in {:.1f}s".format(
+                ref.registry, delay))
+            limiter.back_off(delay)
+            attempt += 1
+        if response.status_code >= 400:
+            raise RegistryError("Request to {} failed with HTTP status {}".format(
+                url, response.status_code
+            ))
+        return response
+
+    def _send(self, method, url, headers=None, **kwargs):
+        import requests
+        headers = dict(headers or {})
+        try:
+            response = self.session.request(
+                method, url, headers=headers, timeout=self.timeout, **kwargs
+            )
+            if response.status_code == 401:
+                token = self._get_token(response.headers.get("WWW-Authenticate", ""))
+                headers["Authorization"] = "Bearer {}".format(token)
+                response = self.session.request(
+                    method, url, headers=headers, timeout=self.timeout, **kwargs
+                )
+        except requests.RequestException as e:
+            raise RegistryError("Request to {} failed: {!s}".format(url, e))
+        return response
+
+    def _get_token(self, challenge):
+        """
+        Obtain an anonymous bearer token as described by the given
+        `WWW-Authenticate` challenge.
+        """
+        if not challenge.lower().startswith("bearer "):
+            raise RegistryError("Unsupported authentication challenge: {}".format(challenge))
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if realm is None:
+            raise RegistryError("Authentication challenge without realm: {}".format(challenge))
+
+        key = (realm, params.get("service"), params.get("scope"))
+        token, expires = self._tokens.get(key, (None, 0))
+        if token is not None and expires > time.time():
+            return token
+
+        response = self.session.get(realm, params=params, timeout=self.timeout)
+        if response.status_code != 200:
+            raise RegistryError("Unable to obtain token from {}: HTTP status {}".format(
+                realm, response.status_code
+            ))
+        try:
+            data = response.json()
+        except ValueError:
+            raise RegistryError("Invalid token response from {}".format(realm))
+        token = data.get("token") or data.get("access_token")
+        if not token:
+            raise RegistryError("No token in response from {}".format(realm))
+        # Tokens are valid for 60 seconds unless the server says otherwise.
+        self._tokens[key] = (token, time.time() + int(data.get("expires_in", 60)) - 5)
+        return token
+
+    def manifest_digest(self, image):
+        """
+        Return the digest of the manifest the registry currently serves for
+        the given image, without downloading the manifest itself.
+
+        :param image:
+            The image name, in any form accepted by `parse_image_reference()`.
+        :returns:
+            The manifest digest, such as `sha256:...`.
+        :raises RegistryError:
+            When the registry could not be reached or didn't return a digest.
+        """
+        ref = parse_image_reference(image)
+        if ref.digest is not None:
+            return ref.digest
+
+        url = self._url(ref, "manifests/{}".format(ref.tag))
+        self.logger.debug("Requesting manifest digest from {}".format(url))
+        response = self._request(
+            "HEAD", ref, url, headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        )
+        digest = response.headers.get("Docker-Content-Digest")
+        if not digest:
+            raise RegistryError("Registry did not return a digest for {}".format(image))
+        return digest
+
+    def _get_json(self, ref, url):
+        response = self._request(
+            "GET", ref, url, headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        )
+        try:
+            return response, response.json()
+        except ValueError:
+            raise RegistryError("Invalid manifest returned by {}".format(url))
+
+    def _select_platform(self, manifests):
+        """
+        Pick the entry of a manifest list matching `self.platform`.
+        """
+        os_name, _, architecture = self.platform.partition("/")
+        for entry in manifests:
+            platform = entry.get("platform", {})
+            if platform.get("os") == os_name and platform.get("architecture") == architecture:
+                return entry
+        raise RegistryError("No manifest for platform {}".format(self.platform))
+
+    def manifest(self, image):
+        """
+        Download the manifest the registry currently serves for the given
+        image. For multi-platform images, the layers are those of the
+        manifest for `self.platform`.
+
+        :param image:
+            The image name, in any form accepted by `parse_image_reference()`.
+        :returns:
+            A `Manifest` instance.
+        :raises RegistryError:
+            When the registry could not be reached or returned an invalid
+            manifest.
+        """
+        ref = parse_image_reference(image)
+        url = self._url(ref, "manifests/{}".format(ref.digest or ref.tag))
+        self.logger.debug("Requesting manifest from {}".format(url))
+        response, data = self._get_json(ref, url)
+        digest = ref.digest or response.headers.get("Docker-Content-Digest")
+        if not digest:
+            raise RegistryError("Registry did not return a digest for {}".format(image))
+
+        if data.get("mediaType") in MANIFEST_LIST_MEDIA_TYPES or "manifests" in data:
+            entry = self._select_platform(data.get("manifests", []))
+            _, data = self._get_json(ref, self._url(ref, "manifests/{}".format(entry["digest"])))
+        return Manifest(digest=digest, layers=[
+            layer["digest"] for layer in data.get("layers", []) if "digest" in layer
+        ])
+
+    def tags(self, image):
+        """
+        List the tags of the repository of the given image, one page at a
+        time. The tags of each page are yielded as soon as it is received,
+        so callers can start processing a large repository before its last
+        page arrives.
+
+        Pages are cached in `tag_cache` and revalidated using their `ETag`,
+        so pages which haven't changed since they were last requested are
+        not downloaded again.
+
+        :param image:
+            The image name, in any form accepted by `parse_image_reference()`.
+            Its tag is ignored.
+        :returns:
+            An iterator over the tags, in the order the registry lists them.
+        :raises RegistryError:
+            When the registry could not be reached or returned an invalid
+            tag list.
+        """
+        ref = parse_image_reference(image)
+        url = self._url(ref, "tags/list?n={}".format(self.page_size))
+        while url is not None:
+            page = self._tag_page(ref, url)
+            for tag in page.tags:
+                yield tag
+            url = page.next
+
+    def _tag_page(self, ref, url):
+        """
+        Return a page of a tag list, from `tag_cache` when it is still valid.
+        """
+        cached = self.tag_cache.get(url)
+        headers = {"Accept": "application/json"}
+        if cached is not None:
+            headers["If-None-Match"] = cached.etag
+        self.logger.debug("Requesting tags from {}".format(url))
+        response = self._request("GET", ref, url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached
+
+        try:
+            tags = response.json().get("tags") or []
+        except (ValueError, AttributeError):
+            raise RegistryError("Invalid tag list returned by {}".format(url))
+        match = NEXT_LINK.search(response.headers.get("Link", ""))
+        page = TagPage(
+            url=url,
+            etag=response.headers.get("ETag"),
+            tags=tags,
+            next=urljoin(url, match.group(1)) if match else None,
+        )
+        if page.etag:
+            self.tag_cache.put(page)
+        return page
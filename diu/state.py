@@ -0,0 +1,176 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import attr
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image TEXT PRIMARY KEY,
+    local_id TEXT,
+    remote_digest TEXT,
+    checked_at REAL NOT NULL,
+    success INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS tag_pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    next TEXT
+)
+"""
+
+
+@attr.s
+class ImageState(object):
+    """
+    What is known about an image from previous runs.
+
+    :param image:
+        The name of the image.
+    :param local_id:
+        The ID of the local image after it was last checked.
+    :param remote_digest:
+        The manifest digest the registry returned when last checked, if known.
+    :param checked_at:
+        The time (in seconds since the epoch) of the last check.
+    :param success:
+        Whether the last check succeeded.
+    :param error:
+        A description of the error, if the last check failed.
+    """
+    image = attr.ib()
+    local_id = attr.ib(default=None)
+    remote_digest = attr.ib(default=None)
+    checked_at = attr.ib(default=0)
+    success = attr.ib(default=True)
+    error = attr.ib(default=None)
+
+
+def state_key(image, host=None):
+    """
+    Return the name under which the state of an image is stored, keeping
+    the states of the same image on different Docker hosts apart.
+    """
+    if host is None:
+        return image
+    return "{} {}".format(host, image)
+
+
+class StateStore(object):
+    """
+    A persistent store of image states, backed by an SQLite database.
+
+    The database is opened in WAL mode, so other processes can read it
+    while a run is writing to it. A single store may be shared between
+    threads.
+    """
+
+    def __init__(self, path, timeout=30):
+        """
+        :param path:
+            Path to the database file. Its directory is created when missing.
+        :param timeout:
+            Number of seconds to wait for a lock held by another process.
+        """
+        self.path = path
+        self.logger = logging.getLogger(self.__class__.__name__)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get(self, image):
+        """
+        Return the stored state of the given image.
+
+        :returns:
+            An `ImageState` instance, or None when the image was never checked.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT image, local_id, remote_digest, checked_at, success, error "
+                "FROM images WHERE image = ?",
+                (image,)
+            ).fetchone()
+        if row is None:
+            return None
+        return ImageState(
+            image=row[0],
+            local_id=row[1],
+            remote_digest=row[2],
+            checked_at=row[3],
+            success=bool(row[4]),
+            error=row[5],
+        )
+
+    def put(self, state):
+        """
+        Store the state of an image, replacing its previous state.
+
+        :param state:
+            An `ImageState` instance.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO images "
+                    "(image, local_id, remote_digest, checked_at, success, error) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (state.image, state.local_id, state.remote_digest, state.checked_at,
+                     int(state.success), state.error)
+                )
+
+    def is_fresh(self, image, ttl, now=None):
+        """
+        Check whether the given image was successfully checked less than
+        `ttl` seconds ago.
+        """
+        if not ttl:
+            return False
+        state = self.get(image)
+        if state is None or not state.success:
+            return False
+        if now is None:
+            now = time.time()
+        return now - state.checked_at < ttl
+
+    def get_tag_page(self, url):
+        """
+        Return a cached page of a tag list, see `diu.registry.TagCache`.
+
+        :returns:
+            A `(etag, tags, next)` tuple, or None when the page isn't cached.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, tags, next FROM tag_pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def put_tag_page(self, url, etag, tags, next):
+        """
+        Cache a page of a tag list, replacing the page previously cached
+        for `url`.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO tag_pages (url, etag, tags, next) "
+                    "VALUES (?, ?, ?, ?)",
+                    (url, etag, json.dumps(tags), next)
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
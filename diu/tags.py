@@ -0,0 +1,258 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import bisect
+import fnmatch
+import logging
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from diu.registry import RegistryError, parse_image_reference
+
+# Characters which can't appear in a Docker tag, and mark a tag as a pattern
+GLOB_CHARACTERS = "*?["
+RANGE_OPERATORS = "^~<>="
+
+VERSION = re.compile(r"^v?(\d+(?:\.\d+)*)(.*)$")
+CONSTRAINT = re.compile(r"^(\^|~|>=|<=|>|<|==|=)?v?(\d+(?:\.\d+)*)$")
+
+
+class NoMatchingTagError(Exception):
+    """
+    Raised when no tag of a repository matches a tag pattern.
+    """
+
+
+def is_tag_pattern(image):
+    """
+    Check whether the tag of an image is a pattern rather than a fixed tag,
+    such as `postgres:15.*` or `nginx:^1.24`.
+    """
+    ref = parse_image_reference(image)
+    if ref.digest is not None:
+        return False
+    return any(c in ref.tag for c in GLOB_CHARACTERS) or ref.tag[:1] in RANGE_OPERATORS
+
+
+def version_key(tag):
+    """
+    Return the key by which tags are ordered from oldest to newest.
+
+    Tags starting with a version number (optionally prefixed by `v`) are
+    ordered by that number, component by component, with releases such
+    as `15.4` ordered after variants such as `15.4-alpine` or `15.4-rc1`.
+    All other tags are ordered before those, alphabetically.
+    """
+    match = VERSION.match(tag)
+    if match is None:
+        return (0, (), 0, tag)
+    numbers = tuple(int(n) for n in match.group(1).split("."))
+    suffix = match.group(2)
+    return (1, numbers, 0 if suffix else 1, suffix)
+
+
+def _pad(numbers, length):
+    return numbers + (0,) * (length - len(numbers))
+
+
+def _compare(a, b):
+    length = max(len(a), len(b))
+    a, b = _pad(a, length), _pad(b, length)
+    return (a > b) - (a < b)
+
+
+class GlobPattern(object):
+    """
+    A tag pattern using shell-style wildcards, such as `15.*-alpine`.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._regex = re.compile(fnmatch.translate(pattern))
+        self.upper = None
+
+    def matches(self, tag):
+        return self._regex.match(tag) is not None
+
+
+class RangePattern(object):
+    """
+    A range of versions, such as `^1.24`, `~15.2` or `>=15,<17`.
+
+    Constraints are separated by commas or spaces and all of them have to
+    be satisfied. `^1.2` allows versions up to the next major version,
+    `~1.2` up to the next minor version. Only tags consisting of a version
+    number match, so `15.4` matches `>=15` but `15.4-alpine` doesn't.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.constraints = []  # List of (operator, numbers) tuples
+        for constraint in re.split(r"[,\s]+", pattern.strip()):
+            match = CONSTRAINT.match(constraint)
+            if match is None:
+                raise ValueError("Invalid version constraint '{}' in tag pattern '{}'".format(
+                    constraint, pattern))
+            operator = match.group(1) or "="
+            numbers = tuple(int(n) for n in match.group(2).split("."))
+            if operator == "^":
+                significant = next((i for i, n in enumerate(numbers) if n), len(numbers) - 1)
+                self.constraints.append((">=", numbers))
+                self.constraints.append(("<", self._bump(numbers, significant)))
+            elif operator == "~":
+                self.constraints.append((">=", numbers))
+                self.constraints.append(("<", self._bump(numbers, min(1, len(numbers) - 1))))
+            else:
+                self.constraints.append((operator.lstrip("="), numbers))
+
+        # The exclusive upper bound of matching versions, used to skip the
+        # newer tags in a `TagIndex`.
+        self.upper = None
+        for operator, numbers in self.constraints:
+            if operator in ("<", "<=", ""):
+                if operator != "<":
+                    numbers = self._bump(numbers, len(numbers) - 1)
+                if self.upper is None or _compare(numbers, self.upper) < 0:
+                    self.upper = numbers
+
+    @staticmethod
+    def _bump(numbers, position):
+        return numbers[:position] + (numbers[position] + 1,)
+
+    def matches(self, tag):
+        match = VERSION.match(tag)
+        if match is None or match.group(2):
+            return False
+        version = tuple(int(n) for n in match.group(1).split("."))
+        for operator, numbers in self.constraints:
+            result = _compare(version, numbers)
+            if operator == ">=" and result < 0 or operator == ">" and result <= 0 or \
+                    operator == "<=" and result > 0 or operator == "<" and result >= 0 or \
+                    operator == "" and result != 0:
+                return False
+        return True
+
+
+def parse_tag_pattern(pattern):
+    """
+    Parse the tag of an image watched by pattern.
+
+    :param pattern:
+        A shell-style wildcard pattern such as `15.*`, or a version range
+        such as `^1.24` or `>=15,<17`.
+    :returns:
+        A `GlobPattern` or `RangePattern` instance.
+    :raises ValueError:
+        When the pattern is invalid.
+    """
+    if pattern[:1] in RANGE_OPERATORS:
+        return RangePattern(pattern)
+    return GlobPattern(pattern)
+
+
+class TagIndex(object):
+    """
+    The tags of a repository, sorted by `version_key()` once so that any
+    number of patterns can be matched against them.
+    """
+
+    def __init__(self, tags):
+        """
+        :param tags:
+            An iterable of tags, such as returned by
+            `diu.registry.RegistryClient.tags()`.
+        """
+        entries = sorted((version_key(tag), tag) for tag in tags)
+        self._keys = [key for key, _ in entries]
+        self._tags = [tag for _, tag in entries]
+
+    def __len__(self):
+        return len(self._tags)
+
+    def newest(self, pattern):
+        """
+        Return the newest tag matching the given pattern.
+
+        :param pattern:
+            A pattern as returned by `parse_tag_pattern()`.
+        :returns:
+            The matching tag, or None when no tag matches.
+        """
+        end = len(self._tags)
+        if pattern.upper is not None:
+            end = bisect.bisect_left(self._keys, (1, pattern.upper))
+        for i in range(end - 1, -1, -1):
+            if pattern.matches(self._tags[i]):
+                return self._tags[i]
+        return None
+
+
+def resolve_tag(image, tag):
+    """
+    Return the name of the image watched by the pattern `image` at `tag`.
+    """
+    return "{}:{}".format(image.rsplit(":", 1)[0], tag)
+
+
+class TagResolver(object):
+    """
+    Resolves images watched by tag pattern, such as `postgres:15.*`, to
+    the newest tag of their repository matching the pattern.
+    """
+
+    def __init__(self, registry, concurrency=4):
+        """
+        :param registry:
+            The `diu.registry.RegistryClient` to list tags with.
+        :param concurrency:
+            The maximum number of repositories to list in parallel.
+        """
+        self.registry = registry
+        self.concurrency = concurrency
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def resolve(self, images):
+        """
+        Resolve the given images watched by pattern. The tags of every
+        repository are listed once, however many patterns refer to it.
+
+        :param images:
+            A list of images whose tag is a pattern.
+        :returns:
+            A dictionary mapping each image to the name of the image at
+            its newest matching tag, or to the exception which occurred
+            while resolving it.
+        """
+        repositories = OrderedDict()
+        for image in images:
+            ref = parse_image_reference(image)
+            repositories.setdefault((ref.registry, ref.repository), []).append(image)
+
+        resolved = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            for results in executor.map(self._resolve_repository, repositories.values()):
+                resolved.update(results)
+        return resolved
+
+    def _resolve_repository(self, images):
+        """
+        Resolve images watched by pattern which share a repository.
+        """
+        try:
+            index = TagIndex(self.registry.tags(images[0]))
+        except RegistryError as e:
+            self.logger.error("Unable to list tags of {}: {!s}".format(images[0], e))
+            return {image: e for image in images}
+        self.logger.debug("Listed {} tags of {}".format(len(index), images[0]))
+
+        resolved = {}
+        for image in images:
+            try:
+                tag = index.newest(parse_tag_pattern(parse_image_reference(image).tag))
+            except ValueError as e:
+                resolved[image] = e
+                continue
+            if tag is None:
+                resolved[image] = NoMatchingTagError("No tag matches {}".format(image))
+            else:
+                resolved[image] = resolve_tag(image, tag)
+        return resolved
@@ -0,0 +1,167 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer(object):
+    """
+    A tracer which records nothing, used when tracing is disabled.
+    """
+
+    def span(self, name, category="run", **args):
+        return _NULL_SPAN
+
+
+class Tracer(object):
+    """
+    Records how long each phase of a run takes, as spans which can be
+    written in the Chrome trace event format and opened in a timeline
+    viewer such as `chrome://tracing` or Perfetto.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        :param clock:
+            A function returning the current time in seconds.
+        """
+        self.clock = clock
+        self.events = []
+        self._lock = threading.Lock()
+        self._threads = {}  # Maps thread idents to (tid, name) tuples
+
+    def _tid(self):
+        thread = threading.current_thread()
+        with self._lock:
+            tid = self._threads.get(thread.ident)
+            if tid is None:
+                tid = self._threads[thread.ident] = (len(self._threads) + 1, thread.name)
+        return tid[0]
+
+    @contextlib.contextmanager
+    def span(self, name, category="run", **args):
+        """
+        A context manager recording the time spent in its block.
+
+        :param name:
+            The name of the span, e.g. `pull ubuntu:latest`.
+        :param category:
+            The kind of span, e.g. `image` or `command`.
+        :param args:
+            Additional details shown with the span.
+        """
+        tid = self._tid()
+        start = self.clock()
+        try:
+            yield
+        finally:
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int((self.clock() - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': tid,
+            }
+            if args:
+                event['args'] = dict((k, str(v)) for k, v in args.items())
+            with self._lock:
+                self.events.append(event)
+
+    def to_json(self):
+        """
+        Return the recorded spans in the Chrome trace event format.
+        """
+        with self._lock:
+            events = list(self.events)
+            threads = sorted(self._threads.values())
+        metadata = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': os.getpid(),
+            'tid': tid,
+            'args': {'name': name},
+        } for tid, name in threads]
+        return {'traceEvents': metadata + sorted(events, key=lambda e: e['ts']),
+                'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        """
+        Write the recorded spans to `path`, see `to_json()`.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f)
+
+
+class ThreadProfiler(object):
+    """
+    Profiles a call with cProfile, along with the threads it starts, such
+    as the worker threads pulling images. Each thread gets a profiler of
+    its own, and their statistics are merged once the call returns.
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self._lock = threading.Lock()
+        self._threads = []  # The profilers of the threads started during the call
+
+    def _profile_thread(self, frame, event, arg):
+        """
+        Installed by `threading.setprofile()`, so it runs first in every
+        new thread, where it replaces itself by the thread's profiler.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12, the profiler of the call covers all threads
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._threads.append(profile)
+
+    def runcall(self, func, *args, **kwargs):
+        """
+        Call `func` with the given arguments while profiling, returning
+        its result.
+        """
+        threading.setprofile(self._profile_thread)
+        try:
+            return self._profile.runcall(func, *args, **kwargs)
+        finally:
+            threading.setprofile(None)
+
+    def stats(self):
+        """
+        Return the statistics of the call and of all threads it started,
+        as a single `pstats.Stats` instance.
+        """
+        stats = pstats.Stats(self._profile)
+        with self._lock:
+            threads = list(self._threads)
+        for profile in threads:
+            stats.add(profile)
+        return stats
+
+    def dump_stats(self, path):
+        """
+        Write the statistics to `path`, for use with `python -m pstats`.
+        """
+        self.stats().dump_stats(path)
@@ -1,9 +1,33 @@
 from __future__ import print_function, absolute_import, unicode_literals, division
 import attr
 import logging
+import os
+import signal
 import subprocess
 import sys
-from docker.errors import APIError
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from diu.circuit import CircuitOpenError, is_registry_error, is_unavailable
+from diu.cleanup import ImageCollector
+from diu.metrics import Metrics
+from diu.progress import PullError, PullProgress, format_bytes, guard_stream
+from diu.ratelimit import RateLimits, is_rate_limited
+from diu.recreate import ContainerRecreator
+from diu.registry import Manifest, RegistryError, parse_image_reference
+from diu.state import ImageState, state_key
+from diu.tags import is_tag_pattern
+from diu.trace import NullTracer
+
+COMMAND_POLL_INTERVAL = 0.1
+
+# Run commands in a session of their own, so they can be signalled together
+# with any processes they start.
+if sys.version_info >= (3, 2):
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': os.setsid}
 
 
 @attr.s
@@ -16,11 +40,114 @@ class ContainerSet(object):
     :param name:
         A unique name for this watcher.
     :param images:
-        A list of Docker images to watch for updates.
+        A list of Docker images to watch for updates. The tag of an image
+        may be a pattern such as `15.*` or `^1.24`, to watch the newest
+        tag matching it, see `diu.tags`.
+    :param commands:
+        A list of commands to run when one of the images is updated, or
+        `recreate` actions recreating the containers using those images.
+    :param interval:
+        How often (in seconds) to check the images when running as a
+        daemon. Uses the daemon's default interval when None.
+    :param ttl:
+        How long (in seconds) a successful check of the images remains
+        valid across runs. Uses the updater's default TTL when None.
+    :param hosts:
+        The names of the Docker hosts to update this set on, when more than
+        one host is configured. All hosts are updated when None.
     """
     name = attr.ib()
     images = attr.ib(default=attr.Factory(list))
     commands = attr.ib(default=attr.Factory(list))
+    interval = attr.ib(default=None)
+    ttl = attr.ib(default=None)
+    hosts = attr.ib(default=None)
+
+
+@attr.s
+class ImageResult(object):
+    """
+    The outcome of updating a single image during a run.
+
+    :param image:
+        The name of the image.
+    :param updated:
+        Whether a newer version of the image was pulled.
+    :param error:
+        The exception which occurred while updating the image, if any.
+    :param skipped:
+        Whether the image wasn't checked because it was checked recently.
+    :param old_id:
+        The ID of the local image before updating, if it existed.
+    :param new_id:
+        The ID of the local image after updating.
+    :param remote_digest:
+        The manifest digest returned by the registry, if it was checked.
+    """
+    image = attr.ib()
+    updated = attr.ib(default=False)
+    error = attr.ib(default=None)
+    skipped = attr.ib(default=False)
+    old_id = attr.ib(default=None)
+    new_id = attr.ib(default=None)
+    remote_digest = attr.ib(default=None)
+
+
+@attr.s
+class ImageCheck(object):
+    """
+    The result of comparing a local image with its registry.
+
+    :param image:
+        The name of the image.
+    :param sets:
+        The names of the sets listing the image.
+    :param local_id:
+        The ID of the local image, or None when it doesn't exist locally.
+    :param local_digests:
+        The manifest digests of the local image.
+    :param remote_digest:
+        The manifest digest currently served by the registry.
+    :param stale:
+        Whether the registry serves a different version than the local one.
+    :param error:
+        The exception which occurred while checking the image, if any.
+    :param host:
+        The name of the Docker host the local image was inspected on, when
+        checking more than one host.
+    """
+    image = attr.ib()
+    sets = attr.ib(default=attr.Factory(list))
+    local_id = attr.ib(default=None)
+    local_digests = attr.ib(default=attr.Factory(list))
+    remote_digest = attr.ib(default=None)
+    stale = attr.ib(default=False)
+    error = attr.ib(default=None)
+    host = attr.ib(default=None)
+
+
+def local_digests(repo_digests):
+    """
+    Extract the manifest digests from the `RepoDigests` of a local image.
+    """
+    return [d.split("@", 1)[1] for d in repo_digests if "@" in d]
+
+
+@attr.s
+class DeduplicatedCommand(object):
+    """
+    Tracks a command marked with `dedupe` during a run.
+
+    :param command:
+        The command dictionary, as found in `ContainerSet.commands`.
+    :param pending:
+        The names of the sets listing the command which haven't finished yet.
+    :param triggered:
+        Whether any of the sets listing the command had images updated.
+    """
+    command = attr.ib()
+    pending = attr.ib(default=attr.Factory(set))
+    triggered = attr.ib(default=False)
 
 
 class Updater(object):
@@ -28,37 +155,236 @@ class Updater(object):
     The docker image updater.
     """
 
-    def __init__(self, client, containerset):
+    def __init__(self, client, containerset, registry=None, concurrency=1, state=None,
+                 state_ttl=0, command_timeout=None, command_kill_after=10,
+                 command_concurrency=1, progress_interval=10, metrics=None, host=None,
+                 share_layers=False, limits=None, breakers=None, pull_timeout=None,
+                 stall_timeout=None, collect_garbage=False, gc_concurrency=4, tracer=None,
+                 tags=None):
         """
         :param client:
             The Docker client to use (a docker.Client instance)
         :param containerset:
             A list of ContainerSet instances.
+        :param registry:
+            An optional `diu.registry.RegistryClient` instance. When given,
+            the digest of the local image is compared against the registry
+            before pulling and the pull is skipped if they are identical.
+        :param concurrency:
+            The maximum number of images to update in parallel.
+        :param state:
+            An optional `diu.state.StateStore` instance in which the outcome
+            of checking each image is recorded across runs.
+        :param state_ttl:
+            The number of seconds after a successful check during which an
+            image isn't checked again. Sets may override this with their
+            own `ttl`. Only used together with `state`.
+        :param command_timeout:
+            The default number of seconds after which commands are
+            terminated. Commands may run indefinitely when None.
+        :param command_kill_after:
+            The number of seconds to wait for a terminated command to exit
+            before killing it.
+        :param command_concurrency:
+            The maximum number of commands to run at the same time, across
+            all sets.
+        :param progress_interval:
+            The number of seconds between progress reports of a pull.
+        :param metrics:
+            The `diu.metrics.Metrics` instance to record metrics in. A new
+            instance is created when not supplied.
+        :param host:
+            The name of the Docker host `client` talks to, when updating
+            more than one host. Used in log messages and to keep the state
+            of each host's images apart.
+        :param share_layers:
+            Download the manifests of all outdated images before pulling
+            them in parallel, so that images sharing layers missing locally
+            wait for the pull that downloads those layers first. Requires
+            `registry`.
+        :param limits:
+            The `diu.ratelimit.RateLimits` limiting the pulls from each
+            registry, and retrying pulls which exceed a registry's rate
+            limit. Should be shared with `registry`.
+        :param breakers:
+            The `diu.circuit.CircuitBreakers` used to fail the images of a
+            registry immediately after it failed repeatedly. Images are
+            always tried when None.
+        :param pull_timeout:
+            The number of seconds after which a pull is aborted, or None.
+        :param stall_timeout:
+            The number of seconds after which a pull is aborted when the
+            Docker daemon sends no progress, or None.
+        :param collect_garbage:
+            Remove the images replaced by a pull at the end of every run,
+            unless containers still use them.
+        :param gc_concurrency:
+            The maximum number of images to remove in parallel.
+        :param tracer:
+            The `diu.trace.Tracer` to record the time spent on each set,
+            image and command in. Nothing is recorded when None.
+        :param tags:
+            The `diu.tags.TagResolver` to resolve images watched by tag
+            pattern with. Such images fail to update when None.
         """
         self.client = client
+        self.registry = registry
+        self.concurrency = concurrency
+        self.state = state
+        self.state_ttl = state_ttl
+        self.command_timeout = command_timeout
+        self.command_kill_after = command_kill_after
+        self.command_concurrency = command_concurrency
+        self.progress_interval = progress_interval
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._command_slots = threading.BoundedSemaphore(command_concurrency)
+        self._lock = threading.Lock()
+        self.host = host
+        self.share_layers = share_layers
+        self.limits = limits if limits is not None else RateLimits()
+        self.breakers = breakers
+        self.pull_timeout = pull_timeout
+        self.stall_timeout = stall_timeout
+        self.collect_garbage = collect_garbage
+        self.gc_concurrency = gc_concurrency
+        self.tracer = tracer if tracer is not None else NullTracer()
+        self.tags = tags
         self.containerset = {x.name: x for x in containerset}
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self._updated = []  # Tracks updated images
+        if host is None:
+            self.logger = logging.getLogger(self.__class__.__name__)
+        else:
+            self.logger = logging.getLogger("{}[{}]".format(self.__class__.__name__, host))
+        self._updated = []  # Tracks the images updated during the last run
+        self._results = {}  # Maps images to their ImageResult during a run
+        self._image_ids = {}  # Maps images to their IDs (before, after) during a run
+        self._remote_digests = {}  # Maps images to their registry digest during a run
+        self._known_layers = {}  # Maps manifest digests to their layers, across runs
+        self._ttls = {}  # Maps images to the TTL of their state during a run
+        self._deduplicated = {}  # Maps deduplicated commands to their DeduplicatedCommand
+        self._pulls = OrderedDict()  # Maps images to their PullProgress during a run
+        self._superseded = set()  # IDs of images replaced by a pull during a run
+        self._resolved = {}  # Maps images watched by pattern to the image they resolved to
+        self._patterns = {}  # Maps resolved images to the patterns resolving to them
+        self._previous_ids = {}  # Maps resolved images to the last ID recorded for their pattern
         self.error_count = 0
 
     def _pull_docker_image(self, image):
         """
-        Pull the given docker image, printing data to stdout to
-        keep the user informed of progress.
+        Pull the given docker image, logging aggregate progress at most
+        once every `progress_interval` seconds to keep the user informed.
+
+        Pulls are subject to the limits of the image's registry. A pull
+        which exceeds the registry's rate limit is retried after an
+        exponential backoff, holding back other pulls from that registry
+        in the meantime.
+
         :param image:
             The name of the image to pull down.
+        :raises PullError:
+            When the Docker daemon reports an error during the pull.
         """
+        from docker.errors import APIError
+        limiter = self.limits.for_registry(parse_image_reference(image).registry)
+        attempt = 0
+        while True:
+            try:
+                with limiter.slot():
+                    return self._pull_once(image)
+            except (PullError, APIError) as e:
+                if not is_rate_limited(e) or attempt >= self.limits.retries:
+                    raise
+                delay = self.limits.backoff(attempt)
+                self.logger.warning("Pull of {} was rate limited, retrying in {:.1f}s".format(
+                    image, delay))
+                self.metrics.inc('diu_rate_limited_total', registry=limiter.registry)
+                limiter.back_off(delay)
+                attempt += 1
+
+    def _pull_once(self, image):
         self.logger.info("Pulling image {}".format(image))
-        attached_to_tty = sys.stdout.isatty()
+        progress = PullProgress(image, interval=self.progress_interval, logger=self.logger)
+        self._pulls[image] = progress
+        try:
+            with self.tracer.span("pull " + image, "pull", image=image):
+                progress.consume(guard_stream(
+                    self.client.pull(image, stream=True),
+                    timeout=self.pull_timeout,
+                    stall_timeout=self.stall_timeout,
+                ))
+        finally:
+            self.metrics.observe('diu_pull_duration_seconds', progress.duration, image=image)
+            self.metrics.inc('diu_pull_bytes_total', progress.downloaded, image=image)
+        self.logger.info("Pulled image {}: {}".format(image, progress.summary()))
 
-        for _ in self.client.pull(image, stream=True):
-            if not attached_to_tty:
-                continue
-            sys.stdout.write('.')
-            sys.stdout.flush()
+    def _log_pull_summary(self):
+        """
+        Log the amount of data transferred by all pulls during this run.
+        """
+        if not self._pulls:
+            return
+        downloaded = sum(p.downloaded for p in self._pulls.values())
+        duration = sum(p.duration for p in self._pulls.values())
+        self.logger.info("Pulled {} images, {} in {:.1f}s of pulling".format(
+            len(self._pulls), format_bytes(downloaded), duration
+        ))
+        for image, progress in self._pulls.items():
+            self.logger.info("  {}: {}".format(image, progress.summary()))
+
+    def _remove_superseded(self):
+        """
+        Remove the images replaced during this run, see
+        `diu.cleanup.ImageCollector`.
+        """
+        if not self._superseded:
+            return
+        current = set(new for old, new in self._image_ids.values())
+        try:
+            with self.tracer.span("cleanup", "run"):
+                ImageCollector(
+                    self.client, self.gc_concurrency, metrics=self.metrics, logger=self.logger
+                ).collect(self._superseded, keep=current)
+        except Exception:
+            self.logger.exception("Unable to remove superseded images")
 
-        if attached_to_tty:
-            sys.stdout.write("\n")
+    def _log_quotas(self):
+        """
+        Log the rate limit quota last reported by each registry.
+        """
+        for registry, quota in sorted(self.limits.quotas().items()):
+            window = "" if quota.window is None else " per {}s".format(quota.window)
+            self.logger.info("Registry {}: {} of {} requests{} remaining".format(
+                registry, quota.remaining, quota.limit, window))
+            self.metrics.set('diu_registry_quota_remaining', quota.remaining, registry=registry)
+
+    def _is_up_to_date(self, image, repo_digests):
+        """
+        Check whether the local image matches the manifest digest currently
+        served by the registry.
+
+        :param image:
+            The name of the image to check.
+        :param repo_digests:
+            The `RepoDigests` of the local image, as returned by `inspect_image()`.
+        :returns:
+            True if the local image is known to be up-to-date, False if it
+            is outdated or this could not be determined.
+        """
+        if self.registry is None:
+            return False
+        try:
+            if image in self._remote_digests:
+                remote_digest = self._remote_digests[image]
+            else:
+                with self.tracer.span("registry " + image, "registry", image=image):
+                    remote_digest = self.registry.manifest_digest(image)
+        except RegistryError as e:
+            self.logger.warning(
+                "Unable to check registry for {}, falling back to pull: {!s}".format(image, e)
+            )
+            return False
+        self.logger.debug("Remote digest: {}".format(remote_digest))
+        self._remote_digests[image] = remote_digest
+        return remote_digest in local_digests(repo_digests)
 
     def _update_image(self, image):
         """
@@ -69,9 +395,15 @@ class Updater(object):
         :returns:
             True if the image is updated, False if it is already the latest version.
         """
+        from docker.errors import APIError
         try:
             self.logger.debug("Inspecting image {}".format(image))
-            image_id = self.client.inspect_image(image)['Id']
+            start = time.time()
+            with self.tracer.span("inspect " + image, "inspect", image=image):
+                inspect = self.client.inspect_image(image)
+            self.metrics.observe('diu_inspect_duration_seconds', time.time() - start, image=image)
+            image_id = inspect['Id']
+            repo_digests = inspect.get('RepoDigests') or []
             self.logger.debug("Image id: {}".format(image_id))
         except APIError as e:
             if e.response.status_code == 404:
@@ -83,72 +415,772 @@ class Updater(object):
             else:
                 raise
 
+        if image_id is not None and self._is_up_to_date(image, repo_digests):
+            self.logger.debug("Local image matches registry digest, skipping pull")
+            self._image_ids[image] = (image_id, image_id)
+            return False
+
         self._pull_docker_image(image)
-        self.logger.debug("New image id: {}".format(image_id))
-        if image_id != self.client.inspect_image(image)['Id']:
+        new_image_id = self.client.inspect_image(image)['Id']
+        self.logger.debug("New image id: {}".format(new_image_id))
+        self._image_ids[image] = (image_id, new_image_id)
+        if image_id != new_image_id:
             self.logger.debug("Image IDs differ before and after pull, image was updated")
             self._updated.append(image)
+            if image_id is not None:
+                with self._lock:
+                    self._superseded.add(image_id)
             return True
 
         self.logger.debug("Image IDs identical before and after pull")
         return False
 
-    def _update(self, watcher):
+    def _check_image(self, image):
+        """
+        Update the given docker image, unless it has already been checked
+        during this run.
+
+        :param image:
+            The image to update.
+        :returns:
+            An `ImageResult` instance.
+        """
+        result = self._results.get(image)
+        if result is not None:
+            return result
+
+        result = ImageResult(image=image)
+        if self.state is not None and \
+                self.state.is_fresh(self._state_key(image), self._ttls.get(image, self.state_ttl)):
+            self.logger.info("Image {} was checked recently, skipping".format(image))
+            result.skipped = True
+            self.metrics.inc('diu_image_checks_total', image=image, outcome='skipped')
+            self._record_state(result, patterns_only=True)
+            self._results[image] = result
+            return result
+
+        breaker = None
+        if self.breakers is not None:
+            breaker = self.breakers.for_registry(parse_image_reference(image).registry)
+        self.logger.info("Updating image {}".format(image))
+        try:
+            if breaker is not None:
+                breaker.allow()
+            with self.tracer.span("image " + image, "image", image=image):
+                result.updated = self._update_image(image)
+        except CircuitOpenError as e:
+            self.logger.error("Not updating {}: {!s}".format(image, e))
+            result.error = e
+            outcome = 'failed'
+        except Exception as e:
+            self.logger.exception("Exception occurred during update of {}".format(image))
+            result.error = e
+            outcome = 'failed'
+            if breaker is not None:
+                if not is_registry_error(e):
+                    breaker.record_skipped()
+                elif is_unavailable(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            if result.updated:
+                self.logger.info("Image {} updated to latest version".format(image))
+                outcome = 'updated'
+            else:
+                self.logger.info("Image {} already at latest version".format(image))
+                outcome = 'unchanged'
+        self.metrics.inc('diu_image_checks_total', image=image, outcome=outcome)
+        result.old_id, result.new_id = self._image_ids.get(image, (None, None))
+        result.remote_digest = self._remote_digests.get(image)
+        self._record_state(result)
+        self._results[image] = result
+        return result
+
+    def _state_key(self, image):
+        """
+        Return the name under which the state of an image is stored.
+        """
+        return state_key(image, self.host)
+
+    def _record_state(self, result, patterns_only=False):
+        """
+        Record the outcome of checking an image in the state store, for
+        the image itself and for the tag patterns it was resolved from.
+
+        :param result:
+            An `ImageResult` instance.
+        :param patterns_only:
+            Only record the outcome for the tag patterns.
+        """
+        if self.state is None:
+            return
+        images = list(self._patterns.get(result.image, []))
+        if not patterns_only:
+            images.insert(0, result.image)
+        for image in images:
+            try:
+                self.state.put(ImageState(
+                    image=self._state_key(image),
+                    local_id=result.new_id,
+                    remote_digest=result.remote_digest,
+                    checked_at=time.time(),
+                    success=result.error is None,
+                    error=None if result.error is None else str(result.error),
+                ))
+            except Exception:
+                self.logger.exception("Unable to record state of {}".format(image))
+
+    def _update(self, watcher, executor=None):
         """
         Update the containers configured by the supplied watcher and
         execute post-update actions as needed.
 
         :param watcher:
             An ContainerSet instance.
+        :param executor:
+            An optional executor to submit the commands of the set to,
+            rather than running them before returning.
         """
         updated = False
-        for image in watcher.images:
-            if image in self._updated:
-                updated = True
-                continue
-            try:
-                self.logger.info("Updating image {}".format(image))
-                updated_ = self._update_image(image)
-            except Exception:
-                self.logger.exception("Exception occurred during update of {}".format(image))
-                self.error_count += 1
-                continue
-            if updated_:
-                self.logger.info("Image {} updated to latest version".format(image))
-                updated = True
-            else:
-                self.logger.info("Image {} already at latest version".format(image))
+        with self.tracer.span("set " + watcher.name, "set", set=watcher.name):
+            for image in self._images(watcher):
+                result = self._check_image(image)
+                if result.error is not None:
+                    self.logger.error("Image {} in set {} failed to update".format(
+                        image, watcher.name
+                    ))
+                    self.metrics.inc('diu_image_failures_total', set=watcher.name, image=image)
+                    self._count_error()
+                elif result.updated:
+                    self.metrics.inc('diu_images_updated_total', set=watcher.name, image=image)
+                    updated = True
 
         if not updated:
             self.logger.debug("No images in this set updated")
+            self._finish_set(watcher, executor=executor)
             return
 
         self.logger.debug("One or more images in this set updated")
-        for command in watcher.commands:
-            try:
-                self._run_command(command)
-            except Exception:
-                self.logger.exception("Exception occurred during command execution")
-                self.error_count += 1
-                continue
+        if executor is not None:
+            executor.submit(self._run_set_commands, watcher)
+        else:
+            self._run_set_commands(watcher)
+
+    def _count_error(self):
+        """
+        Increment the error count. Safe to call from any thread.
+        """
+        with self._lock:
+            self.error_count += 1
+
+    def _run_commands(self, commands, name=""):
+        """
+        Run the given commands sequentially.
+
+        :param commands:
+            A list of command entries, as found in `ContainerSet.commands`.
+            Each is either a shell command, a dictionary with the shell
+            command under `run` and an optional `timeout` and `dedupe`, a
+            dictionary with the options of a `recreate` action (see
+            `_recreate_containers()`), or a dictionary with a list of
+            command entries to run in parallel under `parallel`. Commands
+            with `dedupe` set are deferred, see `_defer_command()`.
+        :param name:
+            The name of the set the commands belong to.
+        """
+        for command in commands:
+            if isinstance(command, dict) and 'parallel' in command:
+                self._run_parallel_commands(command['parallel'], name)
+            elif isinstance(command, dict) and command.get('dedupe'):
+                self._defer_command(command, name)
+            else:
+                self._execute_command(command, name)
+
+    def _execute_command(self, command, name=""):
+        """
+        Run a single command entry, counting any exception as an error.
+
+        :param command:
+            A shell command, a dictionary with `run` and optional `timeout`,
+            or a dictionary with `recreate`.
+        :param name:
+            The name of the set the command belongs to.
+        """
+        start = time.time()
+        status = 'error'
+        try:
+            if isinstance(command, dict) and 'recreate' in command:
+                returncode = self._recreate_containers(command['recreate'], name)
+            elif not isinstance(command, dict):
+                returncode = self._run_command(command)
+            elif 'timeout' in command:
+                returncode = self._run_command(command['run'], timeout=command['timeout'])
+            else:
+                returncode = self._run_command(command['run'])
+            if returncode is None:
+                status = 'timeout'
+            else:
+                status = 'success' if returncode == 0 else 'failure'
+        except Exception:
+            self.logger.exception("Exception occurred during command execution")
+            self._count_error()
+        finally:
+            self.metrics.observe('diu_command_duration_seconds', time.time() - start, set=name)
+            self.metrics.inc('diu_commands_total', set=name, status=status)
+
+    def _register_deduplicated_commands(self, watchers):
+        """
+        Find the commands marked with `dedupe` in the given sets and record
+        which sets list each of them.
+
+        :param watchers:
+            The ContainerSet instances taking part in this run.
+        """
+        self._deduplicated = {}
+
+        def register(name, commands):
+            for command in commands:
+                if isinstance(command, dict) and 'parallel' in command:
+                    register(name, command['parallel'])
+                elif isinstance(command, dict) and command.get('dedupe'):
+                    entry = self._deduplicated.setdefault(
+                        command['run'], DeduplicatedCommand(command=command)
+                    )
+                    entry.pending.add(name)
+
+        for watcher in watchers:
+            register(watcher.name, watcher.commands)
+
+    def _defer_command(self, command, name=""):
+        """
+        Mark a deduplicated command as triggered, so it runs once all of the
+        sets listing it have finished.
+
+        :param command:
+            A command dictionary with `dedupe` set.
+        :param name:
+            The name of the set triggering the command.
+        """
+        with self._lock:
+            entry = self._deduplicated.get(command['run'])
+            if entry is not None:
+                self.logger.debug("Deferring command: {}".format(command['run']))
+                entry.triggered = True
+                return
+        # Not part of a planned run, so there's nothing to wait for.
+        self._execute_command(command, name)
+
+    def _finish_set(self, watcher, executor=None):
+        """
+        Record that a set has finished, running the deduplicated commands
+        that were waiting for it when it was the last set they were
+        waiting for.
+
+        :param watcher:
+            The ContainerSet instance that finished.
+        :param executor:
+            An optional executor to submit the ready commands to, rather
+            than running them before returning.
+        """
+        ready = []
+        with self._lock:
+            for entry in self._deduplicated.values():
+                if watcher.name not in entry.pending:
+                    continue
+                entry.pending.discard(watcher.name)
+                if not entry.pending and entry.triggered:
+                    ready.append(entry.command)
+        for command in ready:
+            if executor is not None:
+                executor.submit(self._execute_command, command, watcher.name)
+            else:
+                self._execute_command(command, watcher.name)
+
+    def _run_set_commands(self, watcher):
+        """
+        Run the commands of a set that had one or more images updated.
+
+        :param watcher:
+            An ContainerSet instance.
+        """
+        with self.tracer.span("commands " + watcher.name, "set", set=watcher.name):
+            self._run_commands(watcher.commands, watcher.name)
+        self._finish_set(watcher)
+
+    def _run_parallel_commands(self, commands, name=""):
+        """
+        Run the given commands in parallel, waiting for all of them to finish.
+
+        :param commands:
+            A list of command entries, see `_run_commands()`.
+        :param name:
+            The name of the set the commands belong to.
+        """
+        if not commands:
+            return
+        with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            for command in commands:
+                executor.submit(self._run_commands, [command], name)
+
+    def _recreate_containers(self, options, name=""):
+        """
+        Recreate the running containers which use an image of the given set
+        which was updated during this run, see `diu.recreate.ContainerRecreator`.
+
+        :param options:
+            True, or a dictionary with the optional keys `containers` (name
+            patterns of the containers to recreate), `concurrency`,
+            `stop_timeout`, `wait_healthy` and `health_timeout`.
+        :param name:
+            The name of the set the action belongs to.
+        :returns:
+            0 when all containers were recreated, 1 otherwise.
+        """
+        if not isinstance(options, dict):
+            options = {}
+        watcher = self.containerset.get(name)
+        images = {}  # Maps outdated image IDs to the image replacing them
+        for image in self._images(watcher) if watcher is not None else []:
+            old_id, new_id = self._image_ids.get(image, (None, None))
+            for image_id in (old_id, self._previous_ids.get(image)):
+                if image_id is not None and image_id != new_id:
+                    images[image_id] = image
+        if not images:
+            self.logger.debug("No updated images to recreate containers of")
+            return 0
 
-    def _run_command(self, command):
+        recreator = ContainerRecreator(
+            self.client,
+            concurrency=options.get('concurrency', 1),
+            stop_timeout=options.get('stop_timeout'),
+            wait_healthy=options.get('wait_healthy', False),
+            health_timeout=options.get('health_timeout', 60),
+            metrics=self.metrics,
+            logger=self.logger,
+        )
+        with self._command_slots, self.tracer.span("recreate " + name, "command", set=name):
+            result = recreator.recreate(images, names=options.get('containers'))
+        if result.failed:
+            self.logger.error("Unable to recreate {} of {} containers".format(
+                len(result.failed), len(result.failed) + len(result.recreated)))
+            self._count_error()
+            return 1
+        return 0
+
+    def _run_command(self, command, timeout=None):
         """
         Run given command in a shell.
+
+        The command is terminated when it runs for longer than `timeout`
+        seconds, and killed when it still hasn't exited `command_kill_after`
+        seconds after that.
+
+        :param command:
+            The shell command to run.
+        :param timeout:
+            The timeout in seconds. Uses `command_timeout` when None.
+        :returns:
+            The exit code of the command, or None when it timed out.
         """
-        self.logger.info("Running command: {}".format(command))
-        p = subprocess.Popen(command, shell=True)
-        returncode = p.wait()
-        if returncode == 0:
+        if timeout is None:
+            timeout = self.command_timeout
+        with self._command_slots, self.tracer.span("command", "command", command=command):
+            self.logger.info("Running command: {}".format(command))
+            p = subprocess.Popen(command, shell=True, **NEW_SESSION)
+            returncode = self._wait_for_command(p, timeout)
+        if returncode is None:
+            self.logger.error("Command timed out after {} seconds: {}".format(timeout, command))
+            self._count_error()
+        elif returncode == 0:
             self.logger.info("Command exited successfully")
         else:
             self.logger.error("Command exited with non-zero exit code {}".format(returncode))
-            self.error_count += 1
+            self._count_error()
+        return returncode
+
+    def _wait_for_command(self, p, timeout):
+        """
+        Wait for a command to exit, terminating it when it exceeds the timeout.
+
+        :param p:
+            The `subprocess.Popen` instance of the command.
+        :param timeout:
+            The timeout in seconds, or None to wait indefinitely.
+        :returns:
+            The exit code of the command, or None when it timed out.
+        """
+        if timeout is None:
+            return p.wait()
+
+        deadline = time.time() + timeout
+        while p.poll() is None:
+            if time.time() >= deadline:
+                break
+            time.sleep(COMMAND_POLL_INTERVAL)
+        else:
+            return p.returncode
+
+        self.logger.warning("Command timed out, terminating it")
+        self._signal_command(p, signal.SIGTERM)
+        deadline = time.time() + self.command_kill_after
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(COMMAND_POLL_INTERVAL)
+        if p.poll() is None:
+            self.logger.warning("Command did not exit after being terminated, killing it")
+            self._signal_command(p, signal.SIGKILL)
+            p.wait()
+        return None
+
+    def _signal_command(self, p, signum):
+        """
+        Send a signal to the process group of a command, so the shell as
+        well as the processes it started receive it.
+        """
+        try:
+            os.killpg(p.pid, signum)
+        except OSError:
+            pass  # Already exited
+
+    def _images(self, watcher):
+        """
+        Return the images of a set, with the images watched by tag pattern
+        replaced by the images they were resolved to during this run.
+        """
+        return [self._resolved.get(image, image) for image in watcher.images]
+
+    def _resolve_patterns(self, watchers, use_state=True):
+        """
+        Resolve the images watched by tag pattern in the given sets to the
+        newest tag matching their pattern, see `diu.tags.TagResolver`.
+
+        Patterns which were checked recently aren't resolved, and neither
+        are patterns which couldn't be resolved. Their outcome is recorded
+        in `_results` right away, so their sets are updated as usual.
+
+        :param watchers:
+            A list of ContainerSet instances.
+        :param use_state:
+            Skip patterns which were checked within their TTL.
+        """
+        self._resolved = {}
+        self._patterns = {}
+        self._previous_ids = {}
+        patterns = OrderedDict()  # Maps patterns to their TTL
+        for watcher in watchers:
+            ttl = self.state_ttl if watcher.ttl is None else watcher.ttl
+            for image in watcher.images:
+                if is_tag_pattern(image):
+                    patterns[image] = min(patterns.get(image, ttl), ttl)
+
+        pending = []
+        for image, ttl in patterns.items():
+            if use_state and self.state is not None and \
+                    self.state.is_fresh(self._state_key(image), ttl):
+                self.logger.info("Image {} was checked recently, skipping".format(image))
+                self._results[image] = ImageResult(image=image, skipped=True)
+                self.metrics.inc('diu_image_checks_total', image=image, outcome='skipped')
+            else:
+                pending.append(image)
+        if not pending:
+            return
+
+        if self.tags is None:
+            resolved = {image: ValueError("Unable to resolve tag patterns without a registry")
+                        for image in pending}
+        else:
+            with self.tracer.span("tags", "registry", patterns=len(pending)):
+                resolved = self.tags.resolve(pending)
+        for image in pending:
+            outcome = resolved[image]
+            if isinstance(outcome, Exception):
+                self.logger.error("Unable to resolve {}: {!s}".format(image, outcome))
+                self._results[image] = ImageResult(image=image, error=outcome)
+                self.metrics.inc('diu_image_checks_total', image=image, outcome='failed')
+                self._record_state(self._results[image])
+            else:
+                self.logger.info("Resolved {} to {}".format(image, outcome))
+                self._resolved[image] = outcome
+                self._patterns.setdefault(outcome, []).append(image)
+                previous = self.state.get(self._state_key(image)) if self.state else None
+                if previous is not None and previous.local_id is not None:
+                    self._previous_ids[outcome] = previous.local_id
 
-    def do_updates(self):
+    def _plan(self, watchers):
+        """
+        Build an index of all unique images across the given sets, after
+        `_resolve_patterns()`.
+
+        :param watchers:
+            A list of ContainerSet instances.
+        :returns:
+            An `OrderedDict` mapping each image to the names of the sets
+            listing it, in the order in which images are first encountered.
+        """
+        plan = OrderedDict()
+        for watcher in watchers:
+            for image in self._images(watcher):
+                names = plan.setdefault(image, [])
+                if watcher.name not in names:
+                    names.append(watcher.name)
+        return plan
+
+    def _fetch_manifest(self, image):
+        """
+        Check an image against the registry, downloading its manifest only
+        when the local image is missing or outdated.
+
+        :returns:
+            A `(manifest, digests)` tuple of the `Manifest` of the image (or
+            None when the image is up-to-date or couldn't be checked) and
+            the manifest digests of the local image.
+        """
+        from docker.errors import APIError
+        try:
+            digests = local_digests(self.client.inspect_image(image).get('RepoDigests') or [])
+        except APIError:
+            digests = []
+        except Exception as e:
+            self.logger.debug("Unable to inspect image {}: {!s}".format(image, e))
+            return None, []
+        try:
+            digest = self.registry.manifest_digest(image)
+            self._remote_digests[image] = digest
+            if digest in digests:
+                return None, digests
+            if digest in self._known_layers:
+                return Manifest(digest=digest, layers=self._known_layers[digest]), digests
+            return self.registry.manifest(image), digests
+        except RegistryError as e:
+            self.logger.debug("Unable to download manifest of {}: {!s}".format(image, e))
+            return None, digests
+
+    def _layer_dependencies(self, plan):
+        """
+        Work out which pulls should wait for others, so that every layer
+        shared between images is downloaded by a single pull.
+
+        Only the manifests of outdated images are downloaded, after a HEAD
+        request for the digest of each image. Layers of the manifests the
+        updater downloaded before, which the local images still use, are
+        known to exist locally and aren't considered.
+
+        Images are ordered by the number of their missing layers which are
+        shared with other images, most first. Each shared layer is then
+        assigned to the first image needing it, and every other image
+        needing that layer waits for the pull of that image. Images which
+        don't share missing layers (or whose manifest couldn't be
+        downloaded) wait for nothing.
+
+        :param plan:
+            The image index as returned by `_plan()`.
+        :returns:
+            A dictionary mapping each image to the set of images to wait for.
+        """
+        dependencies = {image: set() for image in plan}
+        images = [
+            image for image in plan if image not in self._results and (
+                self.state is None or
+                not self.state.is_fresh(self._state_key(image),
+                                        self._ttls.get(image, self.state_ttl)))
+        ]
+        with self.tracer.span("manifests", "registry"), \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            checks = dict(zip(images, executor.map(self._fetch_manifest, images)))
+
+        known_layers = {}
+        for manifest, digests in checks.values():
+            for digest in digests:
+                if digest in self._known_layers:
+                    known_layers[digest] = self._known_layers[digest]
+            if manifest is not None:
+                known_layers[manifest.digest] = manifest.layers
+        local = set()
+        for _, digests in checks.values():
+            for digest in digests:
+                local.update(known_layers.get(digest, ()))
+        # Only keeps the layers of manifests which are still in use
+        self._known_layers = known_layers
+
+        layers = {}
+        users = {}  # Maps layers to the number of images using them
+        for image, (manifest, _) in checks.items():
+            if manifest is None:
+                continue
+            layers[image] = set(manifest.layers) - local
+            for layer in layers[image]:
+                users[layer] = users.get(layer, 0) + 1
+
+        shared = {image: [layer for layer in layers[image] if users[layer] > 1] for image in layers}
+        position = {image: i for i, image in enumerate(plan)}
+        owners = {}  # Maps shared layers to the image downloading them
+        for image in sorted(shared, key=lambda image: (-len(shared[image]), position[image])):
+            for layer in shared[image]:
+                owner = owners.setdefault(layer, image)
+                if owner != image:
+                    dependencies[image].add(owner)
+
+        waiting = sum(1 for deps in dependencies.values() if deps)
+        if waiting:
+            self.logger.info("{} of {} images share layers with an earlier pull".format(
+                waiting, len(plan)
+            ))
+        return dependencies
+
+    def _do_concurrent_updates(self, watchers, plan):
+        """
+        Update the watched images using a pool of worker threads.
+
+        Images are pulled in parallel and the commands of a set are started
+        as soon as all of the images in that set have been updated. Commands
+        of up to `command_concurrency` sets run at the same time. With
+        `share_layers`, images sharing layers with another image are only
+        pulled once that image has been, see `_layer_dependencies()`.
+
+        :param watchers:
+            The ContainerSet instances to update.
+        :param plan:
+            The image index as returned by `_plan()`.
+        """
+        remaining = {watcher.name: 0 for watcher in watchers}
+        for names in plan.values():
+            for name in names:
+                remaining[name] += 1
+
+        if self.share_layers and self.registry is not None:
+            dependencies = self._layer_dependencies(plan)
+        else:
+            dependencies = {image: set() for image in plan}
+        dependents = {image: [] for image in plan}
+        for image, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].append(image)
+
+        with ThreadPoolExecutor(max_workers=self.command_concurrency) as command_executor:
+            for watcher in watchers:
+                if remaining[watcher.name] == 0:
+                    self._update(watcher, executor=command_executor)
+
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = {
+                    executor.submit(self._check_image, image): image
+                    for image in plan if not dependencies[image]
+                }
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for image in [futures.pop(future) for future in done]:
+                        for dependent in dependents[image]:
+                            dependencies[dependent].discard(image)
+                            if not dependencies[dependent]:
+                                futures[executor.submit(self._check_image, dependent)] = dependent
+                        for name in plan[image]:
+                            remaining[name] -= 1
+                            if remaining[name] == 0:
+                                self.logger.info("Checking images in set {}".format(name))
+                                self._update(self.containerset[name], executor=command_executor)
+
+    def _compare_image(self, image, sets):
+        """
+        Compare a local image with the registry, without pulling it.
+
+        :returns:
+            An `ImageCheck` instance.
+        """
+        from docker.errors import APIError
+        check = ImageCheck(image=image, sets=list(sets), host=self.host)
+        if image in self._results:
+            check.error = self._results[image].error
+            return check
+        try:
+            try:
+                inspect = self.client.inspect_image(image)
+            except APIError as e:
+                if e.response.status_code != 404:
+                    raise
+                self.logger.debug("Image {} does not exist locally".format(image))
+            else:
+                check.local_id = inspect['Id']
+                check.local_digests = local_digests(inspect.get('RepoDigests') or [])
+            check.remote_digest = self.registry.manifest_digest(image)
+        except Exception as e:
+            self.logger.error("Unable to check image {}: {!s}".format(image, e))
+            check.error = e
+            return check
+        check.stale = check.remote_digest not in check.local_digests
+        if check.stale:
+            self.logger.info("Image {} is out of date".format(image))
+        return check
+
+    def check_images(self, names=None, concurrency=10):
+        """
+        Compare the local and remote digests of the watched images, without
+        pulling images or running commands. Requires a registry client.
+
+        :param names:
+            The names of the sets to check. All sets are checked when None.
+        :param concurrency:
+            The number of images to check in parallel.
+        :returns:
+            A list of `ImageCheck` instances, one for every unique image in
+            the order in which they're first listed.
+        """
+        if names is None:
+            watchers = list(self.containerset.values())
+        else:
+            watchers = [self.containerset[name] for name in names]
+        self._results = {}
+        self._resolve_patterns(watchers, use_state=False)
+        plan = self._plan(watchers)
+        self.logger.debug("Comparing {} unique images across {} sets".format(
+            len(plan), len(watchers)
+        ))
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            return list(executor.map(self._compare_image, plan.keys(), plan.values()))
+
+    def do_updates(self, names=None):
         """
         Update the watched images.
+
+        Every unique image is checked exactly once, after which the
+        outcome is applied to each set listing that image.
+
+        :param names:
+            The names of the sets to update. All sets are updated when None.
         """
-        for watcher in self.containerset.values():
-            self.logger.info("Checking images in set {}".format(watcher.name))
-            self._update(watcher)
+        if names is None:
+            watchers = list(self.containerset.values())
+        else:
+            watchers = [self.containerset[name] for name in names]
+
+        self._updated = []
+        self._results = {}
+        self._image_ids = {}
+        self._remote_digests = {}
+        self._pulls = OrderedDict()
+        self._superseded = set()
+        self._resolve_patterns(watchers)
+        plan = self._plan(watchers)
+        self._register_deduplicated_commands(watchers)
+        self._ttls = {}
+        for image, names in plan.items():
+            ttls = [self.containerset[name].ttl for name in names]
+            self._ttls[image] = min(self.state_ttl if ttl is None else ttl for ttl in ttls)
+        self.logger.debug("Checking {} unique images across {} sets".format(
+            len(plan), len(watchers)
+        ))
+
+        with self.tracer.span("update", "run", host=self.host, sets=len(watchers)):
+            if self.concurrency > 1:
+                self._do_concurrent_updates(watchers, plan)
+            else:
+                for watcher in watchers:
+                    self.logger.info("Checking images in set {}".format(watcher.name))
+                    self._update(watcher)
+        self._log_pull_summary()
+        self._log_quotas()
+        if self.collect_garbage:
+            self._remove_superseded()
+        self.metrics.set('diu_error_count', self.error_count)
+        self.metrics.set('diu_last_run_timestamp_seconds', time.time())
@@ -0,0 +1,206 @@
+from __future__ import print_function, absolute_import, unicode_literals, division
+import json
+import logging
+import threading
+from diu.registry import parse_image_reference
+from diu.tags import is_tag_pattern, parse_tag_pattern
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def parse_notification(payload):
+    """
+    Extract the pushed images from a registry push notification.
+
+    Both the Docker Hub webhook format and the registry v2 notification
+    envelope format are understood.
+
+    :param payload:
+        The decoded JSON body of the notification.
+    :returns:
+        A list of `(repository, tag)` tuples, with the repository named the
+        same way as by `diu.registry.parse_image_reference()`. Only Docker
+        Hub repositories get the `library/` prefix of official images.
+    :raises ValueError:
+        When the payload isn't in a recognized format.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Notification should be a JSON object")
+
+    pushed = []
+    if 'events' in payload:
+        # Registry v2 notification envelope. The repository is named as on
+        # the registry sending it, which needn't be Docker Hub.
+        for event in payload['events']:
+            if event.get('action') != 'push':
+                continue
+            target = event.get('target', {})
+            if 'repository' in target and target.get('tag'):
+                pushed.append((target['repository'], target['tag']))
+    elif 'repository' in payload and 'push_data' in payload:
+        # Docker Hub webhook
+        ref = parse_image_reference("{}:{}".format(
+            payload['repository']['repo_name'],
+            payload['push_data'].get('tag') or 'latest',
+        ))
+        pushed.append((ref.repository, ref.tag))
+    else:
+        raise ValueError("Unrecognized notification format")
+    return pushed
+
+
+def build_image_index(containerset):
+    """
+    Build a reverse index from images to the sets which list them.
+
+    Images are keyed by repository and tag only: a push notification
+    doesn't reliably name the registry by the same hostname that is used
+    in the configuration. Images watched by tag pattern are left out, see
+    `build_pattern_index()`.
+
+    :param containerset:
+        An iterable of ContainerSet instances.
+    :returns:
+        A dictionary mapping `(repository, tag)` tuples to sets of names.
+    """
+    index = {}
+    for watcher in containerset:
+        for image in watcher.images:
+            if is_tag_pattern(image):
+                continue
+            ref = parse_image_reference(image)
+            index.setdefault((ref.repository, ref.tag), set()).add(watcher.name)
+    return index
+
+
+def build_pattern_index(containerset):
+    """
+    Build a reverse index from images watched by tag pattern, such as
+    `postgres:15.*`, to the sets which list them. Images with an invalid
+    pattern are left out.
+
+    :param containerset:
+        An iterable of ContainerSet instances.
+    :returns:
+        A dictionary mapping repositories to lists of `(pattern, names)`
+        tuples, with patterns as returned by `parse_tag_pattern()`.
+    """
+    index = {}
+    for watcher in containerset:
+        for image in watcher.images:
+            if not is_tag_pattern(image):
+                continue
+            ref = parse_image_reference(image)
+            patterns = index.setdefault(ref.repository, {})
+            if ref.tag not in patterns:
+                try:
+                    patterns[ref.tag] = (parse_tag_pattern(ref.tag), set())
+                except ValueError:
+                    continue
+            patterns[ref.tag][1].add(watcher.name)
+    return {repository: list(patterns.values()) for repository, patterns in index.items()}
+
+
+def matching_sets(pushed, index, patterns):
+    """
+    Return the names of the sets listing any of the pushed images, by
+    their tag or by a tag pattern matching it.
+
+    :param pushed:
+        A list of `(repository, tag)` tuples, as returned by
+        `parse_notification()`.
+    :param index:
+        The index returned by `build_image_index()`.
+    :param patterns:
+        The index returned by `build_pattern_index()`.
+    :returns:
+        A set of names.
+    """
+    names = set()
+    for repository, tag in pushed:
+        names.update(index.get((repository, tag), ()))
+        for pattern, pattern_names in patterns.get(repository, ()):
+            if pattern.matches(tag):
+                names.update(pattern_names)
+    return names
+
+
+class WebhookServer(object):
+    """
+    An HTTP server accepting registry push notifications.
+
+    Every notification is decoded with `parse_notification()` and the
+    pushed images are passed to `callback`, from the server's own thread.
+    """
+
+    def __init__(self, address, callback, token=None):
+        """
+        :param address:
+            A `(host, port)` tuple to listen on.
+        :param callback:
+            A function which is called with the list of pushed
+            `(repository, tag)` tuples of each notification.
+        :param token:
+            When given, notifications are only accepted when posted to
+            `/<token>`.
+        """
+        self.callback = callback
+        self.token = token
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.server = HTTPServer(address, self._create_handler())
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def _create_handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                webhook.logger.debug(format % args)
+
+            def _respond(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                if webhook.token is not None and \
+                        self.path.split("?")[0].strip("/") != webhook.token:
+                    return self._respond(404)
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    payload = json.loads(self.rfile.read(length).decode("utf-8"))
+                    pushed = parse_notification(payload)
+                except (ValueError, KeyError, TypeError) as e:
+                    webhook.logger.warning("Ignoring invalid notification: {!s}".format(e))
+                    return self._respond(400)
+                webhook.logger.info("Received push notification for {}".format(
+                    ", ".join("{}:{}".format(*p) for p in pushed) or "nothing"
+                ))
+                if pushed:
+                    webhook.callback(pushed)
+                self._respond(202)
+
+        return Handler
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name="webhook")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("Listening for push notifications on {}:{}".format(*self.address))
+
+    def stop(self):
+        """
+        Stop serving requests.
+        """
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,200 @@
+"""
+A stand-in for the Docker daemon's HTTP API, listening on a unix socket
+(or on a TCP port on localhost).
+
+It simulates inspect latency, missing images, multi-layer pull streams of
+configurable size and speed and images changing ID when pulled. Used by the
+tests and by the benchmarks in `benchmarks/`.
+"""
+import json
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+MEGABYTE = 1000 * 1000
+
+
+class FakeDocker(object):
+    """
+    Serves the subset of the Docker API used by the updater.
+
+    `images` maps image names (as given to `docker pull`) to their local
+    inspect data. Pulling an image whose name is in `remote` replaces its
+    local inspect data with the remote one, pulling any other image
+    streams an error.
+
+    :param inspect_latency:
+        Seconds to wait before answering an image inspection.
+    :param layers:
+        The number of layers in each pulled image.
+    :param layer_size:
+        The size of each layer in bytes.
+    :param speed:
+        Download speed in bytes per second shared by all layers of a pull,
+        or None to stream the whole pull without delay.
+    :param progress_events:
+        The number of `Downloading` and `Extracting` events sent per layer.
+    :param tcp:
+        Listen on a random TCP port on localhost instead of a unix socket.
+    """
+
+    def __init__(self, inspect_latency=0, layers=3, layer_size=MEGABYTE, speed=None,
+                 progress_events=5, tcp=False):
+        self.images = {}
+        self.remote = {}
+        self.requests = []
+        self.inspect_latency = inspect_latency
+        self.layers = layers
+        self.layer_size = layer_size
+        self.speed = speed
+        self.progress_events = progress_events
+        self.directory = None
+        self.socket = None
+        self._lock = threading.Lock()
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def address_string(self):
+                return "fakedocker"
+
+            def _send_json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_chunk(self, data):
+                self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _handle(self):
+                url = urlparse(self.path)
+                path = re.sub(r"^/v[0-9.]+", "", url.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with daemon._lock:
+                    daemon.requests.append((self.command, path, query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+
+                match = re.match(r"^/images/(.+)/json$", path)
+                if self.command == "GET" and match:
+                    return self.inspect_image(unquote(match.group(1)))
+                if self.command == "POST" and path == "/images/create":
+                    return self.pull(query)
+                if self.command == "GET" and path == "/version":
+                    return self._send_json(200, {"ApiVersion": "1.24", "Version": "fake"})
+                self._send_json(404, {"message": "page not found"})
+
+            do_GET = do_POST = do_DELETE = _handle
+
+            def inspect_image(self, name):
+                if daemon.inspect_latency:
+                    time.sleep(daemon.inspect_latency)
+                data = daemon.images.get(name)
+                if data is None and ":" not in name.rsplit("/", 1)[-1]:
+                    data = daemon.images.get(name + ":latest")
+                if data is None:
+                    return self._send_json(404, {"message": "No such image: " + name})
+                self._send_json(200, data)
+
+            def pull(self, query):
+                name = "{}:{}".format(query["fromImage"], query.get("tag") or "latest")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                if name not in daemon.remote:
+                    self._send_chunk(json.dumps({
+                        "error": "manifest for {} not found".format(name)
+                    }).encode("utf-8") + b"\r\n")
+                else:
+                    for event in daemon.pull_events(name):
+                        self._send_chunk(json.dumps(event).encode("utf-8") + b"\r\n")
+                    daemon.images[name] = daemon.remote[name]
+                self._send_chunk(b"")
+
+        if tcp:
+            self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+            self.base_url = "tcp://127.0.0.1:{}".format(self.server.server_address[1])
+        else:
+            self.directory = tempfile.mkdtemp()
+            self.socket = os.path.join(self.directory, "docker.sock")
+            self.base_url = "unix://" + self.socket
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def add_image(self, name, local_id=None, remote_id=None):
+        """
+        Add an image, present locally with `local_id` (unless None) and
+        available from its registry as `remote_id` (unless None).
+        """
+        if local_id is not None:
+            self.images[name] = {"Id": local_id, "RepoTags": [name]}
+        if remote_id is not None:
+            self.remote[name] = {"Id": remote_id, "RepoTags": [name]}
+
+    def pull_events(self, name):
+        """
+        Generate the progress events streamed while pulling `name`, sleeping
+        in between to simulate the configured download speed.
+        """
+        repository, tag = name.rsplit(":", 1)
+        layer_ids = ["{:012x}".format(abs(hash((name, i))) % (16 ** 12))
+                     for i in range(self.layers)]
+        step = self.layer_size // max(self.progress_events, 1)
+        delay = 0
+        if self.speed:
+            delay = step * self.layers / self.speed
+
+        yield {"status": "Pulling from " + repository, "id": tag}
+        for layer_id in layer_ids:
+            yield {"status": "Pulling fs layer", "progressDetail": {}, "id": layer_id}
+        for status in ("Downloading", "Extracting"):
+            for n in range(1, self.progress_events + 1):
+                if status == "Downloading" and delay:
+                    time.sleep(delay)
+                for layer_id in layer_ids:
+                    yield {
+                        "status": status,
+                        "progressDetail": {"current": step * n, "total": self.layer_size},
+                        "id": layer_id,
+                    }
+            if status == "Downloading":
+                for layer_id in layer_ids:
+                    yield {"status": "Download complete", "progressDetail": {}, "id": layer_id}
+        for layer_id in layer_ids:
+            yield {"status": "Pull complete", "progressDetail": {}, "id": layer_id}
+        yield {"status": "Digest: sha256:" + "0" * 64}
+        yield {"status": "Status: Downloaded newer image for " + name}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket is not None:
+            os.unlink(self.socket)
+            os.rmdir(self.directory)
@@ -0,0 +1,124 @@
+"""
+A stand-in for a Docker registry (HTTP API v2), for use in tests.
+"""
+import hashlib
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from urlparse import parse_qs, urlsplit
+
+
+class FakeRegistry(object):
+    """
+    Serves manifest digests (and optionally manifests) for a configurable
+    set of repositories on a random port on localhost.
+
+    Set `require_token` to emulate Docker Hub's anonymous bearer token flow,
+    `rate_limited` to the number of manifest requests to answer with HTTP
+    status 429 and `quota` to a `(limit, remaining)` tuple to send Docker
+    Hub's rate limit headers.
+
+    Tag lists are paginated following the `n` and `last` parameters and
+    served with an `ETag`, answering requests for unchanged pages with
+    HTTP status 304.
+    """
+
+    def __init__(self):
+        self.manifests = {}  # Maps (repository, tag) to digest
+        self.bodies = {}  # Maps (repository, tag or digest) to the manifest returned by GET
+        self.tags = {}  # Maps repositories to their tags
+        self.not_modified = 0  # Number of tag list pages answered with HTTP status 304
+        self.require_token = False
+        self.rate_limited = 0
+        self.quota = None
+        self.requests = []
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, headers=None, body=b""):
+                self.send_response(status)
+                if registry.quota is not None:
+                    self.send_header("RateLimit-Limit", "{};w=21600".format(registry.quota[0]))
+                    self.send_header("RateLimit-Remaining", "{};w=21600".format(registry.quota[1]))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _handle(self):
+                registry.requests.append((self.command, self.path, dict(self.headers)))
+                if self.path.startswith("/token"):
+                    return self._send(200, body=json.dumps({"token": "secret"}).encode())
+                if registry.require_token and \
+                        self.headers.get("Authorization") != "Bearer secret":
+                    return self._send(401, headers={
+                        "WWW-Authenticate": 'Bearer realm="{}/token",service="fake",'
+                                            'scope="repository:x:pull"'.format(registry.url),
+                    })
+                if "/tags/list" in self.path:
+                    return self._tags()
+                parts = self.path.split("/manifests/")
+                if len(parts) == 2 and parts[0].startswith("/v2/"):
+                    if registry.rate_limited:
+                        registry.rate_limited -= 1
+                        return self._send(429, headers={"Retry-After": "0"})
+                    key = (parts[0][4:], parts[1])
+                    digest = registry.manifests.get(key)
+                    body = registry.bodies.get(key)
+                    if digest is not None or body is not None:
+                        headers = {"Docker-Content-Digest": digest or parts[1]}
+                        if body is None:
+                            return self._send(200, headers=headers)
+                        headers["Content-Type"] = body.get("mediaType", "application/json")
+                        return self._send(200, headers=headers, body=json.dumps(body).encode())
+                self._send(404)
+
+            def _tags(self):
+                url = urlsplit(self.path)
+                repository = url.path[4:-len("/tags/list")]
+                if repository not in registry.tags:
+                    return self._send(404)
+                query = parse_qs(url.query)
+                tags = sorted(registry.tags[repository])
+                if "last" in query:
+                    tags = [t for t in tags if t > query["last"][0]]
+                headers = {}
+                if "n" in query and len(tags) > int(query["n"][0]):
+                    tags = tags[:int(query["n"][0])]
+                    headers["Link"] = '</v2/{}/tags/list?last={}&n={}>; rel="next"'.format(
+                        repository, tags[-1], query["n"][0])
+                body = json.dumps({"name": repository, "tags": tags}).encode()
+                headers["ETag"] = '"{}"'.format(hashlib.sha256(body).hexdigest())
+                if self.headers.get("If-None-Match") == headers["ETag"]:
+                    registry.not_modified += 1
+                    return self._send(304, headers=headers)
+                self._send(200, headers=headers, body=body)
+
+            do_GET = do_HEAD = _handle
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.host = "127.0.0.1:{}".format(self.server.server_address[1])
+        self.url = "http://" + self.host
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,155 @@
+import mock
+import pytest
+import sys
+import threading
+from diu.progress import PullError, PullProgress
+from docker.errors import APIError
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 6), reason="requires Python 3.6+")
+
+
+@pytest.fixture
+def docker():
+    from tests.fakedocker import FakeDocker
+    daemon = FakeDocker().start()
+    yield daemon
+    daemon.stop()
+
+
+@pytest.fixture
+def client(docker):
+    from diu.aio import AsyncioClient
+    client = AsyncioClient(base_url=docker.base_url, version="1.24", pool_size=2)
+    yield client
+    client.close()
+
+
+class TestAsyncioClient(object):
+    def test_inspect_image(self, docker, client):
+        docker.images["ubuntu:latest"] = {"Id": "sha256:aaa"}
+        assert client.inspect_image("ubuntu:latest") == {"Id": "sha256:aaa"}
+        assert client.inspect_image("ubuntu") == {"Id": "sha256:aaa"}
+        assert docker.requests[0] == ("GET", "/images/ubuntu:latest/json", {})
+
+    def test_missing_image_raises_api_error(self, client):
+        with pytest.raises(APIError) as e:
+            client.inspect_image("missing:latest")
+        assert e.value.response.status_code == 404
+        assert e.value.explanation == "No such image: missing:latest"
+
+    def test_streamed_pull_updates_image(self, docker, client):
+        docker.images["ubuntu:latest"] = {"Id": "sha256:aaa"}
+        docker.remote["ubuntu:latest"] = {"Id": "sha256:bbb"}
+        progress = PullProgress("ubuntu:latest")
+        progress.consume(client.pull("ubuntu:latest", stream=True))
+        assert len(progress.layers) == 3
+        assert progress.downloaded == 3 * 1000 * 1000
+        assert docker.requests[0] == (
+            "POST", "/images/create", {"fromImage": "ubuntu", "tag": "latest"}
+        )
+        assert client.inspect_image("ubuntu:latest") == {"Id": "sha256:bbb"}
+
+    def test_pull_errors_are_streamed(self, client):
+        with pytest.raises(PullError):
+            PullProgress("missing:latest").consume(client.pull("missing", stream=True))
+        assert "manifest for missing:latest not found" in client.pull("missing")
+
+    def test_connections_are_reused(self, docker, client):
+        docker.images["ubuntu:latest"] = {"Id": "sha256:aaa"}
+        for _ in range(5):
+            client.inspect_image("ubuntu:latest")
+        assert len(client.api.pool._idle) == 1
+
+    def test_concurrent_requests_share_the_pool(self, docker, client):
+        for i in range(20):
+            docker.images["image{}:latest".format(i)] = {"Id": str(i)}
+        results = {}
+
+        def inspect(i):
+            results[i] = client.inspect_image("image{}:latest".format(i))["Id"]
+
+        threads = [threading.Thread(target=inspect, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == {i: str(i) for i in range(20)}
+        assert len(client.api.pool._idle) <= 2
+
+    def test_updater_runs_against_asyncio_client(self, docker, client):
+        from diu.updater import ContainerSet, Updater
+        docker.images["ubuntu:latest"] = {"Id": "sha256:aaa"}
+        docker.remote["ubuntu:latest"] = {"Id": "sha256:bbb"}
+        docker.images["debian:latest"] = {"Id": "sha256:ccc"}
+        docker.remote["debian:latest"] = {"Id": "sha256:ccc"}
+        updater = Updater(client, [
+            ContainerSet(name="set", images=["ubuntu:latest", "debian:latest"], commands=[]),
+        ], concurrency=2)
+        updater.do_updates()
+        assert updater.error_count == 0
+        assert updater._results["ubuntu:latest"].new_id == "sha256:bbb"
+        assert not updater._results["debian:latest"].updated
+
+    def test_abandoned_pull_releases_connection(self, docker, client):
+        import time
+        docker.images["ubuntu:latest"] = {"Id": "sha256:aaa"}
+        docker.remote["ubuntu:latest"] = {"Id": "sha256:bbb"}
+        docker.speed = 1000 * 1000  # Streams for 3 seconds
+        chunks = client.pull("ubuntu:latest", stream=True)
+        next(chunks)
+        chunks.close()
+        for _ in range(100):
+            if client.api.pool._slots._value == 2:
+                break
+            time.sleep(0.01)
+        assert client.api.pool._slots._value == 2
+        assert client.inspect_image("ubuntu:latest") == {"Id": "sha256:aaa"}
+
+
+    def test_stalled_pull_is_aborted(self, docker, client):
+        from diu.progress import PullTimeout, guard_stream
+        docker.remote["slow:latest"] = {"Id": "sha256:bbb"}
+        docker.layers = 1
+        docker.speed = 100 * 1000  # Each download step takes 2 seconds
+        real_thread = threading.Thread
+        readers = []
+
+        def thread(*args, **kwargs):
+            t = real_thread(*args, **kwargs)
+            if kwargs.get('name') == "pull-reader":
+                readers.append(t)
+            return t
+
+        with mock.patch('diu.progress.threading.Thread', side_effect=thread), \
+                pytest.raises(PullTimeout):
+            list(guard_stream(client.pull("slow:latest", stream=True), stall_timeout=0.3))
+        for reader in readers:
+            reader.join(1)
+        assert readers and not any(reader.is_alive() for reader in readers)
+        assert client.api.pool._slots._value == 2
+
+def test_status_line_without_reason():
+    import asyncio
+    from diu.aio import Connection
+
+    class Writer(object):
+        def write(self, data):
+            pass
+
+        def drain(self):
+            return asyncio.sleep(0)
+
+    # Written without async syntax, so the module can be collected (and
+    # skipped) on interpreters which can't parse it
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"HTTP/1.1 200\r\nContent-Length: 2\r\n\r\n{}")
+        response = loop.run_until_complete(
+            Connection(reader, Writer()).request("GET", "/version")
+        )
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert (response.status, response.reason) == (200, "")
@@ -0,0 +1,86 @@
+import pytest
+from diu.circuit import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, CircuitOpenError,
+    is_registry_error, is_unavailable,
+)
+from requests.exceptions import ConnectionError
+from diu.progress import PullError, PullTimeout
+from diu.registry import RegistryError
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_is_unavailable():
+    assert is_unavailable(PullTimeout("Pull made no progress for 300s"))
+    assert is_unavailable(PullError("Get https://registry/v2/: dial tcp: i/o timeout"))
+    assert is_unavailable(PullError("received unexpected HTTP status: 503 Service Unavailable"))
+    assert is_unavailable(RegistryError("Request to https://registry/v2/ failed: Boom!"))
+    assert not is_unavailable(PullError("manifest for app:latest not found"))
+    assert not is_unavailable(RegistryError("Request to x failed with HTTP status 404"))
+    # Errors of the Docker daemon say nothing about the registry
+    assert not is_unavailable(ConnectionError("docker.sock: Connection refused"))
+    assert not is_unavailable(Exception("500 Server Error: i/o timeout"))
+
+
+def test_is_registry_error():
+    assert is_registry_error(PullTimeout("Pull made no progress for 300s"))
+    assert is_registry_error(PullError("manifest for app:latest not found"))
+    assert is_registry_error(RegistryError("Request to x failed with HTTP status 404"))
+    assert not is_registry_error(ConnectionError("docker.sock: Connection refused"))
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("docker.io", threshold=2, clock=FakeClock())
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_open_circuit_lets_single_probe_through_after_timeout():
+    clock = FakeClock()
+    breaker = CircuitBreaker("docker.io", threshold=1, reset_timeout=60, clock=clock)
+    breaker.record_failure()
+    clock.now += 60
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.now += 60
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.allow()
+
+
+def test_skipped_probe_lets_next_image_through():
+    clock = FakeClock()
+    breaker = CircuitBreaker("docker.io", threshold=1, reset_timeout=60, clock=clock)
+    breaker.record_failure()
+    clock.now += 60
+    breaker.allow()
+    breaker.record_skipped()
+    assert breaker.state == OPEN
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+
+def test_breakers_are_per_registry():
+    breakers = CircuitBreakers(threshold=1)
+    breakers.for_registry("docker.io").record_failure()
+    assert breakers.for_registry("docker.io").state == OPEN
+    assert breakers.for_registry("quay.io").state == CLOSED
+    assert CircuitBreakers(threshold=0).for_registry("docker.io") is None
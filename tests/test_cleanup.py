@@ -0,0 +1,76 @@
+import mock
+import pytest
+from docker.errors import APIError
+from diu.cleanup import CollectionResult, ImageCollector, unique_size
+
+
+class TestImageCollector(object):
+    @pytest.fixture
+    def client(self):
+        client = mock.MagicMock()
+        client.containers.return_value = [
+            {'Id': 'c1', 'Image': 'app:latest', 'ImageID': 'sha256:used'},
+        ]
+        client.images.return_value = [
+            {'Id': 'sha256:old1', 'RepoTags': ['<none>:<none>'], 'Size': 100},
+            {'Id': 'sha256:old2', 'RepoTags': None, 'Size': 50},
+            {'Id': 'sha256:used', 'RepoTags': ['<none>:<none>'], 'Size': 10},
+            {'Id': 'sha256:tagged', 'RepoTags': ['app:stable'], 'Size': 10},
+            {'Id': 'sha256:new', 'RepoTags': ['app:latest'], 'Size': 10},
+        ]
+        return client
+
+    def test_removes_unused_images(self, client):
+        collector = ImageCollector(client)
+        result = collector.collect(
+            ['sha256:old1', 'sha256:old2', 'sha256:used', 'sha256:tagged', 'sha256:gone',
+             'sha256:new'],
+            keep=['sha256:new'],
+        )
+        assert result == CollectionResult(
+            removed=['sha256:old1', 'sha256:old2'], in_use=['sha256:used'],
+            tagged=['sha256:tagged'], reclaimed=150,
+        )
+        assert sorted(client.remove_image.call_args_list) == [
+            mock.call('sha256:old1'), mock.call('sha256:old2')
+        ]
+        assert collector.metrics.get('diu_reclaimed_bytes_total') == 150
+
+    def test_shared_layers_are_not_counted_as_reclaimed(self, client):
+        client.images.return_value = [
+            {'Id': 'sha256:old1', 'RepoTags': None, 'Size': 100, 'VirtualSize': 100,
+             'SharedSize': 80},
+            {'Id': 'sha256:old2', 'RepoTags': None, 'Size': 50, 'VirtualSize': 50,
+             'SharedSize': 0},
+        ]
+        collector = ImageCollector(client)
+        assert collector.collect(['sha256:old1', 'sha256:old2']).reclaimed == 70
+        assert collector.metrics.get('diu_reclaimed_bytes_total') == 70
+
+    def test_lists_containers_and_images_once(self, client):
+        ImageCollector(client).collect(['sha256:old1', 'sha256:old2'])
+        client.containers.assert_called_once_with(all=True)
+        assert client.images.call_count == 1
+
+    def test_failed_removal_is_reported(self, client):
+        response = mock.MagicMock(status_code=409)
+        client.remove_image.side_effect = APIError("conflict", response, "conflict")
+        result = ImageCollector(client).collect(['sha256:old1'])
+        assert result.removed == []
+        assert result.failed == ['sha256:old1']
+        assert result.reclaimed == 0
+
+    def test_nothing_to_collect_needs_no_requests(self, client):
+        assert ImageCollector(client).collect(['sha256:new'], keep=['sha256:new']) == \
+            CollectionResult()
+        assert not client.containers.called
+
+
+@pytest.mark.parametrize('image, expected', [
+    ({'Size': 100, 'VirtualSize': 100, 'SharedSize': 30}, 70),
+    ({'Size': 100, 'VirtualSize': 100, 'SharedSize': -1}, 100),
+    ({'Size': 100}, 100),
+    ({}, 0),
+])
+def test_unique_size(image, expected):
+    assert unique_size(image) == expected
@@ -0,0 +1,100 @@
+import mock
+import pytest
+import yaml
+from diu.config import ConfigLoader, ConfigurationError, expand_paths, matches_patterns
+from diu.updater import ContainerSet
+
+
+def write(f, data):
+    yaml.dump(data, f.open('w'))
+
+
+def build_set(name, watch):
+    if not isinstance(watch, dict):
+        raise ValueError("Key 'watch' should be a dictionary")
+    return ContainerSet(name=name, images=watch.get('images', []),
+                        commands=watch.get('commands', []))
+
+
+class TestExpandPaths(object):
+    def test_directories_and_globs_are_expanded_in_order(self, tmpdir):
+        d = tmpdir.mkdir("conf.d")
+        for name in ("b.yml", "a.yaml", "c.txt"):
+            d.join(name).write("")
+        main = str(tmpdir.join("main.yml"))
+        assert expand_paths([main, str(d)]) == [
+            main, str(d.join("a.yaml")), str(d.join("b.yml"))
+        ]
+        assert expand_paths([str(d.join("*.yml")), str(d.join("b.yml"))]) == [
+            str(d.join("b.yml"))
+        ]
+
+    def test_missing_files_are_kept_but_empty_globs_are_not(self, tmpdir):
+        missing = str(tmpdir.join("missing.yml"))
+        assert expand_paths([missing, str(tmpdir.join("*.yml"))]) == [missing]
+
+    def test_matches_patterns(self, tmpdir):
+        d = tmpdir.mkdir("conf.d")
+        assert matches_patterns(str(d.join("new.yml")), [str(d)])
+        assert not matches_patterns(str(d.join("new.yml.swp")), [str(d)])
+        assert matches_patterns("/etc/diu/x.yml", ["/etc/diu/*.yml"])
+        assert matches_patterns("/etc/diu.yml", ["/etc/diu.yml"])
+
+
+class TestConfigLoader(object):
+    @pytest.fixture
+    def loader(self):
+        return ConfigLoader(mock.Mock(side_effect=build_set))
+
+    @pytest.fixture
+    def confd(self, tmpdir):
+        d = tmpdir.mkdir("conf.d")
+        write(d.join("a.yml"), {'config': {'docker': {'version': '1.16'}},
+                                'watch': {'one': {'images': ['a', 'b']}, 'two': {}}})
+        write(d.join("b.yml"), {'watch': {'one': {'images': ['b', 'c']}, 'three': {}}})
+        return d
+
+    def test_files_are_merged_in_order(self, loader, confd):
+        config, containerset = loader.load([str(confd)])
+        assert config == {'docker': {'version': '1.16'}}
+        assert [s.name for s in containerset] == ['one', 'two', 'three']
+        assert containerset[0].images == ['a', 'b', 'c']
+
+    def test_unchanged_files_are_not_reparsed(self, loader, confd):
+        loader.load([str(confd)])
+        loader.build_set.reset_mock()
+        with mock.patch('yaml.load') as load:
+            config, containerset = loader.load([str(confd)])
+        assert not load.called
+        assert not loader.build_set.called
+        assert loader.changed_files == []
+        assert [s.name for s in containerset] == ['one', 'two', 'three']
+
+    def test_only_sets_of_changed_files_are_rebuilt(self, loader, confd):
+        _, before = loader.load([str(confd)])
+        loader.build_set.reset_mock()
+        write(confd.join("b.yml"), {'watch': {'one': {'images': ['d']}, 'four': {}}})
+        _, after = loader.load([str(confd)])
+        assert sorted(c[0][0] for c in loader.build_set.call_args_list) == ['four', 'one']
+        assert loader.changed_sets == {'one', 'three', 'four'}
+        assert [s.name for s in after] == ['one', 'two', 'four']
+        assert after[0].images == ['a', 'b', 'd']
+        assert after[1] is before[1]
+
+    def test_added_and_removed_files_are_picked_up(self, loader, confd):
+        loader.load([str(confd)])
+        confd.join("a.yml").remove()
+        write(confd.join("c.yml"), {'watch': {'five': {}}})
+        config, containerset = loader.load([str(confd)])
+        assert config == {}
+        assert [s.name for s in containerset] == ['one', 'three', 'five']
+        assert containerset[0].images == ['b', 'c']
+
+    def test_invalid_change_keeps_previous_state(self, loader, confd):
+        loader.load([str(confd)])
+        write(confd.join("b.yml"), {'watch': {'one': []}})
+        with pytest.raises(ConfigurationError):
+            loader.load([str(confd)])
+        write(confd.join("b.yml"), {'watch': {'one': {'images': ['e']}}})
+        _, containerset = loader.load([str(confd)])
+        assert containerset[0].images == ['a', 'b', 'e']
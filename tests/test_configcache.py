@@ -0,0 +1,39 @@
+import os
+import pytest
+from diu.configcache import ConfigCache
+
+
+class TestConfigCache(object):
+    @pytest.fixture
+    def cache(self, tmpdir):
+        return ConfigCache(str(tmpdir.join("cache", "config.cache")))
+
+    def test_roundtrip(self, cache, tmpdir):
+        f = tmpdir.join("config.yml")
+        f.write("watch: {}")
+        key = cache.key([str(f)])
+        assert cache.get(key) is None
+        cache.put(key, {'config': {}})
+        assert cache.get(cache.key([str(f)])) == {'config': {}}
+        assert os.stat(cache.path).st_mode & 0o777 == 0o600
+
+    def test_changed_files_miss(self, cache, tmpdir):
+        f = tmpdir.join("config.yml")
+        f.write("watch: {}")
+        cache.put(cache.key([str(f)]), "old")
+        f.write("watch: {a: {}}")
+        assert cache.get(cache.key([str(f)])) is None
+
+    def test_unreadable_files_are_not_cached(self, cache, tmpdir):
+        key = cache.key([str(tmpdir.join("missing.yml"))])
+        assert key is None
+        cache.put(key, "value")
+        assert not os.path.exists(cache.path)
+
+    def test_corrupt_cache_is_ignored(self, cache, tmpdir):
+        f = tmpdir.join("config.yml")
+        f.write("watch: {}")
+        os.makedirs(os.path.dirname(cache.path))
+        with open(cache.path, 'wb') as fh:
+            fh.write(b"garbage")
+        assert cache.get(cache.key([str(f)])) is None
@@ -0,0 +1,132 @@
+import mock
+import pytest
+from diu.daemon import Daemon, Scheduler
+from diu.updater import ContainerSet
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(object):
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    @pytest.fixture
+    def scheduler(self, clock):
+        return Scheduler(clock=clock)
+
+    def test_pop_due_returns_due_sets_in_order(self, scheduler, clock):
+        scheduler.schedule("b", 20)
+        scheduler.schedule("a", 10)
+        scheduler.schedule("c", 30)
+        assert scheduler.next_due() == 1010
+        clock.now += 25
+        assert scheduler.pop_due() == ["a", "b"]
+        assert scheduler.names() == {"c"}
+        assert scheduler.next_due() == 1030
+
+    def test_rescheduling_replaces_previous_time(self, scheduler, clock):
+        scheduler.schedule("a", 10)
+        scheduler.schedule("a", 60)
+        clock.now += 30
+        assert scheduler.pop_due() == []
+        assert scheduler.next_due() == 1060
+
+    def test_unscheduled_sets_are_never_due(self, scheduler, clock):
+        scheduler.schedule("a", 10)
+        scheduler.unschedule("a")
+        clock.now += 30
+        assert scheduler.pop_due() == []
+        assert scheduler.next_due() is None
+
+
+class TestDaemon(object):
+    @pytest.fixture
+    def app(self):
+        app = mock.MagicMock()
+        app.config = {'daemon': {'interval': 60, 'jitter': 0}}
+        app.updater.error_count = 0
+        app.updater.containerset = {
+            'one': ContainerSet(name='one', images=['ubuntu']),
+            'two': ContainerSet(name='two', images=['debian'], interval=600),
+        }
+        return app
+
+    @pytest.fixture
+    def daemon(self, app):
+        daemon = Daemon(app)
+        daemon.scheduler.clock = FakeClock()
+        return daemon
+
+    def test_run_once_updates_due_sets_and_reschedules_them(self, daemon, app):
+        daemon._sync_schedule()
+        daemon.run_once()
+        app.updater.do_updates.assert_called_once_with(['one', 'two'])
+        assert daemon.scheduler._due == {'one': 1060, 'two': 1600}
+
+    def test_run_once_does_nothing_when_no_sets_are_due(self, daemon, app):
+        daemon.scheduler.schedule('one', 10)
+        daemon.run_once()
+        assert not app.updater.do_updates.called
+
+    def test_reload_reloads_config_and_syncs_schedule(self, daemon, app):
+        daemon.scheduler.schedule('one', 10)
+        daemon.scheduler.schedule('removed', 10)
+        daemon.reload()
+        daemon.run_once()
+        app.reload.assert_called_once_with()
+        assert daemon.scheduler.names() == {'one', 'two'}
+
+    def test_run_exits_when_stopped(self, daemon, app):
+        app.updater.containerset = {}
+        with mock.patch.object(Daemon, 'install_signal_handlers'):
+            daemon.stop()
+            daemon.run()
+        assert not app.updater.do_updates.called
+
+    def test_burst_of_notifications_results_in_single_check(self, daemon, app):
+        app.config['webhook'] = {'debounce': 5}
+        daemon._sync_schedule()
+        daemon.run_once()
+        app.updater.do_updates.reset_mock()
+
+        daemon.trigger([('library/debian', 'latest')])
+        daemon.run_once()
+        daemon.scheduler.clock.now += 2
+        daemon.trigger([('library/debian', 'latest')])
+        daemon.run_once()
+        assert not app.updater.do_updates.called
+
+        daemon.scheduler.clock.now += 3
+        daemon.run_once()
+        app.updater.do_updates.assert_called_once_with(['two'])
+
+    def test_notification_for_unwatched_image_is_ignored(self, daemon, app):
+        daemon._sync_schedule()
+        daemon.trigger([('library/redis', 'latest')])
+        assert daemon._triggered == set()
+
+    def test_notification_matching_tag_pattern_triggers_set(self, daemon, app):
+        app.updater.containerset['db'] = ContainerSet(name='db', images=['postgres:15.*'])
+        daemon._sync_schedule()
+        daemon.trigger([('library/postgres', '15.5')])
+        assert daemon._triggered == {'db'}
+
+    def test_config_changes_trigger_reload(self, daemon, app):
+        app.config_files = ('/etc/docker-image-updater.d',)
+        with mock.patch('diu.daemon.create_file_watcher') as m:
+            daemon._start_file_watcher()
+        m.assert_called_once_with(('/etc/docker-image-updater.d',), daemon.reload)
+
+        app.config['daemon']['watch_config'] = False
+        daemon.file_watcher = None
+        with mock.patch('diu.daemon.create_file_watcher') as m:
+            daemon._start_file_watcher()
+        assert not m.called
+        assert daemon.file_watcher is None
@@ -0,0 +1,35 @@
+import pytest
+import threading
+from diu.filewatch import FileWatcher, PollingFileWatcher, _load_libc
+
+
+def watch(cls, patterns, **kwargs):
+    changed = threading.Event()
+    watcher = cls(patterns, changed.set, **kwargs)
+    watcher.start()
+    return watcher, changed
+
+
+@pytest.mark.skipif(_load_libc() is None, reason="inotify is not available")
+def test_inotify_reports_matching_changes(tmpdir):
+    d = tmpdir.mkdir("conf.d")
+    watcher, changed = watch(FileWatcher, [str(d)], delay=0.05)
+    try:
+        d.join("notes.txt").write("ignored")
+        assert not changed.wait(0.3)
+        d.join("app.yml").write("watch: {}")
+        assert changed.wait(5)
+    finally:
+        watcher.stop()
+
+
+def test_polling_reports_changes(tmpdir):
+    f = tmpdir.join("config.yml")
+    f.write("watch: {}")
+    watcher, changed = watch(PollingFileWatcher, [str(tmpdir.join("*.yml"))], interval=0.05)
+    try:
+        assert not changed.wait(0.2)
+        tmpdir.join("other.yml").write("watch: {}")
+        assert changed.wait(5)
+    finally:
+        watcher.stop()
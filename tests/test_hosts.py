@@ -0,0 +1,58 @@
+import mock
+import pytest
+from collections import OrderedDict
+from diu.hosts import MultiHostUpdater
+from diu.updater import ContainerSet, ImageCheck
+
+
+def fake_updater(sets, errors=0, updated=(), exception=None):
+    updater = mock.MagicMock()
+    updater.containerset = {name: ContainerSet(name=name) for name in sets}
+    updater.error_count = 0
+    updater._updated = []
+
+    def do_updates(names):
+        if exception is not None:
+            raise exception
+        updater.error_count += errors
+        updater._updated.extend(updated)
+
+    updater.do_updates.side_effect = do_updates
+    return updater
+
+
+class TestMultiHostUpdater(object):
+    @pytest.fixture
+    def updater(self):
+        return MultiHostUpdater(OrderedDict([
+            ('web1', fake_updater(['app', 'db'], updated=['app'])),
+            ('web2', fake_updater(['app'], errors=2)),
+            ('web3', fake_updater(['db'], exception=RuntimeError("boom"))),
+        ]), concurrency=2)
+
+    def test_hosts_are_updated_with_their_own_sets(self, updater):
+        updater.do_updates()
+        updaters = updater.updaters
+        updaters['web1'].do_updates.assert_called_once_with(['app', 'db'])
+        updaters['web2'].do_updates.assert_called_once_with(['app'])
+        updaters['web3'].do_updates.assert_called_once_with(['db'])
+
+    def test_results_are_aggregated_per_host(self, updater):
+        updater.do_updates()
+        assert updater.results['web1'].updated == ['app']
+        assert updater.results['web1'].errors == 0
+        assert updater.results['web2'].errors == 2
+        assert updater.results['web3'].failed
+        assert updater.error_count == 3
+
+    def test_only_hosts_with_the_given_sets_are_updated(self, updater):
+        updater.do_updates(['db'])
+        assert not updater.updaters['web2'].do_updates.called
+        updater.updaters['web3'].do_updates.assert_called_once_with(['db'])
+        assert sorted(updater.containerset) == ['app', 'db']
+
+    def test_checks_are_collected_from_every_host(self, updater):
+        for host, u in updater.updaters.items():
+            u.check_images.return_value = [ImageCheck(image='app', host=host)]
+        checks = updater.check_images()
+        assert [c.host for c in checks] == ['web1', 'web2', 'web3']
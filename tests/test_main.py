@@ -1,8 +1,15 @@
+import json
 import mock
+import pstats
 import pytest
+import subprocess
+import sys
+import time
 import yaml
-from diu.main import Application
-from diu.updater import ContainerSet, Updater
+from diu.hosts import MultiHostUpdater
+from diu.main import EXIT_UPDATES_AVAILABLE, Application
+from diu.state import ImageState
+from diu.updater import ContainerSet, ImageCheck, Updater
 
 
 class TestApplication(object):
@@ -136,3 +143,286 @@ class TestApplication(object):
             self.app(tmpdir=tmpdir, config={'watch': "myapp"})
         with pytest.raises(SystemExit):
             self.app(tmpdir=tmpdir, config={'watch': {"myapp": []}})
+
+    def test_reload_keeps_client_and_rebuilds_updater(self, app, tmpdir):
+        client, updater = app.client, app.updater
+        yaml.dump({'config': app.config, 'watch': {'debian': {'images': ['debian']}}},
+                  tmpdir.join("config.yml").open('w'))
+        assert app.reload()
+        assert app.client is client
+        assert app.updater is not updater
+        assert [w.name for w in app.containerset] == ['debian']
+
+    def test_reload_with_invalid_config_keeps_current_config(self, app, tmpdir):
+        updater = app.updater
+        yaml.dump({'watch': []}, tmpdir.join("config.yml").open('w'))
+        assert not app.reload()
+        assert app.updater is updater
+        assert [w.name for w in app.containerset] == ['ubuntu']
+
+    def test_invalid_interval_is_rejected(self, app):
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'interval': 'often'})
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'interval': 0})
+        app._validate_watch_configuration({'interval': 30})
+
+    def test_invalid_commands_are_rejected(self, app):
+        app._validate_watch_configuration({'commands': ['foo', {'run': 'bar', 'timeout': 5}]})
+        app._validate_watch_configuration({'commands': [{'parallel': ['foo', {'run': 'bar'}]}]})
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'commands': [{'command': 'foo'}]})
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'commands': [{'run': 'foo', 'timeout': -1}]})
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'commands': [{'parallel': 'foo'}]})
+
+    def test_invalid_tag_patterns_are_rejected(self, app):
+        app._validate_watch_configuration({'images': ['postgres:15.*', 'nginx:^1.24']})
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'images': ['nginx:>=1.x']})
+
+    def test_tag_patterns_get_a_registry_client(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({
+            'config': {'registry': {'tag_page_size': 50}},
+            'watch': {
+                'db': {'images': ['postgres:15.*']},
+                'cache': {'images': ['redis']},
+            },
+        }, f.open('w'))
+        app = Application(args=[str(f)])
+        # Digests are only checked when enabled, even though tags are listed
+        assert app.updater.registry is None
+        assert app.updater.tags.registry.page_size == 50
+
+    def test_invalid_recreate_actions_are_rejected(self, app):
+        app._validate_watch_configuration({'commands': [
+            {'recreate': True},
+            {'recreate': {'containers': ['web-*'], 'concurrency': 2, 'wait_healthy': True,
+                          'health_timeout': 30, 'stop_timeout': 5}},
+        ]})
+        for recreate in ['yes', {'concurrency': 0}, {'containers': 'web'},
+                         {'wait_healthy': 'yes'}, {'restart': True}]:
+            with pytest.raises(ValueError):
+                app._validate_watch_configuration({'commands': [{'recreate': recreate}]})
+        with pytest.raises(ValueError):
+            app._validate_watch_configuration({'commands': [{'recreate': True, 'dedupe': True}]})
+
+    def test_recreate_is_rejected_with_asyncio_backend(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({
+            'config': {'docker': {'backend': 'asyncio'}},
+            'watch': {'web': {'images': ['nginx'], 'commands': [{'recreate': True}]}},
+        }, f.open('w'))
+        with pytest.raises(SystemExit):
+            Application(args=[str(f)])
+
+    def test_asyncio_backend_is_selected_from_config(self, tmpdir):
+        config = {'config': {'docker': {
+            'backend': 'asyncio',
+            'base_url': 'unix://var/run/docker.sock',
+            'pool_size': 4,
+        }}}
+        f = tmpdir.join("config.yml")
+        yaml.dump(config, f.open('w'))
+        with mock.patch('diu.aio.AsyncioClient') as m, mock.patch('diu.main.DockerClient') as d:
+            Application(args=[str(f)]).client
+        m.assert_called_once_with(base_url='unix://var/run/docker.sock', pool_size=4)
+        assert not d.called
+
+    def test_unknown_backend_is_rejected(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'config': {'docker': {'backend': 'curl'}}}, f.open('w'))
+        with pytest.raises(SystemExit):
+            Application(args=[str(f)])
+
+    def test_registry_limits_are_shared_by_registry_client_and_updater(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'config': {'registry': {
+            'check_digest': True,
+            'retries': 5,
+            'limits': {'docker.io': {'concurrency': 2, 'rate': 0.5}},
+        }}}, f.open('w'))
+        app = Application(args=[str(f)])
+        assert app.updater.limits is app.updater.registry.limits
+        assert app.updater.limits.retries == 5
+        assert app.updater.limits.for_registry('docker.io')._bucket.rate == 0.5
+
+    def test_pull_deadlines_and_breaker_are_configured(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'config': {
+            'pull': {'timeout': 600},
+            'registry': {'breaker': {'threshold': 5, 'reset_timeout': 60}},
+        }}, f.open('w'))
+        app = Application(args=[str(f)])
+        assert app.updater.pull_timeout == 600
+        assert app.updater.stall_timeout == 300
+        assert app.updater.breakers.for_registry('docker.io').threshold == 5
+        assert app.updater.breakers.reset_timeout == 60
+
+    def test_run_exits_early_when_nothing_is_due(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({
+            'config': {'state': {'path': str(tmpdir.join("state.db")), 'ttl': 3600}},
+            'watch': {'ubuntu': {'images': ['ubuntu', 'debian']}},
+        }, f.open('w'))
+        app = Application(args=[str(f)])
+        app.state.put(ImageState('ubuntu', checked_at=time.time()))
+        assert app._work_due()
+        app.state.put(ImageState('debian', checked_at=time.time()))
+        assert not app._work_due()
+        with mock.patch('diu.main.DockerClient') as m:
+            app.run()
+        assert not m.called
+        assert app._updater is None
+
+    def test_early_exit_writes_last_run_timestamp(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        textfile = tmpdir.join("diu.prom")
+        yaml.dump({
+            'config': {
+                'state': {'path': str(tmpdir.join("state.db")), 'ttl': 3600},
+                'metrics': {'textfile': str(textfile)},
+            },
+            'watch': {'ubuntu': {'images': ['ubuntu']}},
+        }, f.open('w'))
+        app = Application(args=[str(f)])
+        app.state.put(ImageState('ubuntu', checked_at=time.time()))
+        app.run()
+        assert app._updater is None
+        assert app.metrics.get('diu_last_run_timestamp_seconds') > time.time() - 60
+        assert "diu_last_run_timestamp_seconds" in textfile.read()
+
+    def test_importing_main_does_not_import_dependencies_of_work(self):
+        # Guards the startup time of runs with nothing to do, see
+        # benchmarks/bench_startup.py.
+        output = subprocess.check_output([sys.executable, "-c", (
+            "import sys, diu.main; "
+            "print(' '.join(sorted(m for m in ('docker', 'requests', 'yaml', 'colorlog', "
+            "'http.server') if m in sys.modules)))"
+        )])
+        assert output.decode("utf-8").strip() == ""
+
+    def test_trace_is_written_after_run(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'watch': {'ubuntu': {'images': ['ubuntu'], 'commands': []}}}, f.open('w'))
+        trace = tmpdir.join("trace.json")
+        app = Application(args=["--trace", str(trace), str(f)])
+        app.client = mock.MagicMock()
+        app.updater.client = app.client
+        app.client.inspect_image.return_value = {'Id': 'sha256:1'}
+        app.client.pull.return_value = []
+        app.run()
+        names = [e['name'] for e in json.loads(trace.read())['traceEvents'] if e['ph'] == 'X']
+        for name in ("load config", "update", "set ubuntu", "image ubuntu", "inspect ubuntu",
+                     "pull ubuntu"):
+            assert name in names
+
+    def test_profile_is_written_after_run(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'watch': {}}, f.open('w'))
+        profile = tmpdir.join("run.prof")
+        app = Application(args=["--profile", str(profile), str(f)])
+        app.run()
+        assert pstats.Stats(str(profile)).total_calls > 0
+
+    @pytest.mark.parametrize("limits", [
+        ['docker.io'],
+        {'docker.io': {'rate': 0}},
+        {'docker.io': {'concurrency': 'many'}},
+        {'docker.io': {'speed': 1}},
+    ])
+    def test_invalid_registry_limits_are_rejected(self, tmpdir, limits):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'config': {'registry': {'limits': limits}}}, f.open('w'))
+        with pytest.raises(SystemExit):
+            Application(args=[str(f)])
+
+    def test_config_is_loaded_from_cache_when_unchanged(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'watch': {'ubuntu': {'images': ['ubuntu']}}}, f.open('w'))
+        args = ["--config-cache", str(tmpdir.join("config.cache")), str(f)]
+        Application(args=args)
+        with mock.patch('yaml.load') as load:
+            app = Application(args=args)
+        assert not load.called
+        assert [w.name for w in app.containerset] == ['ubuntu']
+        assert app.containerset[0].images == ['ubuntu']
+
+        yaml.dump({'watch': {'debian': {'images': ['debian']}}}, f.open('w'))
+        app = Application(args=args)
+        assert [w.name for w in app.containerset] == ['debian']
+
+    def test_config_directories_are_loaded(self, tmpdir):
+        d = tmpdir.mkdir("conf.d")
+        yaml.dump({'watch': {'ubuntu': {'images': ['ubuntu']}}}, d.join("ubuntu.yml").open('w'))
+        yaml.dump({'watch': {'debian': {'images': ['debian']}}}, d.join("debian.yml").open('w'))
+        app = Application(args=[str(d)])
+        assert [w.name for w in app.containerset] == ['debian', 'ubuntu']
+        updater = app.updater
+        assert app.reload()
+        assert app.updater is updater
+
+    def test_check_prints_report_and_signals_updates(self, tmpdir, capsys):
+        f = tmpdir.join("config.yml")
+        yaml.dump({'watch': {'app': {'images': ['app']}, 'db': {'images': ['db']}}}, f.open('w'))
+        app = Application(args=["--check", str(f)])
+        app.updater.check_images = mock.Mock(return_value=[
+            ImageCheck(image='app', sets=['app'], stale=True, remote_digest='sha256:b'),
+            ImageCheck(image='db', sets=['db']),
+        ])
+        with pytest.raises(SystemExit) as e:
+            app.run()
+        assert e.value.code == EXIT_UPDATES_AVAILABLE
+        report = json.loads(capsys.readouterr().out)
+        assert report['sets'] == ['app']
+        assert report['stale'][0]['image'] == 'app'
+        assert report['up_to_date'] == ['db']
+        assert report['errors'] == []
+
+    def test_hosts_get_their_own_updaters(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({
+            'config': {
+                'docker': {'version': '1.24'},
+                'hosts': {'web1': {'base_url': 'tcp://web1:2375'}},
+            },
+            'watch': {
+                'app': {'images': ['app']},
+                'db': {'images': ['db'], 'hosts': ['tcp://db1:2375']},
+            },
+        }, f.open('w'))
+        with mock.patch('diu.main.DockerClient') as m:
+            app = Application(args=[str(f)])
+            assert isinstance(app.updater, MultiHostUpdater)
+        assert list(app.updater.updaters) == ['web1', 'tcp://db1:2375']
+        assert sorted(app.updater.updaters['web1'].containerset) == ['app']
+        assert sorted(app.updater.updaters['tcp://db1:2375'].containerset) == ['db']
+        m.assert_any_call(version='1.24', base_url='tcp://web1:2375')
+        m.assert_any_call(version='1.24', base_url='tcp://db1:2375')
+
+        clients = dict(app.clients)
+        yaml.dump({'config': app.config, 'watch': {'app': {'images': ['app']}}}, f.open('w'))
+        assert app.reload()
+        assert app.clients['web1'] is clients['web1']
+        assert list(app.updater.updaters) == ['web1']
+
+    def test_sets_without_hosts_stay_on_default_daemon(self, tmpdir):
+        f = tmpdir.join("config.yml")
+        yaml.dump({
+            'config': {'docker': {'version': '1.24'}},
+            'watch': {
+                'local-app': {'images': ['app']},
+                'remote-db': {'images': ['db'], 'hosts': ['tcp://db1:2375']},
+            },
+        }, f.open('w'))
+        with mock.patch('diu.main.DockerClient') as m:
+            app = Application(args=[str(f)])
+            assert isinstance(app.updater, MultiHostUpdater)
+        assert list(app.updater.updaters) == ['default', 'tcp://db1:2375']
+        assert sorted(app.updater.updaters['default'].containerset) == ['local-app']
+        assert sorted(app.updater.updaters['tcp://db1:2375'].containerset) == ['remote-db']
+        assert app.updater.updaters['default'].client is app.client
+        m.assert_any_call(version='1.24')
+        m.assert_any_call(version='1.24', base_url='tcp://db1:2375')
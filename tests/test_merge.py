@@ -1,5 +1,5 @@
 import pytest
-from diu.merge import merge
+from diu.merge import Merger, merge
 
 
 def test_shallow_dict_merge():
@@ -91,3 +91,56 @@ def test_different_types_merge():
     b = [1]
     with pytest.raises(ValueError):
         assert merge(a, b)
+
+
+def test_list_of_dicts_merge():
+    a = [{'run': 'foo'}, 'bar']
+    b = [{'run': 'foo'}, {'run': 'baz'}]
+    assert merge(a, b) == [{'run': 'foo'}, 'bar', {'run': 'baz'}]
+
+
+def test_list_merge_preserves_order():
+    a = ['migrate', 'restart', 'migrate']
+    b = ['notify', 'restart', 'cleanup']
+    assert merge(a, b) == ['migrate', 'restart', 'notify', 'cleanup']
+
+
+def test_inputs_are_not_modified():
+    a = {'watch': {'app': {'images': ['a'], 'commands': ['x']}}}
+    b = {'watch': {'app': {'images': ['b']}, 'db': {'images': ['c']}}}
+    merge(a, b)
+    assert a == {'watch': {'app': {'images': ['a'], 'commands': ['x']}}}
+    assert b == {'watch': {'app': {'images': ['b']}, 'db': {'images': ['c']}}}
+
+
+def test_unchanged_structure_is_shared():
+    a = {'one': {'x': [1]}, 'two': {}}
+    b = {'two': {'y': 2}, 'three': {'z': [3]}}
+    result = merge(a, b)
+    assert result['one'] is a['one']
+    assert result['three'] is b['three']
+
+
+def test_merger_copies_each_node_once():
+    merger = Merger()
+    result = {}
+    for i in range(3):
+        previous = result
+        result = merger.merge(result, {'watch': {'app': {'images': [i]}}})
+        if i > 0:
+            assert result is previous
+    assert result == {'watch': {'app': {'images': [0, 1, 2]}}}
+
+
+def test_list_of_dicts_merge_compares_contents():
+    a = [{'run': 'foo', 'parallel': ['a', {'run': 'b'}]}, ['x']]
+    b = [{'parallel': ['a', {'run': 'b'}], 'run': 'foo'}, {'run': 'foo'}, ('x',), ['x']]
+    assert merge(a, b) == [
+        {'run': 'foo', 'parallel': ['a', {'run': 'b'}]}, ['x'], {'run': 'foo'}, ('x',),
+    ]
+
+
+def test_list_of_unkeyable_items_merge():
+    a = [{'run': {1, 2}}]
+    b = [{'run': {1, 2}}, {'run': {3}}]
+    assert merge(a, b) == [{'run': {1, 2}}, {'run': {3}}]
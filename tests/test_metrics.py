@@ -0,0 +1,67 @@
+import pytest
+import requests
+from diu.metrics import Metrics, MetricsServer
+
+
+class TestMetrics(object):
+    @pytest.fixture
+    def metrics(self):
+        return Metrics(buckets=(0.1, 1))
+
+    def test_counters_and_gauges(self, metrics):
+        metrics.inc('diu_pull_bytes_total', 10, image='ubuntu')
+        metrics.inc('diu_pull_bytes_total', 5, image='ubuntu')
+        metrics.set('diu_error_count', 3)
+        assert metrics.get('diu_pull_bytes_total', image='ubuntu') == 15
+        assert metrics.render() == (
+            '# HELP diu_error_count Number of errors which occurred since the updater was started\n'
+            '# TYPE diu_error_count gauge\n'
+            'diu_error_count 3\n'
+            '# HELP diu_pull_bytes_total Number of bytes downloaded while pulling images\n'
+            '# TYPE diu_pull_bytes_total counter\n'
+            'diu_pull_bytes_total{image="ubuntu"} 15\n'
+        )
+
+    def test_histogram(self, metrics):
+        metrics.observe('diu_pull_duration_seconds', 0.5, image='ubuntu')
+        metrics.observe('diu_pull_duration_seconds', 5, image='ubuntu')
+        lines = metrics.render().splitlines()
+        assert lines[2:] == [
+            'diu_pull_duration_seconds_bucket{image="ubuntu",le="0.1"} 0',
+            'diu_pull_duration_seconds_bucket{image="ubuntu",le="1"} 1',
+            'diu_pull_duration_seconds_bucket{image="ubuntu",le="+Inf"} 2',
+            'diu_pull_duration_seconds_sum{image="ubuntu"} 5.5',
+            'diu_pull_duration_seconds_count{image="ubuntu"} 2',
+        ]
+
+    def test_label_values_are_escaped(self, metrics):
+        metrics.inc('diu_commands_total', set='say "hi"\n')
+        assert 'diu_commands_total{set="say \\"hi\\"\\n"} 1' in metrics.render()
+
+    def test_bound_metrics_add_labels(self, metrics):
+        bound = metrics.bind(host='web1')
+        bound.inc('diu_commands_total', set='app', status='success')
+        bound.set('diu_error_count', 2)
+        assert metrics.get('diu_commands_total', host='web1', set='app', status='success') == 1
+        assert bound.get('diu_error_count') == 2
+        assert metrics.get('diu_error_count') is None
+
+    def test_write_textfile(self, metrics, tmpdir):
+        metrics.set('diu_error_count', 0)
+        path = tmpdir.join("diu.prom")
+        metrics.write_textfile(str(path))
+        assert path.read() == metrics.render()
+        assert tmpdir.listdir() == [path]
+
+    def test_metrics_server(self, metrics):
+        metrics.set('diu_error_count', 1)
+        server = MetricsServer(('127.0.0.1', 0), metrics)
+        server.start()
+        try:
+            url = "http://{}:{}".format(*server.address)
+            r = requests.get(url + "/metrics")
+            assert r.status_code == 200
+            assert r.text == metrics.render()
+            assert requests.get(url + "/other").status_code == 404
+        finally:
+            server.stop()
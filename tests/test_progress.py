@@ -0,0 +1,153 @@
+import json
+import logging
+import mock
+import threading
+import time
+import pytest
+from diu.progress import PullError, PullProgress, PullTimeout, decode_stream, guard_stream
+
+
+EVENTS = [
+    {"status": "Pulling from library/ubuntu", "id": "latest"},
+    {"status": "Already exists", "progressDetail": {}, "id": "aaa"},
+    {"status": "Pulling fs layer", "progressDetail": {}, "id": "bbb"},
+    {"status": "Downloading", "progressDetail": {"current": 1000000, "total": 3000000},
+     "id": "bbb"},
+    {"status": "Downloading", "progressDetail": {"current": 2000000, "total": 3000000},
+     "id": "bbb"},
+    {"status": "Download complete", "progressDetail": {}, "id": "bbb"},
+    {"status": "Extracting", "progressDetail": {"current": 3000000, "total": 3000000},
+     "id": "bbb"},
+    {"status": "Pull complete", "progressDetail": {}, "id": "bbb"},
+    {"status": "Digest: sha256:1234"},
+    {"status": "Status: Downloaded newer image for ubuntu:latest"},
+]
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def test_decode_stream_handles_lines_split_across_chunks():
+    raw = b"".join(json.dumps(e).encode() + b"\r\n" for e in EVENTS)
+    chunks = [raw[i:i + 7] for i in range(0, len(raw), 7)]
+    assert list(decode_stream(chunks)) == EVENTS
+
+
+def test_decode_stream_handles_multiple_lines_per_chunk():
+    raw = "\r\n".join(json.dumps(e) for e in EVENTS[:3])
+    assert list(decode_stream([raw])) == EVENTS[:3]
+
+
+def test_progress_tracks_layers():
+    progress = PullProgress("ubuntu", clock=FakeClock())
+    for event in EVENTS:
+        progress.feed(event)
+    assert set(progress.layers) == {"aaa", "bbb"}
+    assert progress.layers["aaa"].present
+    assert progress.downloaded == 3000000
+    assert progress.extracted == 3000000
+    assert progress.summary().endswith("1 of 2 layers already present")
+
+
+def test_progress_raises_on_error():
+    progress = PullProgress("ubuntu")
+    with pytest.raises(PullError):
+        progress.feed({"error": "manifest unknown", "errorDetail": {"message": "manifest unknown"}})
+
+
+def test_progress_is_reported_at_most_once_per_interval(caplog):
+    caplog.set_level(logging.INFO)
+    progress = PullProgress("ubuntu", interval=4, clock=FakeClock())
+    for event in EVENTS:
+        progress.feed(event)
+    reports = [r for r in caplog.records if r.getMessage().startswith("Pulling ubuntu")]
+    # The clock advances one second per call, so 10 events span about 10 seconds
+    assert len(reports) == 2
+    assert all(r.name == "PullProgress" for r in reports)
+
+
+def test_progress_is_reported_to_given_logger(caplog):
+    caplog.set_level(logging.INFO)
+    progress = PullProgress("ubuntu", interval=0, clock=FakeClock(),
+                            logger=logging.getLogger("Updater[web1]"))
+    for event in EVENTS:
+        progress.feed(event)
+    assert caplog.records
+    assert set(r.name for r in caplog.records) == {"Updater[web1]"}
+
+
+def stalling_stream(chunks, stalled):
+    for chunk in chunks:
+        yield chunk
+    stalled.wait(5)
+
+
+def test_guard_stream_passes_chunks_on():
+    assert list(guard_stream([b"a", b"b"], timeout=5, stall_timeout=5)) == [b"a", b"b"]
+    assert list(guard_stream([b"a", b"b"])) == [b"a", b"b"]
+
+
+def test_guard_stream_raises_errors_of_stream():
+    def failing():
+        yield b"a"
+        raise IOError("Boom!")
+
+    with pytest.raises(IOError):
+        list(guard_stream(failing(), stall_timeout=5))
+
+
+def test_guard_stream_aborts_stalled_stream():
+    stalled = threading.Event()
+    chunks = []
+    with pytest.raises(PullTimeout) as e:
+        for chunk in guard_stream(stalling_stream([b"a"], stalled), stall_timeout=0.1):
+            chunks.append(chunk)
+    stalled.set()
+    assert chunks == [b"a"]
+    assert "no progress" in str(e.value)
+
+
+def test_guard_stream_closes_stalled_docker_pull():
+    from docker import Client
+    from tests.fakedocker import FakeDocker
+    # Each download step of the single layer takes 2 seconds
+    docker = FakeDocker(layers=1, speed=100 * 1000, tcp=True).start()
+    try:
+        docker.add_image("slow:latest", remote_id="sha256:a")
+        client = Client(base_url=docker.base_url, version="1.24")
+        real_thread = threading.Thread
+        readers = []
+
+        def thread(*args, **kwargs):
+            t = real_thread(*args, **kwargs)
+            if kwargs.get('name') == "pull-reader":
+                readers.append(t)
+            return t
+
+        with mock.patch('diu.progress.threading.Thread', side_effect=thread), \
+                pytest.raises(PullTimeout):
+            list(guard_stream(client.pull("slow:latest", stream=True), stall_timeout=0.3))
+        for reader in readers:
+            reader.join(1)
+        assert readers and not any(reader.is_alive() for reader in readers)
+    finally:
+        docker.stop()
+
+
+def test_guard_stream_enforces_deadline():
+    def slow():
+        while True:
+            time.sleep(0.02)
+            yield b"a"
+
+    started = time.time()
+    with pytest.raises(PullTimeout) as e:
+        list(guard_stream(slow(), timeout=0.2, stall_timeout=1))
+    assert time.time() - started < 1
+    assert "within" in str(e.value)
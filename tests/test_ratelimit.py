@@ -0,0 +1,110 @@
+import threading
+from diu.ratelimit import (
+    Quota, RateLimits, RegistryLimiter, TokenBucket, is_rate_limited, parse_quota,
+    parse_retry_after,
+)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_parse_quota():
+    assert parse_quota({"RateLimit-Limit": "100;w=21600", "RateLimit-Remaining": "76;w=21600"}) \
+        == Quota(limit=100, remaining=76, window=21600)
+    assert parse_quota({"RateLimit-Limit": "100", "RateLimit-Remaining": "5"}) == Quota(100, 5)
+    assert parse_quota({}) is None
+    assert parse_quota({"RateLimit-Limit": "many", "RateLimit-Remaining": "5"}) is None
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Thu, 01 Jan 1970 00:01:40 GMT", now=40) == 60
+    assert parse_retry_after("Thu, 01 Jan 1970 00:01:40 GMT", now=400) == 0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_is_rate_limited():
+    assert is_rate_limited(Exception("toomanyrequests: You have reached your pull rate limit"))
+    assert is_rate_limited("Too Many Requests")
+    assert not is_rate_limited(Exception("manifest unknown"))
+
+
+def test_token_bucket_allows_burst_then_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == [0.5, 0.5]
+
+
+def test_token_bucket_refills_over_time():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, burst=2, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+    clock.now += 10
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+
+
+def test_limiter_backs_off():
+    clock = FakeClock()
+    limiter = RegistryLimiter("docker.io", clock=clock, sleep=clock.sleep)
+    limiter.back_off(30)
+    limiter.back_off(10)
+    with limiter.slot():
+        pass
+    assert clock.sleeps == [30]
+
+
+def test_limiter_caps_concurrency():
+    limiter = RegistryLimiter("docker.io", concurrency=2)
+    active = []
+    peak = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def pull():
+        with limiter.slot():
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            release.wait(1)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=pull) for _ in range(4)]
+    for t in threads:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join()
+    assert max(peak) <= 2
+
+
+def test_backoff_is_exponential_with_jitter():
+    limits = RateLimits(backoff=1, max_backoff=5, random=lambda: 1)
+    assert [limits.backoff(n) for n in range(5)] == [1, 2, 4, 5, 5]
+    limits.random = lambda: 0.5
+    assert limits.backoff(2) == 2
+
+
+def test_limiters_are_per_registry():
+    limits = RateLimits(limits={"docker.io": {"concurrency": 2}})
+    assert limits.for_registry("docker.io") is limits.for_registry("docker.io")
+    assert limits.for_registry("docker.io")._slots is not None
+    assert limits.for_registry("quay.io")._slots is None
+    limits.for_registry("quay.io").update({"RateLimit-Limit": "10", "RateLimit-Remaining": "1"})
+    assert limits.quotas() == {"quay.io": Quota(10, 1)}
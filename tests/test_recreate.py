@@ -0,0 +1,194 @@
+import mock
+import pytest
+from diu.recreate import ContainerRecreator, container_config, uses_recreate
+
+OLD_ID = "sha256:old"
+
+IMAGE_CONFIG = {
+    'Cmd': ["postgres"],
+    'Env': ["PATH=/usr/bin", "PG_VERSION=15.3"],
+    'Labels': {'maintainer': 'someone'},
+    'Volumes': {'/var/lib/postgresql/data': {}},
+}
+
+
+def inspect(container_id, name, **extra):
+    info = {
+        'Id': container_id,
+        'Name': '/' + name,
+        'Config': {
+            'Hostname': container_id[:12],
+            'Image': 'postgres:15',
+            'Cmd': ["postgres"],
+            'Env': ["PATH=/usr/bin", "PG_VERSION=15.3", "POSTGRES_PASSWORD=secret"],
+            'Labels': {'maintainer': 'someone', 'app': 'db'},
+            'Volumes': {'/var/lib/postgresql/data': {}},
+        },
+        'HostConfig': {'NetworkMode': 'backend', 'Binds': ["/srv/conf:/etc/postgresql:ro"]},
+        'Mounts': [
+            {'Type': 'bind', 'Source': '/srv/conf', 'Destination': '/etc/postgresql'},
+            {'Type': 'volume', 'Name': 'f00', 'Destination': '/var/lib/postgresql/data',
+             'RW': True},
+        ],
+        'NetworkSettings': {'Networks': {
+            'backend': {'Aliases': [container_id[:12], 'db'], 'Links': None,
+                        'IPAMConfig': None},
+            'monitoring': {'Aliases': None, 'Links': None,
+                           'IPAMConfig': {'IPv4Address': '10.0.0.5'}},
+        }},
+    }
+    info.update(extra)
+    return info
+
+
+class FakeClient(object):
+    def __init__(self, containers):
+        self._containers = containers
+        self.calls = []
+        self.events_seen = []
+        self.fail_start = False
+        self.healthcheck = None
+        self.stop_timeouts = {}
+        self.events_closed = 0
+
+    def containers(self):
+        return [{'Id': c, 'Names': ['/' + name], 'ImageID': image_id}
+                for c, (name, image_id) in sorted(self._containers.items())]
+
+    def inspect_image(self, image):
+        return {'Config': IMAGE_CONFIG}
+
+    def inspect_container(self, container):
+        if container.startswith("new-"):
+            return {'Config': {'Healthcheck': self.healthcheck}}
+        return inspect(container, self._containers[container][0])
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name,) + args)
+            if name == 'stop':
+                self.stop_timeouts[args[0]] = kwargs['timeout']
+            if name == 'create_container_from_config':
+                return {'Id': "new-" + kwargs['name']}
+            if name == 'start' and self.fail_start and args[0].startswith("new-"):
+                raise Exception("Boom!")
+        return call
+
+    def events(self, **kwargs):
+        self.calls.append(('events', kwargs['filters']['container']))
+        return self._events()
+
+    def _events(self):
+        try:
+            for event in self.events_seen:
+                yield event
+        finally:
+            self.events_closed += 1
+
+
+def test_uses_recreate():
+    assert uses_recreate(['foo', {'recreate': True}])
+    assert uses_recreate([{'parallel': ['foo', {'recreate': {}}]}])
+    assert not uses_recreate(['foo', {'run': 'bar'}])
+
+
+def test_container_config_keeps_overrides_of_container():
+    config, networks = container_config(inspect("abcdef1234567890", "db"), IMAGE_CONFIG,
+                                        "postgres:15")
+    assert config['Image'] == "postgres:15"
+    # Settings inherited from the old image are left to the new image
+    assert 'Cmd' not in config and 'Volumes' not in config and 'Hostname' not in config
+    assert config['Env'] == ["POSTGRES_PASSWORD=secret"]
+    assert config['Labels'] == {'app': 'db'}
+    # Anonymous volumes keep their data
+    assert config['HostConfig']['Binds'] == [
+        "/srv/conf:/etc/postgresql:ro", "f00:/var/lib/postgresql/data",
+    ]
+    assert config['NetworkingConfig'] == {'EndpointsConfig': {'backend': {
+        'Aliases': ['db'], 'Links': None, 'IPAMConfig': None,
+    }}}
+    assert networks == [('monitoring', {
+        'aliases': None, 'links': None, 'ipv4_address': '10.0.0.5', 'ipv6_address': None,
+    })]
+
+
+def test_container_config_of_host_network():
+    info = inspect("abcdef1234567890", "db", HostConfig={'NetworkMode': 'host'})
+    config, networks = container_config(info, IMAGE_CONFIG, "postgres:15")
+    assert 'NetworkingConfig' not in config
+    assert networks == []
+
+
+class TestContainerRecreator(object):
+    @pytest.fixture
+    def client(self):
+        return FakeClient({
+            "c1": ("db", OLD_ID),
+            "c2": ("db-replica", OLD_ID),
+            "c3": ("web", "sha256:other"),
+        })
+
+    def test_containers_using_old_image_are_recreated(self, client):
+        result = ContainerRecreator(client, concurrency=2).recreate({OLD_ID: "postgres:15"})
+        assert sorted(result.recreated) == ["db", "db-replica"]
+        assert result.failed == []
+        assert [c[0] for c in client.calls if c[1:2] in (("c1",), ("new-db",))] == [
+            'stop', 'rename', 'connect_container_to_network', 'start', 'remove_container',
+        ]
+
+    def test_names_limit_containers(self, client):
+        result = ContainerRecreator(client).recreate({OLD_ID: "postgres:15"}, names=["*-replica"])
+        assert result.recreated == ["db-replica"]
+
+    def test_failed_container_is_restored(self, client):
+        client.fail_start = True
+        recreator = ContainerRecreator(client)
+        result = recreator.recreate({OLD_ID: "postgres:15"}, names=["db"])
+        assert result.failed == ["db"]
+        assert client.calls[-3:] == [
+            ('remove_container', 'new-db'), ('rename', 'c1', 'db'), ('start', 'c1'),
+        ]
+        assert recreator.metrics.get('diu_containers_recreated_total', outcome='failed') == 1
+
+    def test_wait_for_healthy_container(self, client):
+        client.healthcheck = {'Test': ["CMD", "pg_isready"]}
+        client.events_seen = [{'Action': 'start'}, {'Action': 'health_status: healthy'}]
+        result = ContainerRecreator(client, wait_healthy=True).recreate(
+            {OLD_ID: "postgres:15"}, names=["db"])
+        assert result.recreated == ["db"]
+        assert ('events', 'new-db') in client.calls
+        assert client.events_closed == 1
+        assert client.calls[-1] == ('remove_container', 'c1')
+
+    def test_unhealthy_container_is_rolled_back(self, client):
+        client.healthcheck = {'Test': ["CMD", "pg_isready"]}
+        client.events_seen = [{'Action': 'health_status: unhealthy'}]
+        result = ContainerRecreator(client, wait_healthy=True).recreate(
+            {OLD_ID: "postgres:15"}, names=["db"])
+        assert result.failed == ["db"]
+        assert client.events_closed == 1
+        assert client.calls[-1] == ('start', 'c1')
+
+    def test_health_timeout(self, client):
+        client.healthcheck = {'Test': ["CMD", "pg_isready"]}
+        clock = mock.Mock(side_effect=[1000, 1000, 1030, 1030, 1061])
+        result = ContainerRecreator(client, wait_healthy=True, health_timeout=60,
+                                    clock=clock).recreate({OLD_ID: "postgres:15"}, names=["db"])
+        assert result.failed == ["db"]
+        assert client.calls.count(('events', 'new-db')) == 2
+
+    def test_stop_timeout(self, client):
+        client.inspect_container = lambda c: inspect(c, "db", Config={'StopTimeout': 30})
+        ContainerRecreator(client).recreate({OLD_ID: "postgres:15"}, names=["db"])
+        assert client.stop_timeouts == {"c1": 30}
+        ContainerRecreator(client, stop_timeout=5).recreate({OLD_ID: "postgres:15"}, names=["db"])
+        assert client.stop_timeouts == {"c1": 5}
+        client.inspect_container = lambda c: inspect(c, "db")
+        ContainerRecreator(client).recreate({OLD_ID: "postgres:15"}, names=["db"])
+        assert client.stop_timeouts == {"c1": 10}
+
+    def test_container_without_healthcheck_is_not_waited_for(self, client):
+        result = ContainerRecreator(client, wait_healthy=True).recreate(
+            {OLD_ID: "postgres:15"}, names=["db"])
+        assert result.recreated == ["db"]
+        assert ('events', 'new-db') not in client.calls
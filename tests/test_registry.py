@@ -0,0 +1,156 @@
+import pytest
+from diu.registry import (
+    ImageReference, Manifest, RegistryClient, RegistryError, TagCache, parse_image_reference
+)
+from diu.ratelimit import Quota, RateLimits
+from diu.state import StateStore
+from tests.fakeregistry import FakeRegistry
+
+
+@pytest.mark.parametrize("image,expected", [
+    ("ubuntu", ImageReference("docker.io", "library/ubuntu", "latest")),
+    ("ubuntu:14.04", ImageReference("docker.io", "library/ubuntu", "14.04")),
+    ("zoni/jenkins", ImageReference("docker.io", "zoni/jenkins", "latest")),
+    ("localhost/app", ImageReference("localhost", "app", "latest")),
+    ("registry.example.com:5000/my/app:1.0",
+     ImageReference("registry.example.com:5000", "my/app", "1.0")),
+    ("ubuntu@sha256:abc", ImageReference("docker.io", "library/ubuntu", "latest", "sha256:abc")),
+])
+def test_parse_image_reference(image, expected):
+    assert parse_image_reference(image) == expected
+
+
+def test_docker_hub_uses_registry_1_endpoint():
+    assert parse_image_reference("ubuntu").endpoint == "registry-1.docker.io"
+    assert parse_image_reference("localhost:5000/app").endpoint == "localhost:5000"
+
+
+class TestRegistryClient(object):
+    @pytest.fixture
+    def registry(self):
+        r = FakeRegistry().start()
+        yield r
+        r.stop()
+
+    @pytest.fixture
+    def client(self, registry):
+        return RegistryClient(timeout=2, insecure=[registry.host])
+
+    def test_manifest_digest_returns_digest_header(self, registry, client):
+        registry.manifests[("my/app", "1.0")] = "sha256:1234"
+        assert client.manifest_digest("{}/my/app:1.0".format(registry.host)) == "sha256:1234"
+        method, path, headers = registry.requests[0]
+        assert method == "HEAD"
+        assert "application/vnd.docker.distribution.manifest.list.v2+json" in headers["Accept"]
+
+    def test_manifest_digest_obtains_bearer_token(self, registry, client):
+        registry.require_token = True
+        registry.manifests[("my/app", "latest")] = "sha256:1234"
+        assert client.manifest_digest("{}/my/app".format(registry.host)) == "sha256:1234"
+        assert [r[1].split("?")[0] for r in registry.requests] == [
+            "/v2/my/app/manifests/latest", "/token", "/v2/my/app/manifests/latest"
+        ]
+
+    def test_manifest_digest_of_pinned_image_needs_no_request(self, registry, client):
+        digest = client.manifest_digest("{}/my/app@sha256:abcd".format(registry.host))
+        assert digest == "sha256:abcd"
+        assert registry.requests == []
+
+    def test_rate_limited_request_is_retried(self, registry, client):
+        registry.manifests[("my/app", "latest")] = "sha256:1234"
+        registry.rate_limited = 2
+        assert client.manifest_digest("{}/my/app".format(registry.host)) == "sha256:1234"
+        assert len(registry.requests) == 3
+
+    def test_rate_limited_request_gives_up_after_retries(self, registry):
+        client = RegistryClient(timeout=2, insecure=[registry.host],
+                                limits=RateLimits(retries=1, sleep=lambda delay: None))
+        registry.manifests[("my/app", "latest")] = "sha256:1234"
+        registry.rate_limited = 2
+        with pytest.raises(RegistryError):
+            client.manifest_digest("{}/my/app".format(registry.host))
+
+    def test_quota_headers_are_recorded(self, registry, client):
+        registry.manifests[("my/app", "latest")] = "sha256:1234"
+        registry.quota = (100, 76)
+        client.manifest_digest("{}/my/app".format(registry.host))
+        assert client.limits.quotas() == {registry.host: Quota(100, 76, 21600)}
+
+    def test_unknown_manifest_raises_registry_error(self, registry, client):
+        with pytest.raises(RegistryError):
+            client.manifest_digest("{}/my/app:missing".format(registry.host))
+
+    def test_unreachable_registry_raises_registry_error(self, registry, client):
+        registry.stop()
+        with pytest.raises(RegistryError):
+            client.manifest_digest("{}/my/app".format(registry.host))
+
+    def test_manifest_returns_digest_and_layers(self, registry, client):
+        registry.manifests[("my/app", "1.0")] = "sha256:1234"
+        registry.bodies[("my/app", "1.0")] = {
+            "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+            "layers": [{"digest": "sha256:a"}, {"digest": "sha256:b"}],
+        }
+        manifest = client.manifest("{}/my/app:1.0".format(registry.host))
+        assert manifest == Manifest(digest="sha256:1234", layers=["sha256:a", "sha256:b"])
+        assert registry.requests[0][0] == "GET"
+
+    def test_manifest_of_manifest_list_uses_platform(self, registry, client):
+        registry.manifests[("my/app", "latest")] = "sha256:list"
+        registry.bodies[("my/app", "latest")] = {
+            "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+            "manifests": [
+                {"digest": "sha256:arm", "platform": {"os": "linux", "architecture": "arm64"}},
+                {"digest": "sha256:amd", "platform": {"os": "linux", "architecture": "amd64"}},
+            ],
+        }
+        registry.bodies[("my/app", "sha256:amd")] = {"layers": [{"digest": "sha256:a"}]}
+        manifest = client.manifest("{}/my/app".format(registry.host))
+        assert manifest == Manifest(digest="sha256:list", layers=["sha256:a"])
+
+    def test_manifest_list_without_platform_raises_registry_error(self, registry, client):
+        registry.bodies[("my/app", "latest")] = {"manifests": [
+            {"digest": "sha256:arm", "platform": {"os": "linux", "architecture": "arm64"}},
+        ]}
+        with pytest.raises(RegistryError):
+            client.manifest("{}/my/app".format(registry.host))
+
+    def test_tags_follow_pagination(self, registry):
+        registry.tags["my/app"] = ["1.0", "1.1", "1.2", "2.0", "latest"]
+        client = RegistryClient(timeout=2, insecure=[registry.host], page_size=2)
+        tags = list(client.tags("{}/my/app:1.*".format(registry.host)))
+        assert tags == ["1.0", "1.1", "1.2", "2.0", "latest"]
+        assert [r[1] for r in registry.requests] == [
+            "/v2/my/app/tags/list?n=2",
+            "/v2/my/app/tags/list?last=1.1&n=2",
+            "/v2/my/app/tags/list?last=2.0&n=2",
+        ]
+
+    def test_unchanged_tag_pages_are_revalidated(self, registry):
+        registry.tags["my/app"] = ["1.0", "1.1", "1.2"]
+        client = RegistryClient(timeout=2, insecure=[registry.host], page_size=2)
+        list(client.tags("{}/my/app".format(registry.host)))
+        registry.tags["my/app"].append("1.3")
+        del registry.requests[:]
+
+        tags = list(client.tags("{}/my/app".format(registry.host)))
+        assert tags == ["1.0", "1.1", "1.2", "1.3"]
+        # The first page is unchanged, the second one gained a tag
+        assert all("If-None-Match" in r[2] for r in registry.requests)
+        assert registry.not_modified == 1
+
+    def test_tag_cache_is_kept_in_state_store(self, registry, tmpdir):
+        registry.tags["my/app"] = ["1.0", "1.1"]
+        store = StateStore(str(tmpdir.join("state.db")))
+        client = RegistryClient(timeout=2, insecure=[registry.host],
+                                tag_cache=TagCache(store=store))
+        list(client.tags("{}/my/app".format(registry.host)))
+
+        client = RegistryClient(timeout=2, insecure=[registry.host],
+                                tag_cache=TagCache(store=store))
+        assert list(client.tags("{}/my/app".format(registry.host))) == ["1.0", "1.1"]
+        assert registry.not_modified == 1
+
+    def test_tags_of_unknown_repository_raise_registry_error(self, registry, client):
+        with pytest.raises(RegistryError):
+            list(client.tags("{}/my/app".format(registry.host)))
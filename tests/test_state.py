@@ -0,0 +1,46 @@
+import sqlite3
+import pytest
+from diu.state import ImageState, StateStore
+
+
+class TestStateStore(object):
+    @pytest.fixture
+    def store(self, tmpdir):
+        return StateStore(str(tmpdir.join("state", "state.db")))
+
+    def test_unknown_image_has_no_state(self, store):
+        assert store.get("ubuntu") is None
+
+    def test_put_replaces_previous_state(self, store):
+        store.put(ImageState("ubuntu", local_id="a", checked_at=10))
+        store.put(ImageState("ubuntu", local_id="b", remote_digest="sha256:1234", checked_at=20,
+                             success=False, error="Boom!"))
+        assert store.get("ubuntu") == ImageState(
+            "ubuntu", local_id="b", remote_digest="sha256:1234", checked_at=20,
+            success=False, error="Boom!"
+        )
+
+    def test_is_fresh(self, store):
+        store.put(ImageState("ubuntu", checked_at=100))
+        store.put(ImageState("debian", checked_at=100, success=False))
+        assert store.is_fresh("ubuntu", ttl=60, now=150)
+        assert not store.is_fresh("ubuntu", ttl=60, now=170)
+        assert not store.is_fresh("ubuntu", ttl=0, now=150)
+        assert not store.is_fresh("debian", ttl=60, now=150)
+        assert not store.is_fresh("redis", ttl=60, now=150)
+
+    def test_state_can_be_read_by_other_connections(self, store):
+        store.put(ImageState("ubuntu", local_id="a", checked_at=10))
+        other = sqlite3.connect(store.path)
+        assert other.execute("SELECT local_id FROM images").fetchall() == [("a",)]
+        # Writes are possible while another connection has the database open
+        store.put(ImageState("debian", checked_at=10))
+        assert StateStore(store.path).get("debian") is not None
+
+    def test_tag_pages_are_cached(self, store):
+        assert store.get_tag_page("https://r/v2/app/tags/list?n=2") is None
+        store.put_tag_page("https://r/v2/app/tags/list?n=2", '"abc"', ["1.0", "1.1"],
+                           "https://r/next")
+        assert store.get_tag_page("https://r/v2/app/tags/list?n=2") == (
+            '"abc"', ["1.0", "1.1"], "https://r/next"
+        )
@@ -0,0 +1,94 @@
+import pytest
+from diu.registry import RegistryError
+from diu.tags import (
+    NoMatchingTagError, TagIndex, TagResolver, is_tag_pattern, parse_tag_pattern, version_key,
+)
+
+TAGS = [
+    "latest", "alpine", "14", "14.9", "15", "15.4", "15.4-alpine", "15.10", "15.10-alpine",
+    "16.0", "16.1-rc1", "v2.3.1",
+]
+
+
+class FakeRegistryClient(object):
+    def __init__(self, tags):
+        self._tags = tags
+        self.listed = []
+
+    def tags(self, image):
+        self.listed.append(image)
+        if image.startswith("broken"):
+            raise RegistryError("Boom!")
+        return iter(self._tags)
+
+
+def test_is_tag_pattern():
+    assert is_tag_pattern("postgres:15.*")
+    assert is_tag_pattern("postgres:1?")
+    assert is_tag_pattern("registry.example.com:5000/my/app:^1.24")
+    assert is_tag_pattern("nginx:>=1.24,<1.26")
+    assert not is_tag_pattern("postgres:15.4")
+    assert not is_tag_pattern("registry.example.com:5000/my/app")
+    assert not is_tag_pattern("postgres@sha256:abcd")
+
+
+def test_version_key_orders_by_version_number():
+    tags = ["15.10", "latest", "15.4-alpine", "15.9", "v15.5", "15.4", "alpine"]
+    assert sorted(tags, key=version_key) == [
+        "alpine", "latest", "15.4-alpine", "15.4", "v15.5", "15.9", "15.10",
+    ]
+
+
+@pytest.mark.parametrize("pattern,expected", [
+    ("15.*", "15.10"),
+    ("15.*-alpine", "15.10-alpine"),
+    ("1?", "15"),
+    ("^15", "15.10"),
+    ("^15.5", "15.10"),
+    ("~15.4", "15.4"),
+    (">=14,<16", "15.10"),
+    (">=14 <=15.4", "15.4"),
+    ("<15", "14.9"),
+    ("=15", "15"),
+    ("^2", "v2.3.1"),
+    ("^0.1", None),
+    ("17.*", None),
+])
+def test_newest_matching_tag(pattern, expected):
+    assert TagIndex(TAGS).newest(parse_tag_pattern(pattern)) == expected
+
+
+def test_ranges_only_match_releases():
+    index = TagIndex(["16.0", "16.1-rc1", "16.1-alpine"])
+    assert index.newest(parse_tag_pattern("^16")) == "16.0"
+
+
+@pytest.mark.parametrize("pattern", ["^", ">=15,<abc", "~1.x", ">=15;<16"])
+def test_invalid_ranges_raise_value_error(pattern):
+    with pytest.raises(ValueError):
+        parse_tag_pattern(pattern)
+
+
+class TestTagResolver(object):
+    def test_repositories_are_listed_once(self):
+        registry = FakeRegistryClient(TAGS)
+        resolved = TagResolver(registry).resolve(["postgres:15.*", "postgres:^14", "redis:1?"])
+        assert resolved == {
+            "postgres:15.*": "postgres:15.10",
+            "postgres:^14": "postgres:14.9",
+            "redis:1?": "redis:15",
+        }
+        assert sorted(registry.listed) == ["postgres:15.*", "redis:1?"]
+
+    def test_failures_are_returned(self):
+        registry = FakeRegistryClient(TAGS)
+        resolved = TagResolver(registry).resolve(["broken:1.*", "postgres:17.*"])
+        assert isinstance(resolved["broken:1.*"], RegistryError)
+        assert isinstance(resolved["postgres:17.*"], NoMatchingTagError)
+
+    def test_keeps_registry_of_pattern(self):
+        registry = FakeRegistryClient(TAGS)
+        resolved = TagResolver(registry).resolve(["registry.example.com:5000/my/app:~15.4"])
+        assert resolved == {
+            "registry.example.com:5000/my/app:~15.4": "registry.example.com:5000/my/app:15.4"
+        }
@@ -0,0 +1,80 @@
+import json
+import threading
+from diu.trace import NullTracer, Tracer
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_spans_are_recorded_in_chrome_trace_format(tmpdir):
+    clock = FakeClock()
+    tracer = Tracer(clock=clock)
+    with tracer.span("set web", "set", set="web"):
+        clock.now += 0.5
+        with tracer.span("pull nginx", "pull"):
+            clock.now += 1.25
+
+    path = tmpdir.join("trace.json")
+    tracer.write(str(path))
+    data = json.loads(path.read())
+    events = [e for e in data['traceEvents'] if e['ph'] == 'X']
+    assert [(e['name'], e['cat'], e['ts'], e['dur']) for e in events] == [
+        ("set web", "set", 100000000, 1750000),
+        ("pull nginx", "pull", 100500000, 1250000),
+    ]
+    assert events[0]['args'] == {'set': 'web'}
+    assert [e['args']['name'] for e in data['traceEvents'] if e['ph'] == 'M'] == [
+        threading.current_thread().name
+    ]
+
+
+def test_span_is_recorded_when_block_raises():
+    tracer = Tracer()
+    try:
+        with tracer.span("pull nginx", "pull"):
+            raise ValueError("Boom!")
+    except ValueError:
+        pass
+    assert [e['name'] for e in tracer.events] == ["pull nginx"]
+
+
+def test_threads_get_their_own_tid():
+    tracer = Tracer()
+    with tracer.span("main"):
+        pass
+    t = threading.Thread(target=lambda: tracer.span("worker").__enter__())
+    t.start()
+    t.join()
+    assert len(set(tid for tid, name in tracer._threads.values())) == 2
+
+
+def test_null_tracer_records_nothing():
+    with NullTracer().span("anything", "run", image="x"):
+        pass
+
+
+def _work_in_thread():
+    return sum(range(1000))
+
+
+def test_profiler_covers_threads_started_during_call():
+    from diu.trace import ThreadProfiler
+
+    def run():
+        threads = [threading.Thread(target=_work_in_thread) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return 42
+
+    profiler = ThreadProfiler()
+    assert profiler.runcall(run) == 42
+    calls = {func[2]: stat[1] for func, stat in profiler.stats().stats.items()}
+    assert calls['_work_in_thread'] == 3
+    assert calls['run'] == 1
@@ -1,9 +1,19 @@
 import itertools
+import threading
+import time
 import mock
 import pytest
 from copy import deepcopy
 from docker.errors import APIError
-from diu.updater import Updater, ContainerSet
+from requests.exceptions import ConnectionError
+from diu.circuit import CLOSED, CircuitBreakers, CircuitOpenError
+from diu.progress import PullError
+from diu.ratelimit import Quota, RateLimits
+from diu.recreate import RecreateResult
+from diu.registry import Manifest, RegistryError
+from diu.state import ImageState, StateStore
+from diu.tags import NoMatchingTagError
+from diu.updater import ContainerSet, ImageResult, Updater
 
 
 CONTAINERSET = [
@@ -51,6 +61,87 @@ class TestUpdater(object):
         assert updated
         assert updater._updated == ['ubuntu:latest']
 
+    def test_pull_progress_is_recorded(self, updater):
+        self.client.pull.return_value = [
+            b'{"status": "Downloading", "progressDetail": {"current": 10, "total": 20}, "id": "a"}\r\n',
+            b'{"status": "Pull complete", "id": "a"}\r\n',
+        ]
+        updater._pull_docker_image('ubuntu:latest')
+        assert updater._pulls['ubuntu:latest'].downloaded == 20
+
+    def test_pull_error_is_raised(self, updater):
+        self.client.pull.return_value = [b'{"error": "Boom!"}\r\n']
+        with pytest.raises(PullError):
+            updater._pull_docker_image('ubuntu:latest')
+
+    def test_rate_limited_pull_is_retried_with_backoff(self, updater):
+        sleeps = []
+        updater.limits = RateLimits(retries=2, sleep=sleeps.append, random=lambda: 0.5)
+        self.client.pull.side_effect = [
+            [b'{"error": "toomanyrequests: You have reached your pull rate limit."}\r\n'],
+            [b'{"error": "toomanyrequests: You have reached your pull rate limit."}\r\n'],
+            [b'{"status": "Pull complete", "id": "a"}\r\n'],
+        ]
+        updater._pull_docker_image('ubuntu:latest')
+        assert self.client.pull.call_count == 3
+        assert len(sleeps) == 2 and sleeps[0] <= 0.5 and sleeps[1] <= 1
+        assert updater.metrics.get('diu_rate_limited_total', registry='docker.io') == 2
+
+    def test_rate_limited_pull_gives_up_after_retries(self, updater):
+        updater.limits = RateLimits(retries=1, sleep=lambda delay: None)
+        self.client.pull.return_value = [b'{"error": "toomanyrequests: Too Many Requests"}\r\n']
+        with pytest.raises(PullError):
+            updater._pull_docker_image('ubuntu:latest')
+        assert self.client.pull.call_count == 2
+
+    def test_stalled_pull_is_aborted(self, updater):
+        stalled = threading.Event()
+
+        def stream():
+            yield b'{"status": "Downloading", "id": "a"}\r\n'
+            stalled.wait(5)
+
+        updater.stall_timeout = 0.1
+        self.client.pull.return_value = stream()
+        with pytest.raises(PullError):
+            updater._pull_docker_image('ubuntu:latest')
+        stalled.set()
+
+    def test_broken_registry_fails_remaining_images_fast(self, updater):
+        updater.breakers = CircuitBreakers(threshold=2)
+        updater.containerset = {'apps': ContainerSet(
+            name='apps', images=['a', 'b', 'c', 'quay.io/d'], commands=[]
+        )}
+        self.client.pull.return_value = [b'{"error": "dial tcp: i/o timeout"}\r\n']
+        updater.do_updates()
+        assert self.client.pull.call_count == 3
+        assert isinstance(updater._results['c'].error, CircuitOpenError)
+        assert isinstance(updater._results['quay.io/d'].error, PullError)
+        assert updater.error_count == 4
+
+    def test_daemon_errors_do_not_open_circuit(self, updater):
+        updater.breakers = CircuitBreakers(threshold=2)
+        updater.containerset = {'apps': ContainerSet(
+            name='apps', images=['a', 'b', 'c'], commands=[]
+        )}
+        self.client.inspect_image.side_effect = ConnectionError("docker.sock: Connection refused")
+        updater.do_updates()
+        assert updater.breakers.for_registry('docker.io').state == CLOSED
+        assert all(isinstance(updater._results[image].error, ConnectionError)
+                   for image in ['a', 'b', 'c'])
+
+    def test_superseded_images_are_removed_after_run(self, updater, default_image):
+        updater.collect_garbage = True
+        self.client.inspect_image.side_effect = [
+            {'Id': 'sha256:old'}, {'Id': 'sha256:new'}, {'Id': 'sha256:same'}, {'Id': 'sha256:same'},
+        ]
+        self.client.containers.return_value = []
+        self.client.images.return_value = [{'Id': 'sha256:old', 'Size': 42}]
+        with mock.patch('diu.updater.Updater._run_command'):
+            updater.do_updates()
+        self.client.remove_image.assert_called_once_with('sha256:old')
+        assert updater.metrics.get('diu_reclaimed_bytes_total') == 42
+
     def test_update_image_will_pull_if_image_not_found(self, updater, default_image):
         r = mock.MagicMock()
         r.status_code = 404
@@ -64,6 +155,89 @@ class TestUpdater(object):
         assert updated
         assert updater._updated == ['ubuntu:newtag']
 
+    def test_update_image_skips_pull_if_registry_digest_matches(self, updater, default_image):
+        default_image['RepoDigests'] = ['ubuntu@sha256:1234']
+        updater.registry = mock.MagicMock()
+        updater.registry.manifest_digest.return_value = 'sha256:1234'
+
+        assert not updater._update_image('ubuntu:latest')
+        assert not self.client.pull.called
+
+    def test_update_image_pulls_if_registry_digest_differs(self, updater, default_image):
+        default_image['RepoDigests'] = ['ubuntu@sha256:1234']
+        updater.registry = mock.MagicMock()
+        updater.registry.manifest_digest.return_value = 'sha256:5678'
+
+        updater._update_image('ubuntu:latest')
+        assert self.client.pull.called
+
+    def test_update_image_pulls_if_registry_unreachable(self, updater, default_image):
+        default_image['RepoDigests'] = ['ubuntu@sha256:1234']
+        updater.registry = mock.MagicMock()
+        updater.registry.manifest_digest.side_effect = RegistryError("Boom!")
+
+        updater._update_image('ubuntu:latest')
+        assert self.client.pull.called
+
+    def test_updated_images_are_tracked_per_run(self, updater):
+        with mock.patch.object(Updater, '_update_image', return_value=True):
+            updater.do_updates()
+        updater._updated.append('ubuntu:latest')
+        with mock.patch.object(Updater, '_update_image', return_value=False):
+            updater.do_updates()
+        assert updater._updated == []
+
+    def test_registry_quota_is_reported(self, updater):
+        updater.limits.for_registry('docker.io').quota = Quota(limit=100, remaining=76, window=21600)
+        updater.do_updates()
+        assert updater.metrics.get('diu_registry_quota_remaining', registry='docker.io') == 76
+
+    def test_recently_checked_image_is_skipped(self, updater, tmpdir):
+        updater.state = StateStore(str(tmpdir.join("state.db")))
+        updater.state_ttl = 60
+        updater.state.put(ImageState('ubuntu:latest', checked_at=time.time()))
+        with mock.patch.object(Updater, '_update_image', return_value=False) as m:
+            updater.do_updates()
+        assert m.call_args_list == [mock.call('ubuntu:14.04')]
+        assert updater._results['ubuntu:latest'].skipped
+
+    def test_containerset_ttl_overrides_state_ttl(self, tmpdir):
+        containerset = [ContainerSet(name="one", images=['ubuntu:latest'], ttl=0)]
+        updater = Updater(client=self.client, containerset=containerset,
+                          state=StateStore(str(tmpdir.join("state.db"))), state_ttl=60)
+        updater.state.put(ImageState('ubuntu:latest', checked_at=time.time()))
+        with mock.patch.object(Updater, '_update_image', return_value=False) as m:
+            updater.do_updates()
+        assert m.called
+
+    def test_outcome_of_check_is_recorded_in_state(self, updater, default_image, tmpdir):
+        updater.state = StateStore(str(tmpdir.join("state.db")))
+        after = deepcopy(default_image)
+        after['Id'] = 'a-new-id'
+        self.client.inspect_image.side_effect = [default_image, after, Exception("Boom!")]
+        updater.do_updates()
+
+        state = updater.state.get('ubuntu:latest')
+        assert state.success and state.local_id == 'a-new-id'
+        state = updater.state.get('ubuntu:14.04')
+        assert not state.success and state.error == "Boom!"
+
+    def test_metrics_are_recorded(self, updater, default_image):
+        after = deepcopy(default_image)
+        after['Id'] = 'a-new-id'
+        self.client.inspect_image.side_effect = [default_image, after, Exception("Boom!")]
+        popen = mock.MagicMock(**{'return_value.wait.return_value': 0})
+        with mock.patch('diu.updater.subprocess.Popen', new=popen):
+            updater.do_updates()
+
+        m = updater.metrics
+        assert m.get('diu_image_checks_total', image='ubuntu:latest', outcome='updated') == 1
+        assert m.get('diu_image_checks_total', image='ubuntu:14.04', outcome='failed') == 1
+        assert m.get('diu_images_updated_total', set='ubuntu', image='ubuntu:latest') == 1
+        assert m.get('diu_image_failures_total', set='ubuntu', image='ubuntu:14.04') == 1
+        assert m.get('diu_commands_total', set='ubuntu', status='success') == 2
+        assert m.get('diu_error_count') == 1
+
     def test_do_updates_calls_update_with_each_containerset(self, updater):
         with mock.patch.object(Updater, '_update') as m:
             updater.do_updates()
@@ -118,11 +292,45 @@ class TestUpdater(object):
     @mock.patch('diu.updater.Updater._run_command')
     def test_update_is_aware_of_images_updated_by_other_containerset(self, run_command_mock, updater):
         assert "ubuntu:latest" in CONTAINERSET[0].images
-        updater._updated = ["ubuntu:latest"]
+        updater._results = {"ubuntu:latest": ImageResult("ubuntu:latest", updated=True)}
 
         updater._update(CONTAINERSET[0])
         assert run_command_mock.called
 
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_unchanged_image_shared_by_sets_is_checked_once(self, run_command_mock):
+        containerset = [
+            ContainerSet(name="one", images=['ubuntu:latest'], commands=['foo']),
+            ContainerSet(name="two", images=['ubuntu:latest', 'ubuntu:latest'], commands=['bar']),
+        ]
+        updater = Updater(client=self.client, containerset=containerset)
+        with mock.patch.object(Updater, '_update_image', return_value=False) as m:
+            updater.do_updates()
+        assert m.call_args_list == [mock.call('ubuntu:latest')]
+        assert not run_command_mock.called
+
+    def test_plan_maps_images_to_sets(self):
+        containerset = [
+            ContainerSet(name="one", images=['ubuntu:latest', 'redis'], commands=[]),
+            ContainerSet(name="two", images=['redis', 'redis'], commands=[]),
+        ]
+        updater = Updater(client=self.client, containerset=containerset)
+        assert list(updater._plan(containerset).items()) == [
+            ('ubuntu:latest', ['one']),
+            ('redis', ['one', 'two']),
+        ]
+
+    def test_failure_of_shared_image_is_attributed_to_each_set(self):
+        containerset = [
+            ContainerSet(name="one", images=['ubuntu:latest'], commands=[]),
+            ContainerSet(name="two", images=['ubuntu:latest'], commands=[]),
+        ]
+        updater = Updater(client=self.client, containerset=containerset)
+        with mock.patch.object(Updater, '_update_image', side_effect=Exception("Boom!")) as m:
+            updater.do_updates()
+        assert m.call_count == 1
+        assert updater.error_count == 2
+
     def test_error_count_is_incremented_if_updating_image_fails(self, updater):
         assert updater.error_count == 0
         m = mock.MagicMock()
@@ -158,3 +366,447 @@ class TestUpdater(object):
 
         assert m.called
         assert updater.error_count == 2
+
+
+class TestConcurrentUpdater(object):
+    CONTAINERSET = [
+        ContainerSet(name="ubuntu", images=['ubuntu:latest', 'ubuntu:14.04'], commands=['foo']),
+        ContainerSet(name="shared", images=['ubuntu:latest'], commands=['bar']),
+        ContainerSet(name="debian", images=['debian:jessie'], commands=['baz']),
+    ]
+
+    @pytest.fixture
+    def updater(self):
+        return Updater(client=mock.MagicMock(), containerset=self.CONTAINERSET, concurrency=4)
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_each_image_is_updated_once(self, run_command_mock, updater):
+        with mock.patch.object(Updater, '_update_image', return_value=True) as m:
+            updater.do_updates()
+        assert sorted(m.call_args_list) == sorted(
+            [mock.call('ubuntu:latest'), mock.call('ubuntu:14.04'), mock.call('debian:jessie')]
+        )
+        assert sorted(run_command_mock.call_args_list) == sorted(
+            [mock.call('foo'), mock.call('bar'), mock.call('baz')]
+        )
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_commands_run_as_soon_as_set_is_done(self, run_command_mock, updater):
+        commands_run = threading.Event()
+        run_command_mock.side_effect = lambda command: commands_run.set()
+
+        def update_image(image):
+            if image == 'debian:jessie':
+                return True
+            # Block the ubuntu images until debian's commands have run
+            assert commands_run.wait(5)
+            return False
+
+        with mock.patch.object(Updater, '_update_image', side_effect=update_image):
+            updater.do_updates()
+        assert run_command_mock.call_args_list == [mock.call('baz')]
+
+    def test_error_count_matches_sequential_semantics(self, updater):
+        with mock.patch.object(Updater, '_update_image', side_effect=Exception("Boom!")):
+            updater.do_updates()
+        # ubuntu:latest is counted once for each set listing it
+        assert updater.error_count == 4
+
+
+
+class TestLayerSharing(object):
+    CONTAINERSET = [
+        ContainerSet(name="apps", images=['app1', 'app2', 'base', 'other'], commands=[]),
+    ]
+    LAYERS = {
+        'base': ['sha256:os', 'sha256:runtime'],
+        'app1': ['sha256:os', 'sha256:runtime', 'sha256:app1'],
+        'app2': ['sha256:os', 'sha256:app2'],
+        'other': ['sha256:other'],
+    }
+
+    @pytest.fixture
+    def registry(self):
+        registry = mock.MagicMock()
+        registry.manifest_digest.side_effect = lambda image: "sha256:" + image
+        registry.manifest.side_effect = lambda image: Manifest(
+            digest="sha256:" + image, layers=self.LAYERS[image]
+        )
+        return registry
+
+    @pytest.fixture
+    def client(self):
+        client = mock.MagicMock()
+        client.inspect_image.return_value = {'Id': 'sha256:1', 'RepoDigests': []}
+        return client
+
+    @pytest.fixture
+    def updater(self, client, registry):
+        return Updater(client=client, containerset=self.CONTAINERSET,
+                       registry=registry, concurrency=4, share_layers=True)
+
+    def test_layer_dependencies(self, updater):
+        plan = updater._plan(self.CONTAINERSET)
+        # app1 shares the most layers, so it downloads os and runtime
+        assert updater._layer_dependencies(plan) == {
+            'app1': set(), 'app2': {'app1'}, 'base': {'app1'}, 'other': set(),
+        }
+
+    def test_images_wait_for_pull_of_shared_layers(self, updater):
+        finished = []
+
+        def update_image(image):
+            if image == 'app1':
+                time.sleep(0.1)
+            finished.append(image)
+            return False
+
+        with mock.patch.object(Updater, '_update_image', side_effect=update_image):
+            updater.do_updates()
+        assert finished[0] == 'other'
+        assert finished.index('app1') < finished.index('app2')
+        assert finished.index('app1') < finished.index('base')
+
+    def test_manifest_digest_is_reused(self, updater, registry):
+        plan = updater._plan(self.CONTAINERSET)
+        updater._layer_dependencies(plan)
+        assert registry.manifest_digest.call_count == 4
+        assert updater._is_up_to_date('app1', ['app1@sha256:app1'])
+        assert registry.manifest_digest.call_count == 4
+
+    def test_manifests_of_up_to_date_images_are_not_downloaded(self, updater, client,
+                                                                registry):
+        client.inspect_image.side_effect = lambda image: {
+            'Id': 'sha256:1', 'RepoDigests': ['{0}@sha256:{0}'.format(image)],
+        }
+        plan = updater._plan(self.CONTAINERSET)
+        assert updater._layer_dependencies(plan) == {image: set() for image in plan}
+        assert not registry.manifest.called
+
+    def test_local_layers_are_not_shared(self, updater, client, registry):
+        plan = updater._plan(self.CONTAINERSET)
+        updater._layer_dependencies(plan)
+        # Everything was pulled, then app2 and base got a new top layer
+        client.inspect_image.side_effect = lambda image: {
+            'Id': 'sha256:1', 'RepoDigests': ['{0}@sha256:{0}'.format(image)],
+        }
+        changed = {
+            'app2': ['sha256:os', 'sha256:app2-v2'],
+            'base': ['sha256:os', 'sha256:runtime', 'sha256:base-v2'],
+        }
+        registry.manifest_digest.side_effect = lambda image: (
+            "sha256:v2-" + image if image in changed else "sha256:" + image
+        )
+        registry.manifest.side_effect = lambda image: Manifest(
+            digest="sha256:v2-" + image, layers=changed[image],
+        )
+        # The os layer they share is still there, so they don't wait for each other
+        assert updater._layer_dependencies(plan) == {image: set() for image in plan}
+        assert registry.manifest.call_count == 6
+
+    def test_known_manifest_is_not_downloaded_again(self, updater, registry):
+        plan = updater._plan(self.CONTAINERSET)
+        updater._layer_dependencies(plan)
+        updater._layer_dependencies(plan)
+        assert registry.manifest.call_count == 4
+
+    def test_failed_manifest_does_not_delay_pull(self, updater, registry):
+        registry.manifest.side_effect = RegistryError("Boom!")
+        plan = updater._plan(self.CONTAINERSET)
+        assert updater._layer_dependencies(plan) == {image: set() for image in plan}
+
+
+class TestTagPatterns(object):
+    CONTAINERSET = [
+        ContainerSet(name="db", images=['postgres:15.*'], commands=['restart db']),
+        ContainerSet(name="other", images=['postgres:15.*', 'redis:latest'], commands=[]),
+    ]
+
+    @pytest.fixture
+    def tags(self):
+        tags = mock.MagicMock()
+        tags.resolve.return_value = {'postgres:15.*': 'postgres:15.4'}
+        return tags
+
+    @pytest.fixture
+    def updater(self, tags):
+        return Updater(client=mock.MagicMock(), containerset=self.CONTAINERSET, tags=tags)
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_pattern_is_resolved_and_updated(self, run_command_mock, updater, tags):
+        with mock.patch.object(Updater, '_update_image', return_value=True) as m:
+            updater.do_updates()
+        tags.resolve.assert_called_once_with(['postgres:15.*'])
+        assert m.call_args_list == [mock.call('postgres:15.4'), mock.call('redis:latest')]
+        assert mock.call('restart db') in run_command_mock.call_args_list
+
+    def test_unresolved_pattern_fails_its_sets(self, updater, tags):
+        tags.resolve.return_value = {'postgres:15.*': NoMatchingTagError("No tag matches")}
+        with mock.patch.object(Updater, '_update_image', return_value=False) as m:
+            updater.do_updates()
+        assert m.call_args_list == [mock.call('redis:latest')]
+        assert updater.error_count == 2
+
+    def test_state_is_recorded_for_pattern(self, updater, tags, tmpdir):
+        updater.state = StateStore(str(tmpdir.join("state.db")))
+        updater.state_ttl = 60
+        with mock.patch.object(Updater, '_update_image', return_value=False):
+            updater.do_updates()
+        assert updater.state.get('postgres:15.*').success
+        assert updater.state.get('postgres:15.4').success
+
+        with mock.patch.object(Updater, '_update_image', return_value=False) as m:
+            updater.do_updates()
+        # Patterns checked within their TTL aren't resolved again
+        assert tags.resolve.call_count == 1
+        assert not m.called
+
+    def test_pattern_without_resolver_fails(self):
+        updater = Updater(client=mock.MagicMock(), containerset=self.CONTAINERSET)
+        with mock.patch.object(Updater, '_update_image', return_value=False):
+            updater.do_updates()
+        assert updater.error_count == 2
+
+
+class TestRecreateAction(object):
+    CONTAINERSET = [
+        ContainerSet(name="db", images=['postgres:15', 'redis'], commands=[
+            {'recreate': {'containers': ['db-*'], 'concurrency': 2, 'wait_healthy': True}},
+        ]),
+    ]
+
+    @pytest.fixture
+    def updater(self):
+        return Updater(client=mock.MagicMock(), containerset=self.CONTAINERSET)
+
+    def update(self, updater, result):
+        def update_image(image):
+            if image == 'postgres:15':
+                updater._image_ids[image] = ('old-id', 'new-id')
+                return True
+            updater._image_ids[image] = ('redis-id', 'redis-id')
+            return False
+
+        with mock.patch.object(Updater, '_update_image', side_effect=update_image), \
+                mock.patch('diu.updater.ContainerRecreator') as recreator:
+            recreator.return_value.recreate.return_value = result
+            updater.do_updates()
+        return recreator
+
+    def test_containers_of_updated_images_are_recreated(self, updater):
+        recreator = self.update(updater, RecreateResult(recreated=['db-1']))
+        assert recreator.call_args[1]['concurrency'] == 2
+        assert recreator.call_args[1]['wait_healthy']
+        recreator.return_value.recreate.assert_called_once_with(
+            {'old-id': 'postgres:15'}, names=['db-*'])
+        assert updater.error_count == 0
+        assert updater.metrics.get('diu_commands_total', set='db', status='success') == 1
+
+    def test_failed_recreation_is_counted_as_error(self, updater):
+        self.update(updater, RecreateResult(failed=['db-1']))
+        assert updater.error_count == 1
+        assert updater.metrics.get('diu_commands_total', set='db', status='failure') == 1
+
+    def test_containers_of_image_previously_resolved_by_pattern_are_recreated(self, tmpdir):
+        containerset = [ContainerSet(name="db", images=['postgres:15.*'],
+                                     commands=[{'recreate': True}])]
+        tags = mock.MagicMock()
+        tags.resolve.return_value = {'postgres:15.*': 'postgres:15.4'}
+        updater = Updater(client=mock.MagicMock(), containerset=containerset, tags=tags,
+                          state=StateStore(str(tmpdir.join("state.db"))))
+        updater.state.put(ImageState('postgres:15.*', local_id='id-of-15.3'))
+
+        def update_image(image):
+            updater._image_ids[image] = (None, 'id-of-15.4')
+            return True
+
+        with mock.patch.object(Updater, '_update_image', side_effect=update_image), \
+                mock.patch('diu.updater.ContainerRecreator') as recreator:
+            recreator.return_value.recreate.return_value = RecreateResult()
+            updater.do_updates()
+        recreator.return_value.recreate.assert_called_once_with(
+            {'id-of-15.3': 'postgres:15.4'}, names=None)
+
+
+class TestCommands(object):
+    @pytest.fixture
+    def updater(self):
+        return Updater(client=mock.MagicMock(), containerset=[], command_kill_after=0.2)
+
+    def test_command_exceeding_timeout_is_terminated(self, updater):
+        start = time.time()
+        updater._run_command("sleep 5", timeout=0.2)
+        assert time.time() - start < 2
+        assert updater.error_count == 1
+
+    def test_command_ignoring_sigterm_is_killed(self, updater):
+        start = time.time()
+        updater._run_command("trap '' TERM; sleep 5", timeout=0.2)
+        assert time.time() - start < 2
+        assert updater.error_count == 1
+
+    def test_command_within_timeout_succeeds(self, updater):
+        updater.command_timeout = 5
+        updater._run_command("true")
+        assert updater.error_count == 0
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_run_commands_accepts_dicts(self, run_command_mock, updater):
+        updater._run_commands(['foo', {'run': 'bar'}, {'run': 'baz', 'timeout': 5}])
+        assert run_command_mock.call_args_list == [
+            mock.call('foo'), mock.call('bar'), mock.call('baz', timeout=5)
+        ]
+
+    def test_parallel_commands_run_concurrently(self, updater):
+        barrier = threading.Barrier(3, timeout=5)
+        with mock.patch.object(Updater, '_run_command', side_effect=lambda c: barrier.wait()):
+            updater._run_commands([{'parallel': ['a', 'b', 'c']}])
+        assert updater.error_count == 0
+
+    def test_command_concurrency_is_capped(self):
+        updater = Updater(client=mock.MagicMock(), containerset=[], command_concurrency=2)
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def popen(command, **kwargs):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return mock.MagicMock(**{'wait.return_value': 0})
+
+        with mock.patch('diu.updater.subprocess.Popen', side_effect=popen):
+            updater._run_commands([{'parallel': ['a', 'b', 'c', 'd', 'e']}])
+        assert peak[0] == 2
+
+
+class TestDeduplicatedCommands(object):
+    RELOAD = {'run': 'reload nginx', 'dedupe': True}
+    CONTAINERSET = [
+        ContainerSet(name="one", images=['one'], commands=['foo', RELOAD]),
+        ContainerSet(name="two", images=['two'], commands=[RELOAD, 'bar']),
+        ContainerSet(name="three", images=['three'], commands=[{'parallel': [RELOAD]}]),
+    ]
+
+    @pytest.fixture(params=[1, 4])
+    def updater(self, request):
+        return Updater(client=mock.MagicMock(), containerset=self.CONTAINERSET,
+                       concurrency=request.param)
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_command_runs_once_after_all_sets(self, run_command_mock, updater):
+        with mock.patch.object(Updater, '_update_image', return_value=True):
+            updater.do_updates()
+        commands = [c[0][0] for c in run_command_mock.call_args_list]
+        assert sorted(commands) == ['bar', 'foo', 'reload nginx']
+        assert commands[-1] == 'reload nginx'
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_command_runs_if_any_set_triggers_it(self, run_command_mock, updater):
+        with mock.patch.object(Updater, '_update_image', side_effect=lambda i: i == 'two'):
+            updater.do_updates()
+        commands = [c[0][0] for c in run_command_mock.call_args_list]
+        assert commands == ['bar', 'reload nginx']
+
+    def test_command_ready_after_set_without_updates_runs_on_command_thread(self):
+        updater = Updater(client=mock.MagicMock(), containerset=self.CONTAINERSET, concurrency=4)
+        threads = {}
+
+        def update_image(image):
+            if image == 'three':
+                time.sleep(0.05)  # Finish last, without updates
+            return image == 'two'
+
+        def run_command(command, **kwargs):
+            threads[command] = threading.current_thread()
+            return 0
+
+        with mock.patch.object(Updater, '_update_image', side_effect=update_image), \
+                mock.patch.object(Updater, '_run_command', side_effect=run_command):
+            updater.do_updates()
+        assert sorted(threads) == ['bar', 'reload nginx']
+        assert threads['reload nginx'] is not threading.current_thread()
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_command_does_not_run_if_no_set_triggers_it(self, run_command_mock, updater):
+        with mock.patch.object(Updater, '_update_image', return_value=False):
+            updater.do_updates()
+        assert not run_command_mock.called
+
+    @mock.patch('diu.updater.Updater._run_command')
+    def test_command_outside_of_run_is_not_deferred(self, run_command_mock, updater):
+        updater._run_commands([self.RELOAD])
+        assert run_command_mock.call_args_list == [mock.call('reload nginx')]
+
+
+class TestUpdaterAgainstFakeDocker(object):
+    @pytest.fixture
+    def docker(self):
+        from tests.fakedocker import FakeDocker
+        daemon = FakeDocker(inspect_latency=0.01, layers=4, tcp=True).start()
+        yield daemon
+        daemon.stop()
+
+    @pytest.fixture
+    def client(self, docker):
+        from docker import Client
+        return Client(base_url=docker.base_url, version="1.24")
+
+    @mock.patch('diu.updater.Updater._run_command', return_value=0)
+    def test_updates_images_which_changed(self, run_command_mock, docker, client):
+        docker.add_image("changed:latest", local_id="sha256:a", remote_id="sha256:b")
+        docker.add_image("same:latest", local_id="sha256:c", remote_id="sha256:c")
+        docker.add_image("new:latest", remote_id="sha256:d")
+        docker.add_image("gone:latest", local_id="sha256:e")
+        updater = Updater(client, [
+            ContainerSet(name="one", images=["changed:latest", "same:latest"], commands=["a"]),
+            ContainerSet(name="two", images=["same:latest"], commands=["b"]),
+            ContainerSet(name="three", images=["new:latest"], commands=["c"]),
+            ContainerSet(name="four", images=["gone:latest"], commands=["d"]),
+        ], concurrency=2)
+        updater.do_updates()
+
+        assert sorted(c[0][0] for c in run_command_mock.call_args_list) == ['a', 'c']
+        assert updater.error_count == 1
+        assert docker.images["changed:latest"]["Id"] == "sha256:b"
+        assert updater._results["changed:latest"].old_id == "sha256:a"
+        assert updater._results["new:latest"].new_id == "sha256:d"
+        assert updater._results["gone:latest"].error
+
+
+class TestCheckImages(object):
+    CONTAINERSET = [
+        ContainerSet(name="one", images=['stale', 'fresh'], commands=['foo']),
+        ContainerSet(name="two", images=['fresh', 'missing', 'broken'], commands=['bar']),
+    ]
+
+    @pytest.fixture
+    def updater(self):
+        def inspect(image):
+            if image == 'missing':
+                raise APIError("Not found", response=mock.Mock(status_code=404))
+            return {'Id': image, 'RepoDigests': ['{}@sha256:{}'.format(image, image)]}
+
+        def manifest_digest(image):
+            if image == 'broken':
+                raise RegistryError("unreachable")
+            return 'sha256:' + {'stale': 'new'}.get(image, image)
+
+        client = mock.MagicMock()
+        client.inspect_image.side_effect = inspect
+        registry = mock.MagicMock()
+        registry.manifest_digest.side_effect = manifest_digest
+        return Updater(client=client, containerset=self.CONTAINERSET, registry=registry)
+
+    def test_check_compares_each_image_once_without_pulling(self, updater):
+        checks = updater.check_images(concurrency=4)
+        assert [c.image for c in checks] == ['stale', 'fresh', 'missing', 'broken']
+        assert [c.stale for c in checks] == [True, False, True, False]
+        assert checks[0].sets == ['one']
+        assert checks[1].sets == ['one', 'two']
+        assert checks[2].local_id is None
+        assert isinstance(checks[3].error, RegistryError)
+        assert updater.client.inspect_image.call_count == 4
+        assert not updater.client.pull.called
@@ -0,0 +1,122 @@
+import json
+import mock
+import pytest
+import requests
+from diu.updater import ContainerSet
+from diu.webhook import (
+    WebhookServer, build_image_index, build_pattern_index, matching_sets, parse_notification,
+)
+
+
+DOCKER_HUB_PAYLOAD = {
+    'push_data': {'pushed_at': 1417566161, 'pusher': 'trustedbuilder', 'tag': 'latest'},
+    'repository': {'repo_name': 'zoni/jenkins', 'name': 'jenkins', 'namespace': 'zoni'},
+}
+
+REGISTRY_PAYLOAD = {
+    'events': [
+        {
+            'action': 'push',
+            'target': {'repository': 'my/app', 'tag': '1.0', 'digest': 'sha256:1234'},
+            'request': {'host': 'registry.example.com'},
+        },
+        {
+            'action': 'pull',
+            'target': {'repository': 'my/other', 'tag': '1.0'},
+        },
+        {
+            # Blob pushes have no tag
+            'action': 'push',
+            'target': {'repository': 'my/app', 'digest': 'sha256:5678'},
+        },
+    ]
+}
+
+
+def test_parse_docker_hub_notification():
+    assert parse_notification(DOCKER_HUB_PAYLOAD) == [('zoni/jenkins', 'latest')]
+
+
+def test_parse_registry_notification():
+    assert parse_notification(REGISTRY_PAYLOAD) == [('my/app', '1.0')]
+
+
+def test_top_level_repository_of_private_registry_matches():
+    payload = {'events': [{
+        'action': 'push',
+        'target': {'repository': 'app', 'tag': '1.0'},
+        'request': {'host': 'registry.example.com'},
+    }]}
+    pushed = parse_notification(payload)
+    assert pushed == [('app', '1.0')]
+    index = build_image_index([
+        ContainerSet(name='app', images=['registry.example.com/app:1.0']),
+        ContainerSet(name='web', images=['registry.example.com/team/web:1.0']),
+    ])
+    assert matching_sets(pushed, index, {}) == {'app'}
+
+
+def test_parse_unrecognized_notification():
+    with pytest.raises(ValueError):
+        parse_notification({'foo': 'bar'})
+    with pytest.raises(ValueError):
+        parse_notification([])
+
+
+def test_build_image_index():
+    index = build_image_index([
+        ContainerSet(name='one', images=['ubuntu', 'registry.example.com/my/app:1.0']),
+        ContainerSet(name='two', images=['ubuntu:latest']),
+    ])
+    assert index == {
+        ('library/ubuntu', 'latest'): {'one', 'two'},
+        ('my/app', '1.0'): {'one'},
+    }
+
+
+def test_pattern_sets_match_pushed_tags():
+    containerset = [
+        ContainerSet(name='db', images=['postgres:15.*', 'redis']),
+        ContainerSet(name='stable', images=['postgres:^15', 'postgres:^15']),
+        ContainerSet(name='broken', images=['postgres:~1.x']),
+    ]
+    index = build_image_index(containerset)
+    patterns = build_pattern_index(containerset)
+    assert index == {('library/redis', 'latest'): {'db'}}
+    assert [names for _, names in patterns['library/postgres']] == [{'db'}, {'stable'}]
+    assert matching_sets([('library/postgres', '15.5')], index, patterns) == {'db', 'stable'}
+    assert matching_sets([('library/postgres', '15.5-alpine')], index, patterns) == {'db'}
+    assert matching_sets([('library/postgres', '16.0')], index, patterns) == set()
+    assert matching_sets([('library/redis', 'latest'), ('library/postgres', '15')],
+                         index, patterns) == {'db', 'stable'}
+
+
+class TestWebhookServer(object):
+    @pytest.fixture
+    def callback(self):
+        return mock.MagicMock()
+
+    @pytest.fixture
+    def server(self, callback):
+        server = WebhookServer(('127.0.0.1', 0), callback, token='secret')
+        server.start()
+        yield server
+        server.stop()
+
+    def url(self, server, path):
+        return "http://{}:{}{}".format(server.address[0], server.address[1], path)
+
+    def test_notification_is_passed_to_callback(self, server, callback):
+        r = requests.post(self.url(server, '/secret'), data=json.dumps(DOCKER_HUB_PAYLOAD))
+        assert r.status_code == 202
+        callback.assert_called_once_with([('zoni/jenkins', 'latest')])
+
+    def test_wrong_token_is_rejected(self, server, callback):
+        r = requests.post(self.url(server, '/wrong'), data=json.dumps(DOCKER_HUB_PAYLOAD))
+        assert r.status_code == 404
+        assert not callback.called
+
+    def test_invalid_payload_is_rejected(self, server, callback):
+        r = requests.post(self.url(server, '/secret'), data="not json")
+        assert r.status_code == 400
+        assert not callback.called